@@ -0,0 +1,151 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import socket
+import struct
+
+import netaddr
+
+IPV4_ALL_ONES = 0xffffffff
+
+_ipv4_address = struct.Struct('!I')
+
+
+def ip_to_int(ip_address):
+    if isinstance(ip_address, int):
+        return ip_address
+    return _ipv4_address.unpack(socket.inet_aton(str(ip_address)))[0]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(_ipv4_address.pack(value))
+
+
+def mac_to_int(mac):
+    if isinstance(mac, int):
+        return mac
+    return int(mac.replace(':', ''), 16)
+
+
+def int_to_mac(value):
+    return ':'.join('%02x' % (value >> shift & 0xff,)
+                    for shift in range(40, -8, -8))
+
+
+def network_range(network):
+    """The (first, last) addresses of a network, as integers
+
+    The network may be given as a CIDR string, a netaddr.IPNetwork or a
+    (first, last) tuple.
+    """
+    if isinstance(network, tuple):
+        return network
+    network = netaddr.IPNetwork(network)
+    return network.first, network.last
+
+
+def mask_range(address, mask):
+    """The (first, last) addresses of the network of address with mask"""
+    first = address & mask
+    return first, first | (~mask & IPV4_ALL_ONES)
+
+
+def range_to_cidr(first, last):
+    return '%s/%d' % (int_to_ip(first), 33 - (last - first + 1).bit_length())
+
+
+class AddressSet(object):
+    """A set of addresses, kept as integers
+
+    to_int converts the given addresses (e.g. strings) to integers, and
+    to_str converts them back when the set is exported.
+    """
+    def __init__(self, addresses=(), to_int=ip_to_int, to_str=int_to_ip):
+        self._to_int = to_int
+        self._to_str = to_str
+        self._addresses = set(to_int(address) for address in addresses)
+
+    def __contains__(self, address):
+        return address in self._addresses
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def __iter__(self):
+        return iter(sorted(self._addresses))
+
+    def add(self, address):
+        self._addresses.add(self._to_int(address))
+
+    def to_string(self, address):
+        return self._to_str(address)
+
+    def to_strings(self):
+        return [self._to_str(address) for address in self]
+
+
+class NetworkTable(object):
+    """A set of IPv4 networks, with a binary search over their addresses
+
+    The networks are kept as (first, last) integer ranges. The ranges are
+    also merged into a sorted table of disjoint intervals, so looking up
+    the network holding an address is O(log n).
+    """
+    def __init__(self, networks=()):
+        self._networks = set(network_range(network) for network in networks)
+        self._intervals = ([], [])
+        self._rebuild()
+
+    def _rebuild(self):
+        firsts = []
+        lasts = []
+        for first, last in sorted(self._networks):
+            if lasts and first <= lasts[-1] + 1:
+                lasts[-1] = max(lasts[-1], last)
+            else:
+                firsts.append(first)
+                lasts.append(last)
+        # Swap both at once, so readers never see a half-built table
+        self._intervals = (firsts, lasts)
+
+    def __contains__(self, network):
+        """Whether the exact network is in the table"""
+        return network_range(network) in self._networks
+
+    def __len__(self):
+        return len(self._networks)
+
+    def __iter__(self):
+        return iter(sorted(self._networks))
+
+    def add(self, network):
+        network = network_range(network)
+        if network not in self._networks:
+            self._networks.add(network)
+            self._rebuild()
+
+    def contains_address(self, address):
+        """Whether the address is in any of the networks in the table"""
+        firsts, lasts = self._intervals
+        index = bisect.bisect_right(firsts, address) - 1
+        return index >= 0 and address <= lasts[index]
+
+    @staticmethod
+    def to_string(network):
+        return range_to_cidr(*network)
+
+    def to_strings(self):
+        return [range_to_cidr(first, last) for first, last in self]
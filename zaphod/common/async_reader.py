@@ -0,0 +1,69 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+from zaphod.common import packet_reader
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+
+class AsyncPacketReader(packet_reader.PacketReader):
+    """A PacketReader driven by an asyncio event loop
+
+    Instead of a reader thread, the listen socket is registered with the
+    event loop, and the handlers are called from the loop whenever frames
+    are ready. Many readers may share the same loop.
+    """
+    def __init__(self, iface_name=None, loop=None,
+                 recv_mode=packet_reader.RECV_MODE_BATCH, transport=None,
+                 registry=None):
+        if recv_mode == packet_reader.RECV_MODE_SOCKET:
+            # The readiness callback has to drain without blocking
+            recv_mode = packet_reader.RECV_MODE_BATCH
+        super(AsyncPacketReader, self).__init__(iface_name, read_timeout=0,
+                                                recv_mode=recv_mode,
+                                                transport=transport,
+                                                registry=registry)
+        self._loop = loop
+        self._reading = False
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def _on_readable(self):
+        try:
+            self.read_pending()
+        except Exception as e:
+            LOG.error('Failed reading packets')
+            LOG.exception(e)
+
+    def start_reader(self):
+        if not self.is_ready or self._reading:
+            return
+        self.loop.add_reader(self._lsocket.fileno(), self._on_readable)
+        self._reading = True
+
+    def stop_reader(self):
+        if self._reading:
+            self.loop.remove_reader(self._lsocket.fileno())
+            self._reading = False
+
+    def close(self):
+        self.stop_reader()
+        super(AsyncPacketReader, self).close()
@@ -0,0 +1,152 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import errno
+import socket
+import struct
+
+from zaphod.common import packet_filter
+
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+SO_DETACH_FILTER = getattr(socket, 'SO_DETACH_FILTER', 27)
+
+# Classic BPF opcodes (linux/filter.h)
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LDX_B_MSH = 0xb1
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+
+BPF_ACCEPT = 0x40000
+BPF_DROP = 0
+
+_ETHERTYPE_OFFSET = 12
+_IP_OFFSET = packet_filter.ETH_HLEN
+_IP_PROTO_OFFSET = _IP_OFFSET + 9
+_IP_FRAG_OFFSET = _IP_OFFSET + 6
+
+_sock_filter = struct.Struct('HBBI')
+
+# Jump targets, resolved when the block is assembled
+_NEXT = 'next'
+_FAIL = 'fail'
+_ACCEPT = 'accept'
+
+
+def _insn(code, k=0, jt=_NEXT, jf=_NEXT):
+    return code, jt, jf, k
+
+
+def _assemble_block(insns):
+    # Every block ends with its own accept, and failing jumps to the
+    # instruction following the block, so jump offsets never cross blocks
+    # and stay within the 8 bit limit.
+    insns = list(insns) + [_insn(BPF_RET_K, BPF_ACCEPT)]
+    targets = {_ACCEPT: len(insns) - 1, _FAIL: len(insns)}
+
+    def _offset(index, target):
+        if target == _NEXT:
+            return 0
+        if target in targets:
+            return targets[target] - index - 1
+        return target
+
+    return [(code, _offset(index, jt), _offset(index, jf), k)
+            for index, (code, jt, jf, k) in enumerate(insns)]
+
+
+def _port_checks(ports):
+    insns = [
+        _insn(BPF_LD_H_ABS, _IP_FRAG_OFFSET),
+        _insn(BPF_JSET_K, 0x1fff, jt=_FAIL),
+        _insn(BPF_LDX_B_MSH, _IP_OFFSET),
+    ]
+    for port_offset in (_IP_OFFSET, _IP_OFFSET + 2):
+        insns.append(_insn(BPF_LD_H_IND, port_offset))
+        for port in ports:
+            insns.append(_insn(BPF_JEQ_K, port, jt=_ACCEPT))
+    code, jt, jf, k = insns[-1]
+    insns[-1] = (code, jt, _FAIL, k)
+    return insns
+
+
+def _compile_match(match):
+    insns = [
+        _insn(BPF_LD_H_ABS, _ETHERTYPE_OFFSET),
+        _insn(BPF_JEQ_K, match.ethertype, jf=_FAIL),
+    ]
+    if match.ip_proto is None and not match.ports:
+        return _assemble_block(insns)
+    if match.ethertype != packet_filter.ETH_TYPE_IP:
+        # IP level fields can never match on a non-IP frame
+        return []
+    insns.append(_insn(BPF_LD_B_ABS, _IP_PROTO_OFFSET))
+    if match.ip_proto is not None:
+        insns.append(_insn(BPF_JEQ_K, match.ip_proto, jf=_FAIL))
+    else:
+        insns.append(_insn(BPF_JEQ_K, packet_filter.IPPROTO_TCP, jt=1))
+        insns.append(_insn(BPF_JEQ_K, packet_filter.IPPROTO_UDP, jf=_FAIL))
+    if match.ports:
+        insns.extend(_port_checks(match.ports))
+    return _assemble_block(insns)
+
+
+def compile_matches(matches):
+    """Build a classic BPF program accepting the frames of the given matches
+
+    Returns the program as packed sock_filter instructions, or None if one
+    of the matches accepts every frame, in which case no filter is needed.
+    """
+    matches = list(matches)
+    if any(match.match_all for match in matches):
+        return None
+    insns = []
+    if matches:
+        # VLAN tagged frames that were not offloaded by the NIC are left for
+        # the user space classifier to handle
+        insns.extend(_assemble_block([
+            _insn(BPF_LD_H_ABS, _ETHERTYPE_OFFSET),
+            _insn(BPF_JEQ_K, packet_filter.ETH_TYPE_8021Q, jt=_ACCEPT),
+            _insn(BPF_JEQ_K, packet_filter.ETH_TYPE_8021AD, jf=_FAIL),
+        ]))
+    for match in matches:
+        insns.extend(_compile_match(match))
+    insns.append(_insn(BPF_RET_K, BPF_DROP, jt=0, jf=0))
+    return b''.join(_sock_filter.pack(*insn) for insn in insns)
+
+
+def attach_filter(sock, program):
+    """Attach a compiled program to the socket, replacing any older one
+
+    A program of None detaches the current filter.
+    """
+    if program is None:
+        detach_filter(sock)
+        return
+    buf = ctypes.create_string_buffer(program, len(program))
+    fprog = struct.pack('HP', len(program) // _sock_filter.size,
+                        ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def detach_filter(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+    except socket.error as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -19,12 +19,14 @@ import json
 
 class Config(object):
 
-    def __init__(self):
-        parser = argparse.ArgumentParser(description='Zaphod test')
-        parser.add_argument('-c', '--config', required=True,
-                            help='Config file to use')
-        args = parser.parse_args()
-        with open(args.config) as json_file:
+    def __init__(self, config_file=None):
+        if config_file is None:
+            parser = argparse.ArgumentParser(description='Zaphod test')
+            parser.add_argument('-c', '--config', required=True,
+                                help='Config file to use')
+            args = parser.parse_args()
+            config_file = args.config
+        with open(config_file) as json_file:
             self.data = json.load(json_file)
 
     def _get_component_config(self, component):
@@ -37,3 +39,6 @@ class Config(object):
 
     def get_dhcp_config(self):
         return self._get_component_config('dhcp')
+
+    def get_daemon_config(self):
+        return self._get_component_config('daemon')
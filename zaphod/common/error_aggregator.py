@@ -0,0 +1,231 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import time
+
+from zaphod.common import rate_limiter
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+# Notifications per second, and how many may be sent at once
+DEFAULT_RATE = 10
+DEFAULT_BURST = 50
+# An error that keeps being reported is notified again after this long
+DEFAULT_RENOTIFY_INTERVAL = 300
+DEFAULT_MAX_ENTRIES = 65536
+# Errors that were not reported for this long are forgotten
+DEFAULT_ENTRY_TIMEOUT = 3600
+
+
+class AggregatedError(object):
+    """All the reports of the same error"""
+    __slots__ = ('key', 'error', 'count', 'first_seen', 'last_seen',
+                 'notified_at', 'notified_count')
+
+    def __init__(self, key, error, now):
+        self.key = key
+        self.error = error
+        self.count = 1
+        self.first_seen = now
+        self.last_seen = now
+        self.notified_at = None
+        self.notified_count = 0
+
+    def update(self, error, now):
+        # Keep the latest report, for its volatile fields
+        self.error = error
+        self.count += 1
+        self.last_seen = now
+
+    def to_dict(self):
+        result = self.error.to_dict()
+        # Errors may have a count of their own
+        result.update(reports=self.count, first_seen=self.first_seen,
+                      last_seen=self.last_seen)
+        return result
+
+    def __str__(self):
+        if self.count == 1:
+            return str(self.error)
+        return '%s (reported %d times)' % (self.error, self.count)
+
+    def __repr__(self):
+        return str(self)
+
+
+class ErrorAggregator(object):
+    """Merge repeated errors, and limit the rate of their notifications
+
+    The aggregator is registered as a callback of the handlers (or of a
+    ResultBatcher). Errors are merged by their get_key, counting the
+    reports of each one. Its callbacks get a list of AggregatedError: an
+    error is notified when it is first reported, and again if it is still
+    reported renotify_interval seconds later. The notifications are limited
+    to rate per second (None for no limit); the ones over the limit are
+    held until there is room, and then notified from a flush thread, or on
+    later reports or flush, whichever comes first. Up to
+    max_entries errors are kept, and the ones not reported for
+    entry_timeout seconds are forgotten, least recently reported first.
+    """
+    def __init__(self,
+                 rate=DEFAULT_RATE,
+                 burst=DEFAULT_BURST,
+                 renotify_interval=DEFAULT_RENOTIFY_INTERVAL,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 entry_timeout=DEFAULT_ENTRY_TIMEOUT):
+        self.renotify_interval = renotify_interval
+        self.max_entries = max_entries
+        self.entry_timeout = entry_timeout
+        self._bucket = (rate_limiter.TokenBucket(rate, burst)
+                        if rate else None)
+        self._callbacks = []
+        # Keys to entries, least recently reported first
+        self._entries = collections.OrderedDict()
+        # The entries waiting to be notified, in the order they became due
+        self._due = collections.OrderedDict()
+        self._cond = threading.Condition()
+        # When the flush thread should notify the held errors
+        self._flush_at = None
+        self._closed = False
+        self._thread = None
+        # Reports that were merged into an earlier notification
+        self.suppressed = 0
+
+    def register_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def __call__(self, errors):
+        if not errors:
+            return
+        now = time.time()
+        with self._cond:
+            for error in errors:
+                self._add_error(error, now)
+            self._evict(now)
+            notifications = self._take_due(now, True)
+            self._schedule_flush()
+        if notifications:
+            self._emit(notifications)
+
+    def _add_error(self, error, now):
+        key = error.get_key()
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = AggregatedError(key, error, now)
+            self._entries[key] = entry
+            self._due[key] = entry
+            return
+        entry.update(error, now)
+        self._entries.move_to_end(key)
+        if key in self._due:
+            return
+        if (entry.notified_at is not None and
+                now - entry.notified_at >= self.renotify_interval):
+            self._due[key] = entry
+        else:
+            self.suppressed += 1
+
+    def _evict(self, now):
+        idle_since = now - self.entry_timeout
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if (len(self._entries) <= self.max_entries and
+                    entry.last_seen > idle_since):
+                break
+            del self._entries[key]
+            self._due.pop(key, None)
+
+    def _take_due(self, now, limited):
+        notifications = []
+        while self._due:
+            if (limited and self._bucket is not None and
+                    not self._bucket.try_consume()):
+                break
+            _key, entry = self._due.popitem(last=False)
+            entry.notified_at = now
+            entry.notified_count = entry.count
+            notifications.append(entry)
+        return notifications
+
+    def _schedule_flush(self):
+        if not self._due or self._flush_at is not None or self._closed:
+            return
+        # There is room for another notification within 1 / rate seconds
+        self._flush_at = time.monotonic() + 1 / self._bucket.rate
+        if self._thread is None:
+            # Only rate limited aggregators ever hold errors
+            self._thread = threading.Thread(target=self._run,
+                                            name='error-aggregator')
+            self._thread.daemon = True
+            self._thread.start()
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._flush_at is not None:
+                        timeout = self._flush_at - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                self._flush_at = None
+            self.flush()
+
+    def _emit(self, notifications):
+        for callback in self._callbacks:
+            try:
+                callback(notifications)
+            except Exception as e:
+                LOG.error('Exception in aggregated errors callback')
+                LOG.exception(e)
+
+    def flush(self, limited=True):
+        """Notify the held errors, within the rate limit if limited"""
+        with self._cond:
+            notifications = self._take_due(time.time(), limited)
+            self._schedule_flush()
+        if notifications:
+            self._emit(notifications)
+
+    def get_errors(self):
+        """All the errors kept, least recently reported first"""
+        with self._cond:
+            return list(self._entries.values())
+
+    def clear(self):
+        with self._cond:
+            self._entries.clear()
+            self._due.clear()
+            self.suppressed = 0
+
+    def close(self):
+        """Stop the flush thread, notifying the held errors"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(limited=False)
@@ -0,0 +1,187 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+
+from zaphod.common import learned_state
+from zaphod.common import packet_reader
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+DEFAULT_STATE_INTERVAL = 5
+
+_MSG_ERRORS = 'errors'
+_MSG_STATE = 'state'
+_MSG_DONE = 'done'
+
+
+def _send_errors(results, worker_index, protocol_name, errors):
+    if errors:
+        results.put((_MSG_ERRORS, worker_index, protocol_name, errors))
+
+
+def _send_states(results, worker_index, handlers):
+    for handler in handlers:
+        results.put((_MSG_STATE, worker_index, handler.get_protocol_name(),
+                     handler.export_learned_state()))
+
+
+def _run_worker(worker_index, iface_name, fanout_group, fanout_mode,
+                recv_mode, handler_factory, results, stop_event,
+                state_interval, transport):
+    reader = packet_reader.PacketReader(iface_name, read_timeout=1,
+                                        recv_mode=recv_mode,
+                                        fanout_group=fanout_group,
+                                        fanout_mode=fanout_mode,
+                                        transport=transport)
+    handlers = []
+    try:
+        if not reader.is_ready:
+            LOG.error('Fanout worker %d reader is not ready', worker_index)
+            return
+        handlers = handler_factory(reader)
+        for handler in handlers:
+            handler.register_callback(functools.partial(
+                _send_errors, results, worker_index,
+                handler.get_protocol_name()))
+        reader.start_reader()
+        while not stop_event.wait(state_interval):
+            _send_states(results, worker_index, handlers)
+        reader.stop_reader()
+        _send_states(results, worker_index, handlers)
+    finally:
+        for handler in handlers:
+            handler.close()
+        if reader.is_ready:
+            reader.close()
+        results.put((_MSG_DONE, worker_index, None, None))
+
+
+class FanoutCapture(object):
+    """Capture on an interface with a PACKET_FANOUT group of processes
+
+    Each worker process opens its own socket in the fanout group, so the
+    kernel splits the frames between them (by flow hash, or by the CPU that
+    received them), and runs the protocol handlers returned by
+    handler_factory(reader). The errors the workers find are passed to the
+    callbacks registered here, and their learned state is merged back into
+    the parent, by protocol name.
+
+    If transport is given (e.g. a MemoryTransport), the workers read from
+    it instead, each taking the next frame when it is ready.
+    """
+    def __init__(self, iface_name, handler_factory,
+                 workers=None,
+                 fanout_mode=packet_reader.FANOUT_HASH,
+                 fanout_group=None,
+                 recv_mode=packet_reader.RECV_MODE_BATCH,
+                 state_interval=DEFAULT_STATE_INTERVAL,
+                 transport=None):
+        self.iface_name = iface_name
+        self._handler_factory = handler_factory
+        self._workers = workers or os.cpu_count() or 1
+        self._fanout_mode = fanout_mode
+        if fanout_group is None:
+            fanout_group = os.getpid() & 0xffff
+        self._fanout_group = fanout_group
+        self._recv_mode = recv_mode
+        self._state_interval = state_interval
+        self._transport = transport
+        # The workers inherit the parent state through fork
+        self._context = multiprocessing.get_context('fork')
+        self._results = self._context.Queue()
+        self._stop_event = self._context.Event()
+        self._processes = []
+        self._collector = None
+        self._callbacks = []
+        self._worker_states = {}
+        self._lock = threading.Lock()
+
+    def register_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def get_learned_state(self, protocol_name):
+        with self._lock:
+            states = [states[protocol_name]
+                      for states in self._worker_states.values()
+                      if protocol_name in states]
+        merged = {}
+        for state in states:
+            learned_state.merge_learned_state(merged, state)
+        return merged
+
+    def _emit_results(self, protocol_name, errors):
+        for callback in self._callbacks:
+            try:
+                callback(errors)
+            except Exception as e:
+                LOG.error('Exception in callback for %s', protocol_name)
+                LOG.exception(e)
+
+    def _collect_results(self, workers):
+        while workers:
+            try:
+                msg_type, worker_index, protocol_name, data = \
+                    self._results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive()
+                           for process in self._processes):
+                    return
+                continue
+            if msg_type == _MSG_ERRORS:
+                self._emit_results(protocol_name, data)
+            elif msg_type == _MSG_STATE:
+                with self._lock:
+                    self._worker_states.setdefault(
+                        worker_index, {})[protocol_name] = data
+            elif msg_type == _MSG_DONE:
+                workers -= 1
+
+    def start(self):
+        if self._processes:
+            return
+        self._stop_event.clear()
+        for worker_index in range(self._workers):
+            process = self._context.Process(
+                target=_run_worker,
+                args=(worker_index, self.iface_name, self._fanout_group,
+                      self._fanout_mode, self._recv_mode,
+                      self._handler_factory, self._results,
+                      self._stop_event, self._state_interval,
+                      self._transport),
+                name='fanout-%d' % (worker_index,))
+            process.daemon = True
+            self._processes.append(process)
+            process.start()
+        self._collector = threading.Thread(target=self._collect_results,
+                                           args=(self._workers,))
+        self._collector.start()
+
+    def stop(self):
+        if not self._processes:
+            return
+        self._stop_event.set()
+        self._collector.join()
+        for process in self._processes:
+            process.join()
+        self._processes = []
+        self._collector = None
@@ -0,0 +1,46 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The learned state of a handler is a dict of dicts and lists, as returned
+# by its export_learned_state
+
+
+def merge_learned_state(state, other):
+    """Merge a learned state exported by a handler into another one"""
+    for key, value in other.items():
+        if isinstance(value, dict):
+            merged = state.setdefault(key, {})
+            for item_key, item in value.items():
+                merged.setdefault(item_key, item)
+        else:
+            merged = state.setdefault(key, [])
+            merged.extend(item for item in value if item not in merged)
+    return state
+
+
+def diff_learned_state(stored, state):
+    """The part of a learned state that merging adds to the stored one"""
+    diff = {}
+    for key, value in state.items():
+        if isinstance(value, dict):
+            known = stored.get(key, {})
+            new = {item_key: item for item_key, item in value.items()
+                   if item_key not in known}
+        else:
+            known = set(stored.get(key, ()))
+            new = [item for item in value if item not in known]
+        if new:
+            diff[key] = new
+    return diff
@@ -0,0 +1,245 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import collections
+import http.server
+import threading
+
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Handler processing times and probe round trips, in seconds
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+    """A value that only goes up
+
+    Updates are not locked, to keep them cheap. Each metric is expected to
+    be updated from a single thread, e.g. the thread of its reader.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def to_value(self):
+        return self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram(object):
+    """Counts of the observed values, by the upper bounds of buckets"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last count is of the values above all the buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_value(self):
+        return {
+            'buckets': dict(zip(self.buckets, self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class _MetricFamily(object):
+    def __init__(self, name, help_text, metric_type, factory):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.factory = factory
+        # Label tuples to metrics
+        self.metrics = collections.OrderedDict()
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels),)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """The metrics of the readers and handlers
+
+    Metrics are created once, by name and labels, and then updated
+    directly, so the hot paths only pay for the update itself. Collectors
+    are called before the metrics are read, to update metrics that are
+    expensive to keep current (e.g. socket statistics).
+    """
+    def __init__(self):
+        self._families = collections.OrderedDict()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_metric(self, name, help_text, metric_type, factory, labels):
+        label_key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = _MetricFamily(name, help_text, metric_type, factory)
+                self._families[name] = family
+            elif family.metric_type != metric_type:
+                raise ValueError('Metric %s is a %s' % (name,
+                                                        family.metric_type))
+            metric = family.metrics.get(label_key)
+            if metric is None:
+                metric = family.factory()
+                family.metrics[label_key] = metric
+            return metric
+
+    def counter(self, name, help_text, **labels):
+        return self._get_metric(name, help_text, COUNTER, Counter, labels)
+
+    def gauge(self, name, help_text, **labels):
+        return self._get_metric(name, help_text, GAUGE, Gauge, labels)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get_metric(name, help_text, HISTOGRAM,
+                                lambda: Histogram(buckets), labels)
+
+    def register_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def unregister_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def collect(self):
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                LOG.error('Exception in metrics collector')
+                LOG.exception(e)
+        with self._lock:
+            return [(family, list(family.metrics.items()))
+                    for family in self._families.values()]
+
+    def snapshot(self):
+        """The current values, by metric name and then by label tuple"""
+        return {family.name: {labels: metric.to_value()
+                              for labels, metric in metrics}
+                for family, metrics in self.collect()}
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        for family, metrics in self.collect():
+            lines.append('# HELP %s %s' % (family.name, family.help_text))
+            lines.append('# TYPE %s %s' % (family.name, family.metric_type))
+            for labels, metric in metrics:
+                if family.metric_type != HISTOGRAM:
+                    lines.append('%s%s %s' % (family.name,
+                                              _format_labels(labels),
+                                              _format_value(metric.value)))
+                    continue
+                total = 0
+                bounds = metric.buckets + (float('inf'),)
+                for bound, count in zip(bounds, metric.counts):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (
+                        family.name,
+                        _format_labels(labels,
+                                       (('le', _format_value(bound)),)),
+                        total))
+                lines.append('%s_sum%s %s' % (family.name,
+                                              _format_labels(labels),
+                                              _format_value(metric.sum)))
+                lines.append('%s_count%s %d' % (family.name,
+                                                _format_labels(labels),
+                                                metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug('Metrics request: ' + format, *args)
+
+
+def start_http_server(port, address='127.0.0.1', registry=REGISTRY):
+    """Serve the metrics for Prometheus from a background thread
+
+    Returns the server, to be stopped with its shutdown method.
+    """
+    handler_class = type('MetricsRequestHandler', (_MetricsRequestHandler,),
+                         {'registry': registry})
+    server = http.server.ThreadingHTTPServer((address, port), handler_class)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,162 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_BUFFER_SIZE = 65535
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+class _SockAddrLL(ctypes.Structure):
+    _fields_ = [('sll_family', ctypes.c_ushort),
+                ('sll_protocol', ctypes.c_ushort),
+                ('sll_ifindex', ctypes.c_int),
+                ('sll_hatype', ctypes.c_ushort),
+                ('sll_pkttype', ctypes.c_ubyte),
+                ('sll_halen', ctypes.c_ubyte),
+                ('sll_addr', ctypes.c_ubyte * 8)]
+
+
+def _load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr),
+                         ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+_recvmmsg = _load_recvmmsg()
+
+
+class BatchReceiver(object):
+    """Receive frames in batches into a preallocated buffer pool
+
+    Uses recvmmsg where the C library has it, and recvfrom_into otherwise.
+    The frames are handed out as memoryviews into the pool, which are only
+    valid while the frame handler is running.
+    """
+    def __init__(self, sock,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 use_recvmmsg=True):
+        self._sock = sock
+        # A non-blocking twin of the socket, so draining the socket never
+        # waits for the socket timeout
+        self._nb_sock = socket.fromfd(sock.fileno(), sock.family, sock.type,
+                                      sock.proto)
+        self._nb_sock.setblocking(False)
+        self._batch_size = batch_size
+        self._buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self._views = [memoryview(buf) for buf in self._buffers]
+        self._poll = select.poll()
+        self._poll.register(sock.fileno(), select.POLLIN | select.POLLERR)
+        self._msgs = None
+        if use_recvmmsg and _recvmmsg:
+            self._setup_msgs(buffer_size)
+
+    def _setup_msgs(self, buffer_size):
+        self._addrs = (_SockAddrLL * self._batch_size)()
+        self._iovecs = (_IOVec * self._batch_size)()
+        self._msgs = (_MMsgHdr * self._batch_size)()
+        for index, buf in enumerate(self._buffers):
+            c_buf = (ctypes.c_char * buffer_size).from_buffer(buf)
+            self._iovecs[index].iov_base = ctypes.addressof(c_buf)
+            self._iovecs[index].iov_len = buffer_size
+            hdr = self._msgs[index].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[index])
+            hdr.msg_iov = ctypes.pointer(self._iovecs[index])
+            hdr.msg_iovlen = 1
+
+    def _receive_mmsg(self):
+        addr_len = ctypes.sizeof(_SockAddrLL)
+        for msg in self._msgs:
+            msg.msg_hdr.msg_namelen = addr_len
+        count = _recvmmsg(self._sock.fileno(), self._msgs,
+                          self._batch_size, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise socket.error(err, os.strerror(err))
+        return [(self._msgs[index].msg_len, self._addrs[index].sll_pkttype)
+                for index in range(count)]
+
+    def _receive_into(self):
+        received = []
+        for buf in self._buffers:
+            try:
+                nbytes, sa_ll = self._nb_sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            received.append((nbytes, sa_ll[2]))
+        return received
+
+    def read(self, frame_handler, timeout):
+        """Pass a batch of up to batch_size frames to the frame handler
+
+        Waits up to timeout seconds for the first frame, and returns the
+        number of frames handled.
+        """
+        if not self._poll.poll(timeout * 1000):
+            return 0
+        if self._msgs:
+            received = self._receive_mmsg()
+        else:
+            received = self._receive_into()
+        for index, (nbytes, pkt_type) in enumerate(received):
+            frame = self._views[index][:nbytes]
+            try:
+                frame_handler(frame, pkt_type)
+            finally:
+                frame.release()
+        return len(received)
+
+    def close(self):
+        self._msgs = None
+        self._nb_sock.close()
+        for view in self._views:
+            view.release()
@@ -0,0 +1,103 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+ETH_HLEN = 14
+VLAN_HLEN = 4
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_8021Q = 0x8100
+ETH_TYPE_8021AD = 0x88a8
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+_VLAN_ETH_TYPES = (ETH_TYPE_8021Q, ETH_TYPE_8021AD)
+_PORT_PROTOCOLS = (IPPROTO_TCP, IPPROTO_UDP)
+
+_unpack_short = struct.Struct('!H').unpack_from
+_unpack_ports = struct.Struct('!HH').unpack_from
+
+
+class Match(object):
+    """Describes the frames a packet handler is interested in
+
+    The match is evaluated on the raw frame bytes, before any parsing is
+    done. A match with no ethertype accepts every frame.
+    """
+    def __init__(self, ethertype=None, ip_proto=None, ports=()):
+        self.ethertype = ethertype
+        self.ip_proto = ip_proto
+        self.ports = tuple(ports)
+
+    @property
+    def match_all(self):
+        return self.ethertype is None
+
+    def matches(self, ethertype, ip_proto, src_port, dst_port):
+        if self.ethertype is None:
+            return True
+        if ethertype != self.ethertype:
+            return False
+        if self.ip_proto is not None and ip_proto != self.ip_proto:
+            return False
+        if self.ports and (src_port not in self.ports and
+                           dst_port not in self.ports):
+            return False
+        return True
+
+    def __repr__(self):
+        return 'Match(ethertype=%s, ip_proto=%s, ports=%s)' % (
+            self.ethertype, self.ip_proto, self.ports)
+
+
+MATCH_ALL = Match()
+
+
+def get_network_header(data):
+    """Get the ethertype of a frame and the offset of its network header
+
+    VLAN tags are skipped. The frame must hold at least an ethernet header.
+    """
+    data_len = len(data)
+    offset = ETH_HLEN
+    ethertype, = _unpack_short(data, offset - 2)
+    while ethertype in _VLAN_ETH_TYPES and data_len >= offset + VLAN_HLEN:
+        offset += VLAN_HLEN
+        ethertype, = _unpack_short(data, offset - 2)
+    return ethertype, offset
+
+
+def classify(data):
+    """Extract the demux fields of an ethernet frame
+
+    Returns a tuple of (ethertype, ip_proto, src_port, dst_port), where the
+    fields that do not apply to the frame are None, or None if the frame is
+    too short to hold an ethernet header.
+    """
+    data_len = len(data)
+    if data_len < ETH_HLEN:
+        return None
+    ethertype, offset = get_network_header(data)
+    if ethertype != ETH_TYPE_IP or data_len < offset + 20:
+        return ethertype, None, None, None
+    ip_header_len = (data[offset] & 0x0f) * 4
+    ip_proto = data[offset + 9]
+    frag_offset, = _unpack_short(data, offset + 6)
+    offset += ip_header_len
+    if (ip_proto not in _PORT_PROTOCOLS or frag_offset & 0x1fff or
+            data_len < offset + 4):
+        return ethertype, ip_proto, None, None
+    src_port, dst_port = _unpack_ports(data, offset)
+    return ethertype, ip_proto, src_port, dst_port
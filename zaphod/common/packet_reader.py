@@ -16,22 +16,285 @@
 import atexit
 import collections
 import socket
+import struct
 import threading
+import time
 
-from ryu.lib.packet import packet as ryu_packet
-
-from zaphod.common import socket_utils
+from zaphod.common import bpf
+from zaphod.common import metrics
+from zaphod.common import packet_batch
+from zaphod.common import packet_filter
+from zaphod.common import packet_ring
+from zaphod.common import transport as zaphod_transport
 from zaphod.common import logger
 LOG = logger.get_logger(__name__)
 
 ETH_P_ALL = 0x0003
 
+RECV_MODE_SOCKET = 'socket'
+RECV_MODE_RING = 'ring'
+RECV_MODE_BATCH = 'batch'
+
+PACKET_FANOUT = 18
+FANOUT_HASH = 0
+FANOUT_LB = 1
+FANOUT_CPU = 2
+
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_DROP_MEMBERSHIP = 2
+PACKET_MR_PROMISC = 1
+PACKET_STATISTICS = 6
+
+# Frames addressed to the local host
+PKT_TYPES_HOST = frozenset((socket.PACKET_HOST,))
+# Every frame seen on the wire that was not sent by the local host. Frames
+# addressed to other hosts are only seen in promiscuous mode.
+PKT_TYPES_ALL = frozenset((socket.PACKET_HOST, socket.PACKET_BROADCAST,
+                           socket.PACKET_MULTICAST, socket.PACKET_OTHERHOST))
+
+# struct packet_mreq: mr_ifindex, mr_type, mr_alen, mr_address
+_packet_mreq = struct.Struct('iHH8s')
+# struct tpacket_stats: tp_packets, tp_drops. The TPACKET_V3 stats add a
+# freeze count, so room is left for it.
+_tpacket_stats = struct.Struct('II')
+_TPACKET_STATS_V3_LEN = 12
+
+_HandlerEntry = collections.namedtuple('_HandlerEntry',
+                                       ('protocol', 'handler', 'match',
+                                        'raw', 'pkt_types', 'timer',
+                                        'errors'))
+
+# Bounds the memory of a dispatch table fed with many kinds of frames
+DISPATCH_CACHE_SIZE = 4096
+
+
+class ReaderMetrics(object):
+    """The frame counters of a reader, labeled with the reader name"""
+    def __init__(self, registry, name):
+        self.received = registry.counter(
+            'zaphod_frames_received_total',
+            'Frames read by the reader', reader=name)
+        self.outgoing = registry.counter(
+            'zaphod_frames_outgoing_total',
+            'Frames sent by the local host, which are discarded',
+            reader=name)
+        self.filtered = registry.counter(
+            'zaphod_frames_filtered_total',
+            'Frames no handler was interested in', reader=name)
+        self.dispatched = registry.counter(
+            'zaphod_frames_dispatched_total',
+            'Frames passed to at least one handler', reader=name)
+        self.parsed = registry.counter(
+            'zaphod_frames_parsed_total',
+            'Frames parsed for the handlers of parsed packets', reader=name)
+        self.parse_errors = registry.counter(
+            'zaphod_parse_errors_total',
+            'Frames that failed parsing', reader=name)
+
+
+# ryu is only needed by handlers that ask for a parsed packet
+_ryu_packet = None
+
+
+def _parse_packet(data):
+    global _ryu_packet
+    if _ryu_packet is None:
+        from ryu.lib.packet import packet as ryu_packet
+        _ryu_packet = ryu_packet
+    return _ryu_packet.Packet(data)
+
+
+class _DispatchTable(object):
+    """An immutable snapshot of the registered handlers
+
+    Finds the handlers of a frame from its packet type and demux fields.
+    The handlers of every kind of frame are computed once, in registration
+    order, and cached by the packet type and the fields the handlers look
+    at. Ports no handler matches on are left out of the key, so frames to
+    random ports share the same cache entry.
+    """
+    def __init__(self, entries):
+        self.entries = tuple(entries)
+        self._ports = frozenset(port for entry in self.entries
+                                for port in entry.match.ports)
+        self._cache = {}
+
+    def _find(self, pkt_type, frame_key):
+        return tuple(entry for entry in self.entries
+                     if pkt_type in entry.pkt_types and
+                     entry.match.matches(*frame_key))
+
+    def lookup(self, pkt_type, frame_key):
+        ethertype, ip_proto, src_port, dst_port = frame_key
+        ports = self._ports
+        key = (pkt_type, ethertype, ip_proto,
+               src_port if src_port in ports else None,
+               dst_port if dst_port in ports else None)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        entries = self._find(pkt_type, key[1:])
+        cache = self._cache
+        if len(cache) >= DISPATCH_CACHE_SIZE:
+            cache.clear()
+        cache[key] = entries
+        return entries
+
+
+class PacketDispatcher(object):
+    """Pass frames to the protocol handlers registered for them
+
+    The frames and the time spent in every handler are counted in the
+    registry (by default metrics.REGISTRY), labeled with the name of the
+    dispatcher.
+    """
+    def __init__(self, name, registry=None):
+        self.name = name
+        self.registry = registry if registry is not None else \
+            metrics.REGISTRY
+        self.metrics = ReaderMetrics(self.registry, name)
+        # Registration replaces the dispatch table as a whole, so the
+        # reader never sees it changing, and needs no locking
+        self._dispatch = _DispatchTable(())
+        self._handlers_lock = threading.Lock()
+        # Handlers send through the transport, if the dispatcher has one
+        self.transport = None
+
+    def register_protocol_packet_handler(self, protocol, handler, match=None,
+                                         raw=False, pkt_types=None):
+        """Register a handler for the frames accepted by match
+
+        Handlers are passed a parsed ryu packet holding the given protocol.
+        If raw is set, the handler is passed the frame data as is, without
+        parsing it. The data may be a view into a buffer that is reused once
+        the handler returns. Only frames of the given pkt_types (as in
+        sll_pkttype) are passed to the handler, by default the frames
+        addressed to the local host.
+        """
+        if match is None:
+            match = packet_filter.MATCH_ALL
+        if pkt_types is None:
+            pkt_types = PKT_TYPES_HOST
+        handler_name = getattr(handler, '__qualname__', repr(handler))
+        timer = self.registry.histogram(
+            'zaphod_handler_seconds', 'Time spent handling a frame',
+            reader=self.name, handler=handler_name)
+        errors = self.registry.counter(
+            'zaphod_handler_errors_total', 'Exceptions raised by handlers',
+            reader=self.name, handler=handler_name)
+        entry = _HandlerEntry(protocol, handler, match, raw,
+                              frozenset(pkt_types), timer, errors)
+        with self._handlers_lock:
+            self._dispatch = _DispatchTable(self._dispatch.entries +
+                                            (entry,))
+            self._update_filter()
+
+    def unregister_protocol_packet_handler(self, protocol, handler):
+        with self._handlers_lock:
+            entries = list(self._dispatch.entries)
+            for entry in entries:
+                if entry.protocol == protocol and entry.handler == handler:
+                    entries.remove(entry)
+                    self._dispatch = _DispatchTable(entries)
+                    self._update_filter()
+                    return
+        raise ValueError('Handler is not registered for protocol')
+
+    @property
+    def _handlers(self):
+        return self._dispatch.entries
+
+    def _update_filter(self):
+        pass
+
+    def _get_interested_handlers(self, data, pkt_type=socket.PACKET_HOST):
+        frame_key = packet_filter.classify(data)
+        if frame_key is None:
+            return ()
+        return self._dispatch.lookup(pkt_type, frame_key)
 
-class PacketReader(object):
-    def __init__(self, iface_name, read_timeout=5):
-        self.iface_name = iface_name
-        self._protocols = collections.defaultdict(list)
-        self._lsocket = self._bind_lsock(read_timeout)
+    @staticmethod
+    def _call_handler(entry, data):
+        start = time.perf_counter()
+        try:
+            entry.handler(data)
+        except Exception as e:
+            entry.errors.inc()
+            LOG.exception(e)
+        entry.timer.observe(time.perf_counter() - start)
+
+    def _handle_packet_in(self, data, pkt_type=socket.PACKET_HOST):
+        entries = self._get_interested_handlers(data, pkt_type)
+        if not entries:
+            # Nobody cares about this frame - do not bother parsing it
+            self.metrics.filtered.inc()
+            return
+        self.metrics.dispatched.inc()
+
+        packet = None
+        for entry in entries:
+            if entry.raw:
+                self._call_handler(entry, data)
+                continue
+            if packet is None:
+                try:
+                    # The frame may be a view into a receive buffer that is
+                    # reused once we return, so the packet must own its data
+                    packet = _parse_packet(bytes(data))
+                except Exception as e:
+                    self.metrics.parse_errors.inc()
+                    LOG.error('Failed parsing packet.')
+                    LOG.exception(e)
+                    return
+                self.metrics.parsed.inc()
+            if packet.get_protocol(entry.protocol):
+                self._call_handler(entry, packet)
+
+    def _handle_frame(self, data, pkt_type):
+        self.metrics.received.inc()
+        if pkt_type == socket.PACKET_OUTGOING:
+            # packet originated from the local host - Discard
+            self.metrics.outgoing.inc()
+        else:
+            # The handlers choose which packet types they are interested in
+            self._handle_packet_in(data, pkt_type)
+
+
+class PacketReader(PacketDispatcher):
+    """Read the frames of an interface and pass them to the handlers
+
+    The frames are read through the transport, by default AF_PACKET
+    sockets on iface_name. The handlers registered with the reader send
+    through the same transport.
+    """
+    def __init__(self, iface_name=None, read_timeout=5,
+                 recv_mode=RECV_MODE_SOCKET,
+                 fanout_group=None,
+                 fanout_mode=FANOUT_HASH,
+                 transport=None,
+                 registry=None):
+        if transport is None:
+            transport = zaphod_transport.RawSocketTransport(iface_name)
+        super(PacketReader, self).__init__(transport.iface_name, registry)
+        self.transport = transport
+        self.iface_name = transport.iface_name
+        self._read_timeout = read_timeout
+        self._lsocket = transport.create_listener(read_timeout)
+        self._update_filter()
+        self._receiver = None
+        if self._lsocket and transport.raw:
+            self._receiver = self._create_receiver(recv_mode)
+            if fanout_group is not None:
+                self._join_fanout(fanout_group, fanout_mode)
+            self._socket_frames = self.registry.counter(
+                'zaphod_socket_frames_total',
+                'Frames that reached the listen socket', reader=self.name)
+            self._socket_drops = self.registry.counter(
+                'zaphod_socket_drops_total',
+                'Frames dropped by the kernel as the reader fell behind',
+                reader=self.name)
+            self.registry.register_collector(self.collect_socket_stats)
         self._event = threading.Event()
         self._orig_signal_handler = None
         self._reader_thread = None
@@ -40,54 +303,104 @@ class PacketReader(object):
     def is_ready(self):
         return self._lsocket is not None
 
-    def _bind_lsock(self, read_timeout):
-        sock = socket_utils.create_socket('L-socket', self.iface_name)
-        if not sock:
-            return None
+    def _join_fanout(self, fanout_group, fanout_mode):
+        # Frames are split between the sockets of the fanout group, so a
+        # socket that failed joining it would see duplicates - drop it
         try:
-            sock.bind((self.iface_name, ETH_P_ALL))
+            self._lsocket.setsockopt(packet_ring.SOL_PACKET, PACKET_FANOUT,
+                                     (fanout_group & 0xffff) |
+                                     (fanout_mode << 16))
         except socket.error as msg:
-            LOG.error('L-Socket binding failed')
+            LOG.error('L-Socket failed joining fanout group %d', fanout_group)
             LOG.exception(msg)
-            return None
-        sock.settimeout(read_timeout)
-        return sock
+            self.close()
 
-    def register_protocol_packet_handler(self, protocol, handler):
-        self._protocols[protocol].append(handler)
+    def _create_receiver(self, recv_mode):
+        if recv_mode == RECV_MODE_RING:
+            receiver = packet_ring.PacketRing.create(self._lsocket)
+            if receiver:
+                return receiver
+            # Batching still saves most of the allocations
+            recv_mode = RECV_MODE_BATCH
+        if recv_mode == RECV_MODE_BATCH:
+            return packet_batch.BatchReceiver(self._lsocket)
+        return None
 
-    def unregister_protocol_packet_handler(self, protocol, handler):
-        self._protocols[protocol].remove(handler)
+    def _update_filter(self):
+        # The kernel filter only saves the work of reading frames nobody is
+        # interested in. The frames are still classified in user space, so
+        # a missing filter does not affect correctness.
+        if not self._lsocket or not self.transport.raw:
+            return
+        program = bpf.compile_matches(entry.match for entry in self._handlers)
+        try:
+            bpf.attach_filter(self._lsocket, program)
+        except socket.error as msg:
+            LOG.warning('Failed attaching kernel filter to L-Socket')
+            LOG.exception(msg)
 
-    def _handle_packet_in(self, data):
+    def set_promiscuous(self, enabled):
+        """Receive the frames addressed to other hosts as well"""
+        if not self.transport.raw:
+            # Other transports pass every frame on anyway
+            return True
+        option = PACKET_ADD_MEMBERSHIP if enabled else PACKET_DROP_MEMBERSHIP
+        mreq = _packet_mreq.pack(socket.if_nametoindex(self.iface_name),
+                                 PACKET_MR_PROMISC, 0, b'')
         try:
-            packet = ryu_packet.Packet(data)
-        except Exception as e:
-            LOG.error('Failed parsing packet.')
-            LOG.exception(e)
+            self._lsocket.setsockopt(packet_ring.SOL_PACKET, option, mreq)
+        except socket.error as msg:
+            LOG.error('Failed setting promiscuous mode on %s',
+                      self.iface_name)
+            LOG.exception(msg)
+            return False
+        return True
+
+    def collect_socket_stats(self):
+        """Add the kernel statistics of the listen socket to the metrics
+
+        The kernel resets the statistics whenever they are read.
+        """
+        lsocket = self._lsocket
+        if not lsocket:
             return
+        try:
+            stats = lsocket.getsockopt(packet_ring.SOL_PACKET,
+                                       PACKET_STATISTICS,
+                                       _TPACKET_STATS_V3_LEN)
+        except socket.error as msg:
+            LOG.warning('Failed reading the L-Socket statistics')
+            LOG.exception(msg)
+            return
+        frames, drops = _tpacket_stats.unpack_from(stats)
+        self._socket_frames.inc(frames)
+        self._socket_drops.inc(drops)
+
+    def _read_socket(self):
+        try:
+            data, sa_ll = self._lsocket.recvfrom(65535)
+        except socket.timeout:
+            # With the kernel filter, quiet periods are expected
+            return
+        self._handle_frame(data, sa_ll[2])
+
+    def _read_receiver(self):
+        self._receiver.read(self._handle_frame, self._read_timeout)
+
+    def fileno(self):
+        return self._lsocket.fileno()
 
-        for protocol, handlers in self._protocols.items():
-            proto_packet = packet.get_protocol(protocol)
-            if proto_packet:
-                for handler in handlers:
-                    try:
-                        handler(packet)
-                    except Exception as e:
-                        LOG.exception(e)
+    def read_pending(self):
+        """Handle the frames that are ready, once fileno() is readable"""
+        if self._receiver:
+            self._receiver.read(self._handle_frame, 0)
+        else:
+            self._read_socket()
 
     def _read_packets(self, event):
-        while not event.isSet():
-            try:
-                data, sa_ll = self._lsocket.recvfrom(65535)
-            except socket.timeout:
-                return
-            if sa_ll[2] == socket.PACKET_OUTGOING:
-                # packet originated from the local host - Discard
-                pass
-            elif sa_ll[2] == socket.PACKET_HOST:
-                # packet addressed to the local host - Got something
-                self._handle_packet_in(data)
+        read = self._read_receiver if self._receiver else self._read_socket
+        while not event.is_set():
+            read()
 
     def start_reader(self):
         if not self.is_ready:
@@ -105,4 +418,10 @@ class PacketReader(object):
             self._reader_thread = None
 
     def close(self):
-        self._lsocket.close()
+        self.registry.unregister_collector(self.collect_socket_stats)
+        if self._receiver:
+            self._receiver.close()
+            self._receiver = None
+        if self._lsocket:
+            self._lsocket.close()
+            self._lsocket = None
@@ -0,0 +1,143 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import select
+import socket
+import struct
+
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+SOL_PACKET = getattr(socket, 'SOL_PACKET', 263)
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+DEFAULT_BLOCK_SIZE = 1 << 18
+DEFAULT_BLOCK_COUNT = 64
+DEFAULT_FRAME_SIZE = 1 << 11
+DEFAULT_BLOCK_TIMEOUT_MS = 50
+
+# struct tpacket_req3
+_tpacket_req3 = struct.Struct('7I')
+# struct tpacket_block_desc: block_status, num_pkts, offset_to_first_pkt
+_BLOCK_STATUS_OFFSET = 8
+_block_status = struct.Struct('I')
+_block_packets = struct.Struct('II')
+_BLOCK_PACKETS_OFFSET = 12
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len,
+# tp_status, tp_mac
+_tpacket3_hdr = struct.Struct('IIIIIIH')
+# The sockaddr_ll follows the TPACKET_ALIGN()ed tpacket3_hdr, and
+# sll_pkttype is at offset 10 within it
+_SLL_PKTTYPE_OFFSET = 48 + 10
+
+
+class PacketRing(object):
+    """A TPACKET_V3 receive ring mapped into the process memory
+
+    The kernel fills whole blocks of frames, which are then walked without
+    a system call per frame. The frames are handed out as memoryviews into
+    the ring, which are only valid while the frame handler is running.
+    """
+    def __init__(self, sock,
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 block_count=DEFAULT_BLOCK_COUNT,
+                 frame_size=DEFAULT_FRAME_SIZE,
+                 block_timeout_ms=DEFAULT_BLOCK_TIMEOUT_MS):
+        self._block_size = block_size
+        self._block_count = block_count
+        self._block_index = 0
+        frame_count = (block_size * block_count) // frame_size
+        sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        sock.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                        _tpacket_req3.pack(block_size, block_count,
+                                           frame_size, frame_count,
+                                           block_timeout_ms, 0, 0))
+        self._map = mmap.mmap(sock.fileno(), block_size * block_count,
+                              mmap.MAP_SHARED,
+                              mmap.PROT_READ | mmap.PROT_WRITE)
+        self._view = memoryview(self._map)
+        self._poll = select.poll()
+        self._poll.register(sock.fileno(), select.POLLIN | select.POLLERR)
+
+    @classmethod
+    def create(cls, sock, **kwargs):
+        try:
+            return cls(sock, **kwargs)
+        except (socket.error, ValueError) as msg:
+            LOG.warning('Failed setting up packet ring, using recvfrom')
+            LOG.exception(msg)
+            return None
+
+    def _get_block_offset(self):
+        return self._block_index * self._block_size
+
+    def _is_block_ready(self, block_offset):
+        status, = _block_status.unpack_from(
+            self._map, block_offset + _BLOCK_STATUS_OFFSET)
+        return status & TP_STATUS_USER
+
+    def _walk_block(self, block_offset, frame_handler):
+        ring = self._map
+        num_packets, offset = _block_packets.unpack_from(
+            ring, block_offset + _BLOCK_PACKETS_OFFSET)
+        offset += block_offset
+        for _ in range(num_packets):
+            (next_offset, _sec, _nsec, snaplen, _len, _status,
+             mac_offset) = _tpacket3_hdr.unpack_from(ring, offset)
+            pkt_type = ring[offset + _SLL_PKTTYPE_OFFSET]
+            start = offset + mac_offset
+            frame = self._view[start:start + snaplen]
+            try:
+                frame_handler(frame, pkt_type)
+            finally:
+                # The block is about to be handed back to the kernel
+                frame.release()
+            offset += next_offset
+        return num_packets
+
+    def read(self, frame_handler, timeout):
+        """Pass the frames of all the ready blocks to the frame handler
+
+        Waits up to timeout seconds for a block to be ready, and returns the
+        number of frames handled.
+        """
+        block_offset = self._get_block_offset()
+        if not self._is_block_ready(block_offset):
+            self._poll.poll(timeout * 1000)
+        count = 0
+        while self._is_block_ready(block_offset):
+            try:
+                count += self._walk_block(block_offset, frame_handler)
+            finally:
+                _block_status.pack_into(
+                    self._map, block_offset + _BLOCK_STATUS_OFFSET,
+                    TP_STATUS_KERNEL)
+                self._block_index = (
+                    (self._block_index + 1) % self._block_count)
+            block_offset = self._get_block_offset()
+        return count
+
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            LOG.warning('Packet ring frames are still referenced')
@@ -0,0 +1,128 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+
+ETH_TYPE_IP = 0x0800
+ETH_MIN_FRAME_LEN = 60
+IPPROTO_UDP = 17
+
+_ethernet_header = struct.Struct('!6s6sH')
+_ipv4_header = struct.Struct('!BBHHHBBH4s4s')
+_udp_header = struct.Struct('!HHHH')
+_udp_pseudo_header = struct.Struct('!4s4sBBH')
+
+UDP_CHECKSUM_OFFSET = _ethernet_header.size + _ipv4_header.size + 6
+UDP_PAYLOAD_OFFSET = (_ethernet_header.size + _ipv4_header.size +
+                      _udp_header.size)
+
+_checksum_field = struct.Struct('!H')
+
+
+def mac_to_bytes(mac):
+    return bytes(bytearray(int(part, 16) for part in mac.split(':')))
+
+
+def ip_to_bytes(ip_address):
+    return socket.inet_aton('%s' % (ip_address,))
+
+
+def _fold(value):
+    while value >> 16:
+        value = (value & 0xffff) + (value >> 16)
+    return value
+
+
+def _sum_words(data):
+    if len(data) % 2:
+        data = bytes(data) + b'\0'
+    return sum(struct.unpack('!%dH' % (len(data) // 2,), data))
+
+
+def checksum(data, initial=0):
+    """The internet checksum (RFC 1071) of data"""
+    return ~_fold(_sum_words(data) + initial) & 0xffff
+
+
+def update_checksum(csum, old, new):
+    """Incrementally update a checksum for a changed field (RFC 1624)
+
+    old and new must have the same even length, and start at an even offset
+    within the checksummed data.
+    """
+    total = (~csum & 0xffff) + _sum_words(new)
+    total += sum(~word & 0xffff for word, in struct.iter_unpack('!H', old))
+    return ~_fold(total) & 0xffff
+
+
+class PacketTemplate(object):
+    """A pre-built packet in which only the changing fields are patched
+
+    The template remembers the key it was built for (e.g. the interface
+    addresses), so the owner can tell when it has to be rebuilt.
+    """
+    def __init__(self, data, key=None):
+        self._buf = bytearray(data)
+        self.key = key
+
+    def __len__(self):
+        return len(self._buf)
+
+    def patch(self, offset, value):
+        self._buf[offset:offset + len(value)] = value
+
+    def patch_checksummed(self, offset, value, checksum_offset,
+                          zero_is_none=False):
+        """Patch a field, and update the checksum covering it
+
+        If zero_is_none is set (as in UDP), a checksum of zero is transmitted
+        as all ones, as zero means no checksum was calculated.
+        """
+        old = bytes(self._buf[offset:offset + len(value)])
+        csum, = _checksum_field.unpack_from(self._buf, checksum_offset)
+        csum = update_checksum(csum, old, value)
+        if zero_is_none and not csum:
+            csum = 0xffff
+        _checksum_field.pack_into(self._buf, checksum_offset, csum)
+        self.patch(offset, value)
+
+    def to_bytes(self):
+        return bytes(self._buf)
+
+
+def build_ethernet_frame(dst_mac, src_mac, ethertype, payload):
+    frame = _ethernet_header.pack(mac_to_bytes(dst_mac),
+                                  mac_to_bytes(src_mac),
+                                  ethertype) + payload
+    return frame.ljust(ETH_MIN_FRAME_LEN, b'\0')
+
+
+def build_udp_frame(dst_mac, src_mac, dst_ip, src_ip, dst_port, src_port,
+                    payload, tos=0, ttl=64):
+    """Build an ethernet frame of an IPv4 UDP datagram, with checksums"""
+    dst_ip = ip_to_bytes(dst_ip)
+    src_ip = ip_to_bytes(src_ip)
+    udp_len = _udp_header.size + len(payload)
+    udp_csum = checksum(
+        _udp_header.pack(src_port, dst_port, udp_len, 0) + payload,
+        _sum_words(_udp_pseudo_header.pack(src_ip, dst_ip, 0, IPPROTO_UDP,
+                                           udp_len)))
+    udp = _udp_header.pack(src_port, dst_port, udp_len, udp_csum or 0xffff)
+    ip_fields = [0x45, tos, _ipv4_header.size + udp_len, 0, 0, ttl,
+                 IPPROTO_UDP, 0, src_ip, dst_ip]
+    ip_fields[7] = checksum(_ipv4_header.pack(*ip_fields))
+    return build_ethernet_frame(dst_mac, src_mac, ETH_TYPE_IP,
+                                _ipv4_header.pack(*ip_fields) + udp + payload)
@@ -0,0 +1,336 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import socket
+import struct
+import threading
+import time
+
+from zaphod.common import packet_filter
+from zaphod.common import packet_reader
+from zaphod.common import transport as zaphod_transport
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+LINKTYPE_ETHERNET = 1
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SHB_TYPE = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IDB_TYPE = 1
+PCAPNG_SPB_TYPE = 3
+PCAPNG_EPB_TYPE = 6
+
+_PCAP_HEADER_LEN = 24
+_PCAP_RECORD_LEN = 16
+_PCAPNG_BLOCK_HEADER_LEN = 8
+_PCAP_SNAPLEN = 65535
+
+_pcap_header = struct.Struct('=IHHiIII')
+_pcap_record = struct.Struct('=IIII')
+
+
+class PcapFormatError(Exception):
+    pass
+
+
+def get_pkt_type(data):
+    """Guess the packet type of a captured frame from its destination MAC
+
+    Captures do not record it, so unicast frames are taken to be addressed
+    to the local host.
+    """
+    if data[0] & 1:
+        if data[:6] == b'\xff\xff\xff\xff\xff\xff':
+            return socket.PACKET_BROADCAST
+        return socket.PACKET_MULTICAST
+    return socket.PACKET_HOST
+
+
+def _check_pcap_linktype(buf, byte_order):
+    linktype, = struct.unpack_from(byte_order + 'I', buf, 20)
+    if linktype != LINKTYPE_ETHERNET:
+        raise PcapFormatError('Unsupported link type %d' % (linktype,))
+
+
+def _iter_pcap(buf, byte_order):
+    record = struct.Struct(byte_order + '8xII')
+    offset = _PCAP_HEADER_LEN
+    buf_len = len(buf)
+    while offset + _PCAP_RECORD_LEN <= buf_len:
+        incl_len, _orig_len = record.unpack_from(buf, offset)
+        offset += _PCAP_RECORD_LEN
+        if offset + incl_len > buf_len:
+            LOG.warning('Capture is truncated')
+            return
+        yield offset, incl_len
+        offset += incl_len
+
+
+def _iter_pcapng(buf):
+    buf_len = len(buf)
+    offset = 0
+    byte_order = '<'
+    linktypes = []
+    while offset + _PCAPNG_BLOCK_HEADER_LEN <= buf_len:
+        block_type, = struct.unpack_from(byte_order + 'I', buf, offset)
+        if block_type == PCAPNG_SHB_TYPE:
+            # Each section sets its own byte order and interfaces
+            magic, = struct.unpack_from('<I', buf, offset + 8)
+            byte_order = '<' if magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            linktypes = []
+        block_len, = struct.unpack_from(byte_order + 'I', buf, offset + 4)
+        if block_len < 12 or offset + block_len > buf_len:
+            LOG.warning('Capture is truncated')
+            return
+        body = offset + _PCAPNG_BLOCK_HEADER_LEN
+        if block_type == PCAPNG_IDB_TYPE:
+            linktypes.append(struct.unpack_from(byte_order + 'H2xI', buf,
+                                                body))
+        elif block_type == PCAPNG_EPB_TYPE:
+            interface_id, cap_len = struct.unpack_from(byte_order + 'I8xI',
+                                                       buf, body)
+            if (interface_id < len(linktypes) and
+                    linktypes[interface_id][0] == LINKTYPE_ETHERNET):
+                yield body + 20, cap_len
+        elif block_type == PCAPNG_SPB_TYPE and linktypes:
+            # Simple packets are captured on the first interface
+            orig_len, = struct.unpack_from(byte_order + 'I', buf, body)
+            linktype, snaplen = linktypes[0]
+            if linktype == LINKTYPE_ETHERNET:
+                yield body + 4, min(orig_len, snaplen or orig_len,
+                                    block_len - 16)
+        offset += block_len
+
+
+def iter_frames(buf):
+    """Yield the (offset, length) of the ethernet frames in a capture
+
+    buf holds a whole pcap or pcapng capture. The frames of other link
+    types are skipped.
+    """
+    if len(buf) < _PCAP_HEADER_LEN:
+        raise PcapFormatError('Capture is too short')
+    for byte_order in '<>':
+        magic, = struct.unpack_from(byte_order + 'I', buf)
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            _check_pcap_linktype(buf, byte_order)
+            return _iter_pcap(buf, byte_order)
+    if magic == PCAPNG_SHB_TYPE:
+        return _iter_pcapng(buf)
+    raise PcapFormatError('Not a pcap or pcapng capture')
+
+
+class PcapWriter(object):
+    """Write ethernet frames to a pcap capture"""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(_pcap_header.pack(PCAP_MAGIC_USEC, 2, 4, 0, 0,
+                                           _PCAP_SNAPLEN, LINKTYPE_ETHERNET))
+        self._lock = threading.Lock()
+
+    def write(self, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        seconds = int(timestamp)
+        with self._lock:
+            self._file.write(_pcap_record.pack(
+                seconds, int((timestamp - seconds) * 1000000), len(frame),
+                len(frame)))
+            self._file.write(frame)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def write_pcap(path, frames):
+    """Write the frames to a pcap capture, one microsecond apart"""
+    writer = PcapWriter(path)
+    try:
+        for index, frame in enumerate(frames):
+            writer.write(frame, index / 1000000.0)
+    finally:
+        writer.close()
+
+
+class ReplayStats(object):
+    def __init__(self, frames, total_bytes, elapsed):
+        self.frames = frames
+        self.total_bytes = total_bytes
+        self.elapsed = elapsed
+
+    @property
+    def frames_per_second(self):
+        return self.frames / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {
+            'frames': self.frames,
+            'bytes': self.total_bytes,
+            'elapsed': self.elapsed,
+            'frames_per_second': self.frames_per_second,
+        }
+
+    def __repr__(self):
+        return 'ReplayStats(%d frames in %.3fs: %.0f frames/s)' % (
+            self.frames, self.elapsed, self.frames_per_second,)
+
+
+class PcapReader(packet_reader.PacketDispatcher):
+    """Replay a pcap or pcapng capture to the registered protocol handlers
+
+    The handlers register exactly as they do with a PacketReader. The file
+    is memory mapped, and the frames are handed out as views into it as
+    fast as the handlers take them. Passive handlers need no transport to
+    send on; if iface_name is given the handlers send through its raw
+    sockets, and a transport (e.g. a MemoryTransport) may be given instead.
+    """
+    def __init__(self, path, iface_name=None, transport=None, registry=None):
+        super(PcapReader, self).__init__(path, registry)
+        self.path = path
+        if transport is None and iface_name:
+            transport = zaphod_transport.RawSocketTransport(iface_name)
+        self.transport = transport
+        self.iface_name = transport.iface_name if transport else None
+        self._file = None
+        self._buf = None
+        self._event = threading.Event()
+        self._reader_thread = None
+        self.stats = None
+        self._open()
+
+    @property
+    def is_ready(self):
+        return self._buf is not None
+
+    def _open(self):
+        try:
+            self._file = open(self.path, 'rb')
+            self._buf = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            iter_frames(self._buf)
+        except (OSError, ValueError, PcapFormatError) as e:
+            LOG.error('Failed opening capture %s', self.path)
+            LOG.exception(e)
+            self.close()
+
+    def replay(self, event=None):
+        """Pass every frame in the capture to the handlers
+
+        Stops early if event is set. Returns the ReplayStats of the replay.
+        """
+        frames = 0
+        total_bytes = 0
+        start = time.monotonic()
+        with memoryview(self._buf) as buf:
+            for offset, length in iter_frames(buf):
+                if event is not None and event.is_set():
+                    break
+                data = buf[offset:offset + length]
+                try:
+                    if length >= packet_filter.ETH_HLEN:
+                        self._handle_frame(data, get_pkt_type(data))
+                finally:
+                    data.release()
+                frames += 1
+                total_bytes += length
+        self.stats = ReplayStats(frames, total_bytes,
+                                 time.monotonic() - start)
+        LOG.info('Replayed %s: %s', self.path, self.stats)
+        return self.stats
+
+    def start_reader(self):
+        if not self.is_ready:
+            return
+        self._reader_thread = threading.Thread(target=self.replay,
+                                               args=(self._event,))
+        self._reader_thread.start()
+
+    def wait(self, timeout=None):
+        """Wait until the replay started by start_reader is done"""
+        if self._reader_thread:
+            self._reader_thread.join(timeout)
+
+    def stop_reader(self):
+        if self._reader_thread and self._reader_thread.is_alive():
+            self._event.set()
+            self._reader_thread.join()
+            self._event.clear()
+        self._reader_thread = None
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PcapTransport(zaphod_transport.MemoryTransport):
+    """Feed the frames of a pcap or pcapng capture to the reader
+
+    The capture is injected from a background thread once the listener is
+    created, at the pace the reader takes the frames, and replay_done is
+    set after the last one. The frames the handlers send are written to
+    output_path if given, and dropped otherwise.
+    """
+    def __init__(self, path, output_path=None, iface_name='pcap0',
+                 iface_mac=None, iface_ip=None):
+        super(PcapTransport, self).__init__(iface_name, iface_mac, iface_ip)
+        self.path = path
+        self.replay_done = threading.Event()
+        self._feeder = None
+        self._writer = None
+        if output_path:
+            self._writer = PcapWriter(output_path)
+            self.peer = self._writer.write
+        else:
+            self.peer = self._drop
+
+    @staticmethod
+    def _drop(frame):
+        pass
+
+    def create_listener(self, read_timeout):
+        listener = super(PcapTransport, self).create_listener(read_timeout)
+        if self._feeder is None:
+            self._feeder = threading.Thread(target=self._feed)
+            self._feeder.daemon = True
+            self._feeder.start()
+        return listener
+
+    def _feed(self):
+        try:
+            with open(self.path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for offset, length in iter_frames(buf):
+                    self.inject(buf[offset:offset + min(length,
+                                                        _PCAP_SNAPLEN)])
+        except (OSError, ValueError, PcapFormatError) as e:
+            LOG.error('Failed replaying capture %s', self.path)
+            LOG.exception(e)
+        finally:
+            self.replay_done.set()
+
+    def close(self):
+        super(PcapTransport, self).close()
+        if self._writer:
+            self._writer.close()
+            self._writer = None
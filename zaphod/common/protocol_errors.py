@@ -14,20 +14,103 @@
 # limitations under the License.
 
 import abc
+import enum
+import json
 import six
 
 
+class ErrorCode(enum.IntEnum):
+    """Stable codes of the errors, for consumers of the serialized errors"""
+    INVALID_MAC = 1
+    INVALID_SERVER_MAC = 2
+    INVALID_IP_ADDRESS = 3
+    INVALID_SERVER_IP_ADDRESS = 4
+    INVALID_GATEWAY_IP_ADDRESS = 5
+    INVALID_DNS_SERVER = 6
+    INVALID_ROUTE = 7
+    INVALID_NETWORK = 8
+    INVALID_ARP = 9
+    ROGUE_SERVER = 10
+    CHANGED_SERVER = 11
+    MAC_FLIP = 12
+    IP_CONFLICT = 13
+    GRATUITOUS_ARP_FLOOD = 14
+
+
+# Error classes to the names of their public fields, in slot order
+_fields_cache = {}
+# Error classes to the names of the fields that identify their errors
+_key_fields_cache = {}
+
+
 @six.add_metaclass(abc.ABCMeta)
 class BaseError(object):
+    """An error found by a protocol handler
+
+    Errors are slotted, and keep the handler (usually its class) instead of
+    asking it for its protocol name, so creating them is cheap even when a
+    handler finds many of them per second.
+    """
+    __slots__ = ('_module',)
+    code = None
+    # Fields that change between reports of the same error
+    volatile_fields = ()
+
     def __init__(self, module):
         self._module = module
-        self._protocol_name = self._module.get_protocol_name()
+
+    @property
+    def protocol_name(self):
+        return self._module.get_protocol_name()
+
+    _protocol_name = protocol_name
+
+    @classmethod
+    def get_fields(cls):
+        fields = _fields_cache.get(cls)
+        if fields is None:
+            fields = tuple(field for klass in reversed(cls.__mro__)
+                           for field in klass.__dict__.get('__slots__', ())
+                           if not field.startswith('_'))
+            _fields_cache[cls] = fields
+        return fields
+
+    @classmethod
+    def get_key_fields(cls):
+        fields = _key_fields_cache.get(cls)
+        if fields is None:
+            fields = tuple(field for field in cls.get_fields()
+                           if field not in cls.volatile_fields)
+            _key_fields_cache[cls] = fields
+        return fields
+
+    def get_key(self):
+        """Identify the error, so repeated reports of it can be merged"""
+        return (self.__class__, self.protocol_name) + tuple(
+            getattr(self, field) for field in self.get_key_fields())
+
+    def to_dict(self):
+        result = {'code': self.code.name, 'protocol': self.protocol_name}
+        for field in self.get_fields():
+            result[field] = getattr(self, field)
+        return result
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), default=str)
 
     def __repr__(self):
         return str(self)
 
 
+def to_json_lines(errors):
+    """Serialize errors as JSON lines, one error per line"""
+    return ''.join(error.to_json() + '\n' for error in errors)
+
+
 class InvalidMAC(BaseError):
+    __slots__ = ('mac',)
+    code = ErrorCode.INVALID_MAC
+
     def __init__(self, module, mac):
         super(InvalidMAC, self).__init__(module)
         self.mac = mac
@@ -37,6 +120,9 @@ class InvalidMAC(BaseError):
 
 
 class InvalidServerMAC(InvalidMAC):
+    __slots__ = ()
+    code = ErrorCode.INVALID_SERVER_MAC
+
     def __init__(self, module, mac):
         super(InvalidServerMAC, self).__init__(module, mac)
 
@@ -46,6 +132,9 @@ class InvalidServerMAC(InvalidMAC):
 
 
 class InvalidIPAddress(BaseError):
+    __slots__ = ('ip_address',)
+    code = ErrorCode.INVALID_IP_ADDRESS
+
     def __init__(self, module, ip_address):
         super(InvalidIPAddress, self).__init__(module)
         self.ip_address = ip_address
@@ -56,6 +145,9 @@ class InvalidIPAddress(BaseError):
 
 
 class InvalidServerIPAddress(InvalidIPAddress):
+    __slots__ = ()
+    code = ErrorCode.INVALID_SERVER_IP_ADDRESS
+
     def __init__(self, module, ip_address):
         super(InvalidServerIPAddress, self).__init__(module, ip_address)
 
@@ -65,6 +157,9 @@ class InvalidServerIPAddress(InvalidIPAddress):
 
 
 class InvalidGatewayIPAddress(InvalidIPAddress):
+    __slots__ = ()
+    code = ErrorCode.INVALID_GATEWAY_IP_ADDRESS
+
     def __init__(self, module, ip_address):
         super(InvalidGatewayIPAddress, self).__init__(module, ip_address)
 
@@ -74,6 +169,9 @@ class InvalidGatewayIPAddress(InvalidIPAddress):
 
 
 class InvalidDnsServer(InvalidIPAddress):
+    __slots__ = ()
+    code = ErrorCode.INVALID_DNS_SERVER
+
     def __init__(self, module, ip_address):
         super(InvalidDnsServer, self).__init__(module, ip_address)
 
@@ -83,6 +181,9 @@ class InvalidDnsServer(InvalidIPAddress):
 
 
 class InvalidRoute(InvalidGatewayIPAddress):
+    __slots__ = ('dest_ip',)
+    code = ErrorCode.INVALID_ROUTE
+
     def __init__(self, module, dest_ip, gateway_ip):
         super(InvalidRoute, self).__init__(module, gateway_ip)
         self.dest_ip = dest_ip
@@ -94,6 +195,9 @@ class InvalidRoute(InvalidGatewayIPAddress):
 
 
 class InvalidNetwork(BaseError):
+    __slots__ = ('ip_network',)
+    code = ErrorCode.INVALID_NETWORK
+
     def __init__(self, module, ip_network):
         super(InvalidNetwork, self).__init__(module)
         self.ip_network = ip_network
@@ -104,6 +208,9 @@ class InvalidNetwork(BaseError):
 
 
 class InvalidARP(BaseError):
+    __slots__ = ('mac', 'ip')
+    code = ErrorCode.INVALID_ARP
+
     def __init__(self, module, mac, ip):
         super(InvalidARP, self).__init__(module)
         self.mac = mac
@@ -112,3 +219,70 @@ class InvalidARP(BaseError):
     def __str__(self):
         return '%s: Invalid ARP response: %s -> %s' % (self._protocol_name,
                                                        self.mac, self.ip,)
+
+
+class RogueServer(InvalidServerMAC):
+    __slots__ = ('server_ip',)
+    code = ErrorCode.ROGUE_SERVER
+
+    def __init__(self, module, mac, server_ip):
+        super(RogueServer, self).__init__(module, mac)
+        self.server_ip = server_ip
+
+    def __str__(self):
+        return '%s: Rogue server: %s (server identifier %s)' % (
+            self._protocol_name, self.mac, self.server_ip,)
+
+
+class ChangedServer(InvalidServerMAC):
+    __slots__ = ('changed_field',)
+    code = ErrorCode.CHANGED_SERVER
+
+    def __init__(self, module, mac, changed_field):
+        super(ChangedServer, self).__init__(module, mac)
+        self.changed_field = changed_field
+
+    def __str__(self):
+        return '%s: Server %s changed its %s' % (self._protocol_name,
+                                                 self.mac, self.changed_field,)
+
+
+class MACFlip(InvalidARP):
+    __slots__ = ('old_mac',)
+    code = ErrorCode.MAC_FLIP
+
+    def __init__(self, module, mac, ip, old_mac):
+        super(MACFlip, self).__init__(module, mac, ip)
+        self.old_mac = old_mac
+
+    def __str__(self):
+        return '%s: MAC of %s changed from %s to %s' % (
+            self._protocol_name, self.ip, self.old_mac, self.mac,)
+
+
+class IPConflict(InvalidARP):
+    __slots__ = ('other_mac',)
+    code = ErrorCode.IP_CONFLICT
+
+    def __init__(self, module, mac, ip, other_mac):
+        super(IPConflict, self).__init__(module, mac, ip)
+        self.other_mac = other_mac
+
+    def __str__(self):
+        return '%s: IP conflict on %s between %s and %s' % (
+            self._protocol_name, self.ip, self.other_mac, self.mac,)
+
+
+class GratuitousARPFlood(InvalidMAC):
+    __slots__ = ('count', 'period')
+    code = ErrorCode.GRATUITOUS_ARP_FLOOD
+    volatile_fields = ('count', 'period')
+
+    def __init__(self, module, mac, count, period):
+        super(GratuitousARPFlood, self).__init__(module, mac)
+        self.count = count
+        self.period = period
+
+    def __str__(self):
+        return '%s: Gratuitous ARP flood from %s: %d in %.1fs' % (
+            self._protocol_name, self.mac, self.count, self.period,)
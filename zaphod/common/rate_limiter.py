@@ -0,0 +1,53 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """A token bucket filled at rate tokens per second, up to burst tokens"""
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+        self.rate = float(rate)
+        # By default, allow catching up on 10ms worth of tokens
+        self.burst = float(burst or max(1.0, self.rate / 100))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_consume(self, tokens=1):
+        with self._lock:
+            self._refill()
+            if self._tokens < tokens:
+                return False
+            self._tokens -= tokens
+            return True
+
+    def consume(self, tokens=1):
+        """Take tokens from the bucket, sleeping until they are available"""
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            deficit = -self._tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
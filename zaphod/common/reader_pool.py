@@ -0,0 +1,139 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import select
+import threading
+
+from zaphod.common import packet_reader
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+
+class ReaderPool(object):
+    """Packet readers for many interfaces, drained by a few worker threads
+
+    The readers are sharded between the workers, and each worker waits on
+    the sockets of all its readers at once. Handlers may register against
+    a single interface, a set of interfaces or all of them. Readers are
+    opened on the given transports as well (e.g. MemoryTransports), by the
+    interface names of the transports.
+    """
+    def __init__(self, iface_names, workers=1, read_timeout=1,
+                 recv_mode=packet_reader.RECV_MODE_BATCH, transports=()):
+        self._read_timeout = read_timeout
+        self._readers = {}
+        readers = [packet_reader.PacketReader(iface_name, read_timeout,
+                                              recv_mode)
+                   for iface_name in iface_names]
+        readers.extend(packet_reader.PacketReader(read_timeout=read_timeout,
+                                                  recv_mode=recv_mode,
+                                                  transport=transport)
+                       for transport in transports)
+        for reader in readers:
+            if not reader.is_ready:
+                LOG.error('Reader for %s is not ready - skipping',
+                          reader.iface_name)
+                continue
+            self._readers[reader.iface_name] = reader
+        self._workers = max(1, workers)
+        self._event = threading.Event()
+        self._threads = []
+
+    @property
+    def is_ready(self):
+        return bool(self._readers)
+
+    @property
+    def iface_names(self):
+        return list(self._readers)
+
+    def get_reader(self, iface_name):
+        return self._readers.get(iface_name)
+
+    def _get_readers(self, iface_names):
+        if iface_names is None:
+            return list(self._readers.values())
+        if isinstance(iface_names, str):
+            iface_names = (iface_names,)
+        return [self._readers[iface_name] for iface_name in iface_names
+                if iface_name in self._readers]
+
+    def register_protocol_packet_handler(self, protocol, handler, match=None,
+                                         raw=False, pkt_types=None,
+                                         iface_names=None):
+        for reader in self._get_readers(iface_names):
+            reader.register_protocol_packet_handler(protocol, handler, match,
+                                                    raw, pkt_types)
+
+    def unregister_protocol_packet_handler(self, protocol, handler,
+                                           iface_names=None):
+        for reader in self._get_readers(iface_names):
+            reader.unregister_protocol_packet_handler(protocol, handler)
+
+    def create_handlers(self, handler_class, *args, **kwargs):
+        """Create a protocol handler of the given class for each interface
+
+        The handler_class is called with the reader of each of the
+        interfaces as its first argument, followed by args and kwargs.
+        Returns a dict of the handlers by interface name.
+        """
+        iface_names = kwargs.pop('iface_names', None)
+        return {reader.iface_name: handler_class(reader, *args, **kwargs)
+                for reader in self._get_readers(iface_names)}
+
+    def _read_shard(self, readers, event):
+        poller = select.poll()
+        readers_by_fd = {}
+        for reader in readers:
+            readers_by_fd[reader.fileno()] = reader
+            poller.register(reader.fileno(), select.POLLIN)
+        while not event.is_set():
+            for fd, _event in poller.poll(self._read_timeout * 1000):
+                try:
+                    readers_by_fd[fd].read_pending()
+                except Exception as e:
+                    LOG.error('Failed reading from %s',
+                              readers_by_fd[fd].iface_name)
+                    LOG.exception(e)
+
+    def start(self):
+        if self._threads or not self._readers:
+            return
+        readers = list(self._readers.values())
+        workers = min(self._workers, len(readers))
+        for index in range(workers):
+            thread = threading.Thread(target=self._read_shard,
+                                      args=(readers[index::workers],
+                                            self._event))
+            self._threads.append(thread)
+        atexit.register(self.stop)
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        if not self._threads:
+            return
+        self._event.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._event.clear()
+
+    def close(self):
+        self.stop()
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
@@ -0,0 +1,143 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import time
+
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_MAX_DELAY = 1.0
+
+
+class ResultBatcher(object):
+    """Coalesce the results of protocol handlers into batches
+
+    The batcher is registered as a callback of the handlers, and passes the
+    errors to its own callbacks in batches: once max_size errors are
+    pending, or max_delay seconds after the first pending error, whichever
+    comes first. Most handlers emit a result for every packet they parse,
+    mostly empty ones, while the passive monitors only emit the errors they
+    find. The empty results are dropped, unless emit_empty is set - then a
+    window with only empty results is emitted as an empty batch.
+
+    The batches are passed to the callbacks one at a time and in order, by
+    whichever thread is emitting, so callbacks may pass results back to the
+    batcher.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE,
+                 max_delay=DEFAULT_MAX_DELAY, emit_empty=False):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.emit_empty = emit_empty
+        self._callbacks = []
+        self._pending = []
+        self._has_results = False
+        self._deadline = None
+        self._closed = False
+        self._cond = threading.Condition()
+        # The batches taken, waiting to be emitted
+        self._ready = collections.deque()
+        # Held by the thread emitting the ready batches
+        self._emit_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name='result-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def __call__(self, errors):
+        if not errors and not self.emit_empty:
+            return
+        with self._cond:
+            self._pending.extend(errors)
+            self._has_results = True
+            if len(self._pending) < self.max_size:
+                if self._deadline is None:
+                    self._deadline = time.monotonic() + self.max_delay
+                    self._cond.notify()
+                return
+            self._take_batch()
+        self._emit_ready()
+
+    def _take_batch(self):
+        self._ready.append(self._pending)
+        self._pending = []
+        self._has_results = False
+        self._deadline = None
+
+    def _emit_ready(self):
+        while True:
+            if not self._emit_lock.acquire(blocking=False):
+                # The emitting thread emits the batch when it is done
+                return
+            try:
+                while True:
+                    with self._cond:
+                        if not self._ready:
+                            break
+                        batch = self._ready.popleft()
+                    self._emit(batch)
+            finally:
+                self._emit_lock.release()
+            # A batch may have been taken just before the lock was released
+            with self._cond:
+                if not self._ready:
+                    return
+
+    def _emit(self, batch):
+        for callback in self._callbacks:
+            try:
+                callback(batch)
+            except Exception as e:
+                LOG.error('Exception in batch callback')
+                LOG.exception(e)
+
+    def flush(self):
+        """Emit the pending results right away"""
+        with self._cond:
+            if self._has_results:
+                self._take_batch()
+        self._emit_ready()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._deadline is not None:
+                        timeout = self._deadline - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            self.flush()
+
+    def close(self):
+        """Stop the batcher, emitting the pending results"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
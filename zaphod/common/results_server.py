@@ -0,0 +1,97 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+DEFAULT_SOCKET_PATH = '/run/zaphod/zaphod.sock'
+DEFAULT_QUERY_TIMEOUT = 5
+
+COMMAND_RESULTS = 'results'
+
+_MAX_COMMAND_LEN = 256
+
+
+class _ResultsRequestHandler(socketserver.StreamRequestHandler):
+    get_results = None
+
+    def handle(self):
+        command = self.rfile.readline(_MAX_COMMAND_LEN).strip().decode(
+            'ascii', 'replace') or COMMAND_RESULTS
+        if command == COMMAND_RESULTS:
+            reply = self.get_results()
+        else:
+            reply = {'error': 'Unknown command: %s' % (command,)}
+        self.wfile.write(json.dumps(reply, default=str).encode('utf-8'))
+
+
+class _ResultsServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def _remove_stale_socket(path):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def start_results_server(path, get_results, mode=0o660):
+    """Serve the results returned by get_results on a UNIX socket
+
+    Clients send a command line (only 'results' for now, also the default)
+    and get the results as JSON, after which the connection is closed.
+    Returns the server, to be stopped with stop_results_server.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    _remove_stale_socket(path)
+    handler_class = type('ResultsRequestHandler', (_ResultsRequestHandler,),
+                         {'get_results': staticmethod(get_results)})
+    server = _ResultsServer(path, handler_class)
+    os.chmod(path, mode)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='results-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stop_results_server(server):
+    server.shutdown()
+    server.server_close()
+    _remove_stale_socket(server.server_address)
+
+
+def query_results(path, timeout=DEFAULT_QUERY_TIMEOUT):
+    """Get the results from a results server"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(COMMAND_RESULTS.encode('ascii') + b'\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b''.join(chunks))
@@ -13,13 +13,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import errno
+import fcntl
 import socket
+import struct
+import threading
 
 import netifaces
 
 from zaphod.common import logger
 LOG = logger.get_logger(__name__)
 
+SIOCGIFMTU = 0x8921
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+
+_nlmsghdr = struct.Struct('=IHHII')
+_ifaddrmsg = struct.Struct('=BBBBI')
+_ifreq_mtu = struct.Struct('16si20x')
+
+InterfaceInfo = collections.namedtuple(
+    'InterfaceInfo',
+    ('name', 'mac', 'ipv4_addresses', 'ipv6_addresses', 'mtu'))
+
+_iface_cache = {}
+_iface_cache_lock = threading.Lock()
+_iface_cache_generation = 0
+_iface_monitor = None
+
 
 def create_socket(sock_name, iface_name):
     try:
@@ -29,7 +58,7 @@ def create_socket(sock_name, iface_name):
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, iface_bytes)
     except socket.error as msg:
-        LOG.error('%s error initializing socket %s for iface: %s',
+        LOG.error('%s error initializing socket for iface: %s',
                   sock_name, iface_name)
         LOG.exception(msg)
         return None
@@ -37,13 +66,140 @@ def create_socket(sock_name, iface_name):
     return sock
 
 
-def get_iface_hw_mac(iface_name):
+def _get_iface_mtu(iface_name):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            ifreq = fcntl.ioctl(sock, SIOCGIFMTU,
+                                _ifreq_mtu.pack(iface_name.encode('utf-8'), 0))
+    except (socket.error, IOError):
+        return None
+    return _ifreq_mtu.unpack(ifreq)[1]
+
+
+def _resolve_iface_info(iface_name):
     if iface_name not in netifaces.interfaces():
         return None
-    return netifaces.ifaddresses(iface_name)[netifaces.AF_LINK][0]['addr']
+    addresses = netifaces.ifaddresses(iface_name)
+    link_addresses = addresses.get(netifaces.AF_LINK)
+    return InterfaceInfo(
+        iface_name,
+        link_addresses[0]['addr'] if link_addresses else None,
+        tuple(addr['addr'] for addr in addresses.get(netifaces.AF_INET, ())),
+        tuple(addr['addr'] for addr in addresses.get(netifaces.AF_INET6, ())),
+        _get_iface_mtu(iface_name))
+
+
+class _IfaceMonitor(threading.Thread):
+    """Invalidates the interface cache on RTNETLINK link/address events"""
+    def __init__(self):
+        super(_IfaceMonitor, self).__init__(name='iface-monitor')
+        self.daemon = True
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                   NETLINK_ROUTE)
+        self._sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR |
+                         RTMGRP_IPV6_IFADDR))
+
+    def _handle_message(self, msg_type, data, offset):
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            # Links may be renamed, so do not trust the cached names
+            invalidate_iface_info()
+        elif msg_type in (RTM_NEWADDR, RTM_DELADDR):
+            ifa_index = _ifaddrmsg.unpack_from(data, offset)[4]
+            try:
+                invalidate_iface_info(socket.if_indextoname(ifa_index))
+            except (socket.error, OverflowError):
+                invalidate_iface_info()
+
+    def run(self):
+        while True:
+            try:
+                data = self._sock.recv(65535)
+            except socket.error as e:
+                if e.errno == errno.ENOBUFS:
+                    # Events were lost
+                    invalidate_iface_info()
+                    continue
+                LOG.error('Interface monitor failed, disabling the cache')
+                LOG.exception(e)
+                _stop_iface_cache()
+                return
+            offset = 0
+            while offset + _nlmsghdr.size <= len(data):
+                msg_len, msg_type, _flags, _seq, _pid = \
+                    _nlmsghdr.unpack_from(data, offset)
+                if msg_len < _nlmsghdr.size:
+                    break
+                try:
+                    self._handle_message(msg_type, data,
+                                         offset + _nlmsghdr.size)
+                except struct.error:
+                    # A short message, it is unknown which interface changed
+                    LOG.debug('Malformed netlink message %d - skipping',
+                              msg_type)
+                    invalidate_iface_info()
+                offset += (msg_len + 3) & ~3
+
+
+def _start_iface_monitor():
+    global _iface_monitor
+    with _iface_cache_lock:
+        if _iface_monitor is None:
+            try:
+                _iface_monitor = _IfaceMonitor()
+                _iface_monitor.start()
+            except socket.error as msg:
+                LOG.warning('Failed monitoring interfaces, '
+                            'interface info will not be cached')
+                LOG.exception(msg)
+                _iface_monitor = False
+    return bool(_iface_monitor)
+
+
+def _stop_iface_cache():
+    global _iface_monitor
+    with _iface_cache_lock:
+        _iface_monitor = False
+    invalidate_iface_info()
+
+
+def invalidate_iface_info(iface_name=None):
+    global _iface_cache_generation
+    with _iface_cache_lock:
+        _iface_cache_generation += 1
+        if iface_name is None:
+            _iface_cache.clear()
+        else:
+            _iface_cache.pop(iface_name, None)
+
+
+def get_iface_info(iface_name):
+    """Get the interface addresses and MTU, or None if it does not exist
+
+    The info is cached until RTNETLINK reports a change in the interface,
+    or invalidate_iface_info is called.
+    """
+    try:
+        return _iface_cache[iface_name]
+    except KeyError:
+        pass
+    if not _start_iface_monitor():
+        return _resolve_iface_info(iface_name)
+    generation = _iface_cache_generation
+    info = _resolve_iface_info(iface_name)
+    with _iface_cache_lock:
+        # Do not cache the info if it was invalidated while resolving it
+        if generation == _iface_cache_generation and _iface_monitor:
+            _iface_cache[iface_name] = info
+    return info
+
+
+def get_iface_hw_mac(iface_name):
+    info = get_iface_info(iface_name)
+    return info.mac if info else None
 
 
 def get_iface_ip_address(iface_name):
-    if iface_name not in netifaces.interfaces():
+    info = get_iface_info(iface_name)
+    if not info or not info.ipv4_addresses:
         return None
-    return netifaces.ifaddresses(iface_name)[netifaces.AF_INET][0]['addr']
+    return info.ipv4_addresses[0]
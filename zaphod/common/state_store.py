@@ -0,0 +1,213 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from zaphod.common import learned_state
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+# The log is compacted into the snapshot after this many records
+DEFAULT_COMPACT_RECORDS = 64
+
+LOG_SUFFIX = '.log'
+
+_MAGIC = b'ZPHS'
+_VERSION = 1
+_file_header = struct.Struct('!4sH')
+# Payload length and CRC32
+_record_header = struct.Struct('!II')
+
+
+def _encode_record(protocol_name, state):
+    payload = json.dumps([protocol_name, state],
+                         separators=(',', ':')).encode('utf-8')
+    return _record_header.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path):
+    """Read the (protocol name, state) records of a snapshot or a log
+
+    The file is memory mapped, and read up to the first record that is
+    truncated or corrupted, e.g. by a crash in the middle of an append.
+    Returns the records, and the offset of the end of the last good record
+    (0 if the file has no valid header), or None if it does not exist.
+    """
+    try:
+        state_file = open(path, 'rb')
+    except FileNotFoundError:
+        return [], None
+    records = []
+    offset = 0
+    with state_file:
+        size = os.fstat(state_file.fileno()).st_size
+        if size < _file_header.size:
+            return records, offset
+        with mmap.mmap(state_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            magic, version = _file_header.unpack_from(data, 0)
+            if magic != _MAGIC or version != _VERSION:
+                LOG.error('%s is not a learned state file', path)
+                return records, offset
+            offset = _file_header.size
+            while offset + _record_header.size <= size:
+                length, crc = _record_header.unpack_from(data, offset)
+                start = offset + _record_header.size
+                end = start + length
+                if end > size:
+                    LOG.warning('Truncated record in %s', path)
+                    break
+                payload = data[start:end]
+                if zlib.crc32(payload) != crc:
+                    LOG.warning('Corrupted record in %s', path)
+                    break
+                protocol_name, state = json.loads(payload)
+                records.append((protocol_name, state))
+                offset = end
+            if offset < size:
+                LOG.warning('Ignoring %d bytes at the end of %s',
+                            size - offset, path)
+    return records, offset
+
+
+class StateStore(object):
+    """Keep the state learned by protocol handlers on disk
+
+    The state of each protocol is kept in a snapshot file, at path, and in
+    an append-only log next to it. save only appends what the handlers
+    learned since the last save, and once the log has compact_records
+    records it is merged into a new snapshot, which replaces the old one
+    atomically. Both are memory mapped when loaded, so short-lived
+    processes can restore the handlers quickly, instead of learning again
+    from the traffic. A log ending with a torn record is truncated after
+    its last good record when loaded, so new records are not appended
+    after it.
+    """
+    def __init__(self, path, compact_records=DEFAULT_COMPACT_RECORDS):
+        self.path = path
+        self.log_path = path + LOG_SUFFIX
+        self.compact_records = compact_records
+        self._states = {}
+        self._log = None
+        self._log_records = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read the snapshot and the log, returning the merged states"""
+        with self._lock:
+            states = {}
+            snapshot_records, _end = read_records(self.path)
+            for protocol_name, state in snapshot_records:
+                learned_state.merge_learned_state(
+                    states.setdefault(protocol_name, {}), state)
+            log_records, log_end = read_records(self.log_path)
+            for protocol_name, state in log_records:
+                learned_state.merge_learned_state(
+                    states.setdefault(protocol_name, {}), state)
+            if log_end is not None:
+                self._truncate_log(log_end)
+            self._states = states
+            self._log_records = len(log_records)
+            return states
+
+    def _truncate_log(self, end):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        with open(self.log_path, 'r+b') as log:
+            if os.fstat(log.fileno()).st_size > end:
+                # Drop the torn record, or the whole log if its header is
+                # bad, to be written again by _open_log
+                log.truncate(end)
+                log.flush()
+                os.fsync(log.fileno())
+
+    def get_state(self, protocol_name):
+        with self._lock:
+            return self._states.get(protocol_name, {})
+
+    def restore(self, handlers):
+        """Import the stored state into handlers, by protocol name"""
+        for handler in handlers:
+            state = self.get_state(handler.get_protocol_name())
+            if state:
+                handler.import_learned_state(state)
+
+    def save(self, handlers):
+        """Append the state the handlers learned since the last save"""
+        with self._lock:
+            records = []
+            for handler in handlers:
+                protocol_name = handler.get_protocol_name()
+                stored = self._states.setdefault(protocol_name, {})
+                diff = learned_state.diff_learned_state(
+                    stored, handler.export_learned_state())
+                if diff:
+                    learned_state.merge_learned_state(stored, diff)
+                    records.append(_encode_record(protocol_name, diff))
+            if records:
+                self._append(records)
+            if self._log_records >= self.compact_records:
+                self._compact()
+            return len(records)
+
+    def _open_log(self):
+        if self._log is None:
+            self._log = open(self.log_path, 'ab')
+            # Replace a log left with a torn header
+            if self._log.tell() < _file_header.size:
+                self._log.truncate(0)
+                self._log.write(_file_header.pack(_MAGIC, _VERSION))
+        return self._log
+
+    def _append(self, records):
+        log = self._open_log()
+        log.write(b''.join(records))
+        log.flush()
+        os.fsync(log.fileno())
+        self._log_records += len(records)
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as snapshot:
+            snapshot.write(_file_header.pack(_MAGIC, _VERSION))
+            for protocol_name, state in self._states.items():
+                snapshot.write(_encode_record(protocol_name, state))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temp_path, self.path)
+        # Crashing before the log is truncated is harmless, since merging
+        # its records into the snapshot again adds nothing
+        log = self._open_log()
+        log.truncate(_file_header.size)
+        log.flush()
+        os.fsync(log.fileno())
+        self._log_records = 0
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
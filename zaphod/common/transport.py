@@ -0,0 +1,216 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import collections
+import socket
+import threading
+
+import six
+
+from zaphod.common import packet_template
+from zaphod.common import socket_utils
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+ETH_P_ALL = 0x0003
+
+DEFAULT_SENT_QUEUE_LEN = 65536
+
+_BROADCAST_MAC = b'\xff\xff\xff\xff\xff\xff'
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Transport(object):
+    """Where a packet reader gets its frames from, and handlers send to
+
+    A transport creates the listener the reader receives on, and the
+    senders of the protocol handlers. The listener is socket-like: it has
+    recvfrom, returning the frame and an address whose third item is the
+    packet type (as in sll_pkttype), settimeout, fileno and close. The
+    senders have send, settimeout and close.
+    """
+    # Kernel filters, rings, fanout and promiscuous mode are AF_PACKET
+    # features, only available on raw transports
+    raw = False
+
+    def __init__(self, iface_name, iface_mac=None, iface_ip=None):
+        self.iface_name = iface_name
+        self._iface_mac = iface_mac
+        self._iface_ip = iface_ip
+
+    def get_iface_mac(self):
+        return self._iface_mac
+
+    def get_iface_ip_address(self):
+        return self._iface_ip
+
+    @abc.abstractmethod
+    def create_listener(self, read_timeout):
+        pass
+
+    @abc.abstractmethod
+    def create_sender(self, sock_name, protocol):
+        pass
+
+    def close(self):
+        pass
+
+
+class RawSocketTransport(Transport):
+    """AF_PACKET sockets on a network interface, which need CAP_NET_RAW"""
+    raw = True
+
+    def get_iface_mac(self):
+        return socket_utils.get_iface_hw_mac(self.iface_name)
+
+    def get_iface_ip_address(self):
+        return socket_utils.get_iface_ip_address(self.iface_name)
+
+    def create_listener(self, read_timeout):
+        sock = socket_utils.create_socket('L-socket', self.iface_name)
+        if not sock:
+            return None
+        try:
+            sock.bind((self.iface_name, ETH_P_ALL))
+        except socket.error as msg:
+            LOG.error('L-Socket binding failed')
+            LOG.exception(msg)
+            sock.close()
+            return None
+        sock.settimeout(read_timeout)
+        return sock
+
+    def create_sender(self, sock_name, protocol):
+        sock = socket_utils.create_socket(sock_name, self.iface_name)
+        if not sock:
+            return None
+        try:
+            sock.setsockopt(socket.SOL_SOCKET,
+                            socket.SO_BROADCAST, 1)
+            sock.bind((self.iface_name, protocol))
+        except socket.error as msg:
+            LOG.error('Socket binding failed')
+            LOG.exception(msg)
+            sock.close()
+            return None
+        return sock
+
+
+class _MemoryListener(object):
+    def __init__(self, sock, iface_name, iface_mac):
+        self._sock = sock
+        self._address = (iface_name, ETH_P_ALL)
+        self._iface_mac = (packet_template.mac_to_bytes(iface_mac)
+                           if iface_mac else None)
+
+    def _get_pkt_type(self, data):
+        if data[0] & 1:
+            if data[:6] == _BROADCAST_MAC:
+                return socket.PACKET_BROADCAST
+            return socket.PACKET_MULTICAST
+        if self._iface_mac and data[:6] != self._iface_mac:
+            return socket.PACKET_OTHERHOST
+        return socket.PACKET_HOST
+
+    def recvfrom(self, bufsize):
+        try:
+            data = self._sock.recv(bufsize)
+        except BlockingIOError:
+            # Non blocking listeners time out right away
+            raise socket.timeout()
+        return data, self._address + (self._get_pkt_type(data),)
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        # The socket belongs to the transport
+        pass
+
+
+class _MemorySender(object):
+    def __init__(self, transport):
+        self._transport = transport
+
+    def send(self, frame):
+        self._transport._on_sent(bytes(frame))
+        return len(frame)
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryTransport(Transport):
+    """An in-process link, for tests and benchmarks
+
+    Frames passed to inject are received by the reader through a socket
+    pair, so the reader works exactly as it does on a real link, but with
+    no privileges or interfaces. The packet type of every frame is derived
+    from its destination MAC.
+
+    The frames the handlers send are queued, to be taken with read_sent,
+    up to sent_queue_len frames. If a peer callback is set, the frames are
+    passed to it instead, from the sending thread - e.g. to answer them by
+    injecting replies.
+    """
+    def __init__(self, iface_name='mem0', iface_mac=None, iface_ip=None,
+                 sent_queue_len=DEFAULT_SENT_QUEUE_LEN):
+        super(MemoryTransport, self).__init__(iface_name, iface_mac,
+                                              iface_ip)
+        self._wire, self._host = socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_SEQPACKET)
+        self._sent = collections.deque(maxlen=sent_queue_len)
+        self._sent_cond = threading.Condition()
+        self.peer = None
+
+    def create_listener(self, read_timeout):
+        listener = _MemoryListener(self._host, self.iface_name,
+                                   self._iface_mac)
+        listener.settimeout(read_timeout)
+        return listener
+
+    def create_sender(self, sock_name, protocol):
+        return _MemorySender(self)
+
+    def inject(self, frame):
+        """Pass a frame to the reader, blocking while its queue is full"""
+        self._wire.send(frame)
+
+    def _on_sent(self, frame):
+        peer = self.peer
+        if peer is not None:
+            peer(frame)
+            return
+        with self._sent_cond:
+            self._sent.append(frame)
+            self._sent_cond.notify()
+
+    def read_sent(self, timeout=None):
+        """Take the oldest frame sent by the handlers, or None on timeout"""
+        with self._sent_cond:
+            if not self._sent_cond.wait_for(lambda: self._sent, timeout):
+                return None
+            return self._sent.popleft()
+
+    def close(self):
+        self._wire.close()
+        self._host.close()
@@ -0,0 +1,306 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Keep the readers and the protocol handlers running, probing the DHCP
+# servers and the ARP resolvers of the configuration file on a schedule,
+# and serve the latest results on a UNIX socket, to be queried by the
+# nagios_client plugin.
+
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+from zaphod.common import config
+from zaphod.common import error_aggregator
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import results_server
+from zaphod.common import state_store
+from zaphod.protocols import ARP
+from zaphod.protocols import DHCP
+from zaphod.protocols import base_handler
+
+LOG = logger.get_logger(__name__)
+
+DEFAULT_INTERVAL = 60
+DEFAULT_PROBE_TIMEOUT = 2
+SOCKET_TIMEOUT = 10
+
+options = argparse.ArgumentParser(description='Probe the network '
+                                              'integrity periodically')
+options.add_argument('-f', '--file', type=str, default='/etc/zaphod.conf',
+                     help='Configuration file location '
+                          '(default: /etc/zaphod.conf)')
+options.add_argument('-d', '--socket', type=str, default=None,
+                     help='Results socket location (default: %s)' % (
+                         results_server.DEFAULT_SOCKET_PATH,))
+options.add_argument('-i', '--interval', type=int, default=None,
+                     help='Seconds between probes (default: %d)' % (
+                         DEFAULT_INTERVAL,))
+options.add_argument('-m', '--metrics-port', type=int, default=None,
+                     help='Serve the metrics for Prometheus on this port')
+options.add_argument('-s', '--state-file', type=str, default=None,
+                     help='Restore the learned state from this file, and '
+                          'save it there when learning')
+options.add_argument('-l', '--learn', action='store_true',
+                     help='Learn the valid replies instead of reporting '
+                          'them')
+options.add_argument('-v', '--verbose', action='count', default=0,
+                     help='Print verbose output')
+
+
+def _set_log_level(verbose):
+    if verbose > 1:
+        logger.set_log_level(logger.DEBUG)
+    elif verbose > 0:
+        logger.set_log_level(logger.INFO)
+    else:
+        logger.set_log_level(logger.WARN)
+
+
+class ScheduledProbe(object):
+    """Probe with a handler every interval seconds
+
+    send_probes(handler) sends the requests of a run, and the run is over
+    once all of them were replied or timed out, waiting grace seconds
+    after each reply for other replies to the same request. The result of
+    the last run is kept in result, with the errors found by the handler
+    during it.
+    """
+    def __init__(self, name, handler, send_probes, interval, store=None,
+                 grace=0):
+        self.name = name
+        self.handler = handler
+        self.interval = interval
+        self.grace = grace
+        self.result = None
+        self.runs = 0
+        self._send_probes = send_probes
+        self._store = store
+        self._errors = error_aggregator.ErrorAggregator(rate=None)
+        self.handler.register_callback(self._errors)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        self._errors.clear()
+        started = time.time()
+        timed_out = []
+        failure = None
+        try:
+            self._send_probes(self.handler)
+            requests = self.handler.wait_for_completion(grace=self.grace)
+            timed_out = [str(request.key) for request in requests.values()
+                         if request.reason == base_handler.REQUEST_TIMED_OUT]
+            if self._store and self.handler.learn:
+                self._store.save([self.handler])
+        except Exception as e:
+            LOG.error('%s probe failed', self.name)
+            LOG.exception(e)
+            failure = str(e)
+        errors = [dict(error.to_dict(), message=str(error))
+                  for error in self._errors.get_errors()]
+        if failure:
+            errors.append({'message': '%s probe failed: %s' % (self.name,
+                                                               failure)})
+        self.runs += 1
+        self.result = {
+            'started': started,
+            'duration': time.time() - started,
+            'ok': not errors,
+            'errors': errors,
+            'timed_out': timed_out,
+            'runs': self.runs,
+        }
+        for request_key in timed_out:
+            LOG.warning('%s request %s got no reply', self.name, request_key)
+
+    def _run(self):
+        while True:
+            self.run_once()
+            if self._stop_event.wait(self.interval):
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='%s-probe' % (self.name,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+def _send_dhcp_probes(handler):
+    handler.send_packet(handler.create_packet())
+
+
+def _create_arp_sender(resolvers):
+    def _send_arp_probes(handler):
+        for ip_address in resolvers:
+            handler.send_packet(handler.create_packet(ip_address=ip_address))
+    return _send_arp_probes
+
+
+class ZaphodDaemon(object):
+    """The readers and the scheduled probes of a configuration file
+
+    There is a reader per interface, shared by the probes on it, so the
+    raw sockets are opened and ryu is imported once, instead of on every
+    check. The dhcp and arp sections of the configuration may each set
+    their own interface and interval.
+    """
+    def __init__(self, zaphod_config, interval=DEFAULT_INTERVAL,
+                 probe_timeout=DEFAULT_PROBE_TIMEOUT, store=None,
+                 learn=False):
+        self._config = zaphod_config
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self._store = store
+        self._learn = learn
+        self._readers = {}
+        self._probes = []
+        self.started = None
+
+    def _get_reader(self, iface_name):
+        reader = self._readers.get(iface_name)
+        if reader is None:
+            # A short read timeout, so the daemon stops quickly
+            reader = packet_reader.PacketReader(iface_name, read_timeout=1)
+            if not reader.is_ready:
+                LOG.error('Reader for %s is not ready', iface_name)
+                reader.close()
+                return None
+            self._readers[iface_name] = reader
+        return reader
+
+    def _add_probe(self, name, handler, send_probes, component_config,
+                   grace=0):
+        if self._store:
+            self._store.restore([handler])
+        handler.learn = self._learn
+        handler.set_timeout(SOCKET_TIMEOUT)
+        handler.request_timeout = self.probe_timeout
+        self._probes.append(ScheduledProbe(
+            name, handler, send_probes,
+            component_config.get('interval', self.interval), self._store,
+            grace))
+
+    def start(self):
+        dhcp_config = self._config.get_dhcp_config()
+        reader = self._get_reader(dhcp_config['interface'])
+        if reader:
+            dhcp_proto = DHCP.DHCPProto(reader,
+                                        False,
+                                        dhcp_config['servers'],
+                                        dhcp_config['dhcp_ranges'],
+                                        dhcp_config['gateways'],
+                                        dhcp_config['dns_servers'])
+            # Wait a little for the offers of other servers, e.g. rogue ones
+            self._add_probe('DHCP', dhcp_proto, _send_dhcp_probes,
+                            dhcp_config, DHCP.OFFER_GRACE)
+        arp_config = self._config.get_arp_config()
+        reader = self._get_reader(arp_config['interface'])
+        if reader:
+            arp_proto = ARP.ARPProto(reader, False, arp_config['resolvers'])
+            self._add_probe('ARP', arp_proto,
+                            _create_arp_sender(list(arp_config['resolvers'])),
+                            arp_config)
+        if not self._probes:
+            return False
+        for reader in self._readers.values():
+            reader.start_reader()
+        self.started = time.time()
+        for probe in self._probes:
+            probe.start()
+        return True
+
+    def get_results(self):
+        return {
+            'pid': os.getpid(),
+            'started': self.started,
+            'time': time.time(),
+            'probes': {probe.name: probe.result for probe in self._probes},
+        }
+
+    def stop(self):
+        for probe in self._probes:
+            probe.stop()
+        for reader in self._readers.values():
+            reader.stop_reader()
+        for probe in self._probes:
+            probe.handler.close()
+        for reader in self._readers.values():
+            reader.close()
+        self._probes = []
+        self._readers = {}
+
+
+def main():
+    args = options.parse_args()
+    _set_log_level(args.verbose)
+    try:
+        zaphod_config = config.Config(args.file)
+    except IOError:
+        LOG.error('Config file does not exist or not accessible')
+        return 3
+    daemon_config = zaphod_config.get_daemon_config()
+    socket_path = (args.socket or daemon_config.get('socket') or
+                   results_server.DEFAULT_SOCKET_PATH)
+    interval = args.interval or daemon_config.get('interval',
+                                                  DEFAULT_INTERVAL)
+    metrics_port = args.metrics_port or daemon_config.get('metrics_port')
+    store = (state_store.StateStore(args.state_file)
+             if args.state_file else None)
+    daemon = ZaphodDaemon(zaphod_config, interval,
+                          daemon_config.get('probe_timeout',
+                                            DEFAULT_PROBE_TIMEOUT),
+                          store, args.learn)
+    stop_event = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop_event.set())
+    if not daemon.start():
+        LOG.error('No probes could be started')
+        return 2
+    results = None
+    metrics_server = None
+    try:
+        results = results_server.start_results_server(socket_path,
+                                                      daemon.get_results)
+        if metrics_port:
+            metrics_server = metrics.start_http_server(metrics_port)
+        LOG.info('Serving the results on %s', socket_path)
+        while not stop_event.wait(1):
+            pass
+    finally:
+        if metrics_server:
+            metrics_server.shutdown()
+        if results:
+            results_server.stop_results_server(results)
+        daemon.stop()
+        if store:
+            store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,15 +27,17 @@
 
 import argparse
 import sys
-import time
 
 from zaphod.common import config
+from zaphod.common import error_aggregator
 from zaphod.common import logger
 from zaphod.common import packet_reader
+from zaphod.common import state_store
 from zaphod.protocols import ARP
 from zaphod.protocols import DHCP
+from zaphod.protocols import base_handler
 
-TEST_SLEEP_TIME = 2
+TEST_TIMEOUT = 2
 
 LOG = logger.get_logger(__name__)
 
@@ -46,14 +48,16 @@ options.add_argument('-f', '--file', type=str, default='/etc/zaphod.conf',
                           '(default: /etc/zaphod.conf)')
 options.add_argument('-t', '--timeout', type=int, default=10,
                      help='Socket timeout (default: 10)')
+options.add_argument('-s', '--state-file', type=str, default=None,
+                     help='Restore the learned state from this file, and '
+                          'save it there when learning')
+options.add_argument('-l', '--learn', action='store_true',
+                     help='Learn the valid replies instead of reporting '
+                          'them')
 options.add_argument('-v', '--verbose', action='count', default=0,
                      help='Print verbose output')
 
 
-dhcp_errors = None
-arp_errors = None
-
-
 def _set_log_level(verbose):
     if verbose > 2:
         logger.set_log_level(logger.DEBUG)
@@ -65,10 +69,20 @@ def _set_log_level(verbose):
         logger.set_log_level(logger.ERROR)
 
 
+def _log_timed_out_requests(protocol_name, requests):
+    for request in requests.values():
+        if request.reason == base_handler.REQUEST_TIMED_OUT:
+            LOG.warning('%s request %s got no reply', protocol_name,
+                        request.key)
+
+
 class DhcpTester(object):
-    def __init__(self, zaphod_config):
+    def __init__(self, zaphod_config, store=None, learn=False):
         self.config = zaphod_config.get_dhcp_config()
-        self._errors = None
+        self._store = store
+        self._learn = learn
+        # Every error is reported once, however many times it was found
+        self._errors = error_aggregator.ErrorAggregator(rate=None)
 
     def __enter__(self):
         return self
@@ -76,11 +90,6 @@ class DhcpTester(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
-    @staticmethod
-    def _dhcp_status_callback(errors):
-        global dhcp_errors
-        dhcp_errors = errors
-
     def test_dhcp(self):
         reader = packet_reader.PacketReader(self.config['interface'])
         if not reader.is_ready:
@@ -92,15 +101,23 @@ class DhcpTester(object):
                                     self.config['dhcp_ranges'],
                                     self.config['gateways'],
                                     self.config['dns_servers'])
-        dhcp_proto.register_callback(self._dhcp_status_callback)
+        dhcp_proto.register_callback(self._errors)
+        if self._store:
+            self._store.restore([dhcp_proto])
+        dhcp_proto.learn = self._learn
         dhcp_proto.set_timeout(10)
+        dhcp_proto.request_timeout = TEST_TIMEOUT
         reader.start_reader()
         packet = dhcp_proto.create_packet()
         dhcp_proto.send_packet(packet)
-        time.sleep(TEST_SLEEP_TIME)
+        # Wait a little for the offers of other servers, e.g. rogue ones
+        _log_timed_out_requests('DHCP', dhcp_proto.wait_for_completion(
+            grace=DHCP.OFFER_GRACE))
         reader.stop_reader()
+        if self._store and self._learn:
+            self._store.save([dhcp_proto])
         dhcp_proto.close()
-        global dhcp_errors
+        dhcp_errors = self._errors.get_errors()
         if dhcp_errors:
             for dhcp_error in dhcp_errors:
                 print(f'{dhcp_error}')
@@ -109,8 +126,11 @@ class DhcpTester(object):
 
 
 class ArpTester(object):
-    def __init__(self, zaphod_config):
+    def __init__(self, zaphod_config, store=None, learn=False):
         self.config = zaphod_config.get_arp_config()
+        self._store = store
+        self._learn = learn
+        self._errors = error_aggregator.ErrorAggregator(rate=None)
 
     def __enter__(self):
         return self
@@ -118,27 +138,28 @@ class ArpTester(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
-    @staticmethod
-    def _arp_status_callback(errors):
-        global arp_errors
-        arp_errors = errors
-
     def test_arp(self):
         reader = packet_reader.PacketReader(self.config['interface'])
         if not reader.is_ready:
             print('ARP Reader is not ready')
             return False
         arp_proto = ARP.ARPProto(reader, False, self.config['resolvers'])
-        arp_proto.register_callback(self._arp_status_callback)
+        arp_proto.register_callback(self._errors)
+        if self._store:
+            self._store.restore([arp_proto])
+        arp_proto.learn = self._learn
         arp_proto.set_timeout(10)
+        arp_proto.request_timeout = TEST_TIMEOUT
         reader.start_reader()
         for item in self.config['resolvers'].keys():
             packet = arp_proto.create_packet(ip_address=item)
             arp_proto.send_packet(packet)
-        time.sleep(TEST_SLEEP_TIME)
+        _log_timed_out_requests('ARP', arp_proto.wait_for_completion())
         reader.stop_reader()
+        if self._store and self._learn:
+            self._store.save([arp_proto])
         arp_proto.close()
-        global arp_errors
+        arp_errors = self._errors.get_errors()
         if arp_errors:
             for arp_error in arp_errors:
                 print(f'{arp_error}')
@@ -155,12 +176,18 @@ def main():
     except IOError:
         LOG.error('Config file does not exist or not accessible')
         return 3
-    with DhcpTester(zaphod_config) as tester:
-        if not tester.test_dhcp():
-            status = 1
-    with ArpTester(zaphod_config) as tester:
-        if not tester.test_arp():
-            status = 1
+    store = (state_store.StateStore(args.state_file)
+             if args.state_file else None)
+    try:
+        with DhcpTester(zaphod_config, store, args.learn) as tester:
+            if not tester.test_dhcp():
+                status = 1
+        with ArpTester(zaphod_config, store, args.learn) as tester:
+            if not tester.test_arp():
+                status = 1
+    finally:
+        if store:
+            store.close()
 
     if not status:
         print('All tests succeeded')
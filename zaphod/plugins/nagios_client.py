@@ -0,0 +1,100 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Report the latest results of the zaphod daemon, in the same way as the
+# nagios plugin. Only the results socket is used, so no raw sockets are
+# opened and no protocol code is loaded on every check.
+
+import argparse
+import sys
+import time
+
+from zaphod.common import logger
+from zaphod.common import results_server
+
+LOG = logger.get_logger(__name__)
+
+STATUS_OK = 0
+STATUS_FAILED = 1
+STATUS_UNKNOWN = 3
+
+options = argparse.ArgumentParser(description='Report the network integrity '
+                                              'results of the zaphod daemon')
+options.add_argument('-d', '--socket', type=str,
+                     default=results_server.DEFAULT_SOCKET_PATH,
+                     help='Results socket location (default: %s)' % (
+                         results_server.DEFAULT_SOCKET_PATH,))
+options.add_argument('-a', '--max-age', type=int, default=300,
+                     help='Seconds after which results are stale '
+                          '(default: 300)')
+options.add_argument('-t', '--timeout', type=int,
+                     default=results_server.DEFAULT_QUERY_TIMEOUT,
+                     help='Socket timeout (default: %d)' % (
+                         results_server.DEFAULT_QUERY_TIMEOUT,))
+options.add_argument('-v', '--verbose', action='count', default=0,
+                     help='Print verbose output')
+
+
+def _set_log_level(verbose):
+    if verbose > 1:
+        logger.set_log_level(logger.DEBUG)
+    elif verbose > 0:
+        logger.set_log_level(logger.INFO)
+    else:
+        logger.set_log_level(logger.ERROR)
+
+
+def check_results(results, max_age, now=None):
+    """Print the errors in the daemon results, returning the status"""
+    now = now or time.time()
+    status = STATUS_OK
+    unknown = False
+    for name, result in sorted(results.get('probes', {}).items()):
+        if result is None:
+            print(f'{name}: No results yet')
+            unknown = True
+            continue
+        age = now - result['started']
+        if age > max_age:
+            print(f'{name}: Results are {age:.0f} seconds old')
+            unknown = True
+        for error in result['errors']:
+            print(error['message'])
+        if not result['ok']:
+            status = STATUS_FAILED
+    if not results.get('probes'):
+        print('The daemon runs no probes')
+        unknown = True
+    if status == STATUS_OK and unknown:
+        status = STATUS_UNKNOWN
+    return status
+
+
+def main():
+    args = options.parse_args()
+    _set_log_level(args.verbose)
+    try:
+        results = results_server.query_results(args.socket, args.timeout)
+    except (OSError, ValueError) as e:
+        print(f'Could not get the results of the zaphod daemon: {e}')
+        return STATUS_UNKNOWN
+    status = check_results(results, args.max_age)
+    if status == STATUS_OK:
+        print('All tests succeeded')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Validate the DHCP and ARP traffic in pcap or pcapng captures offline,
+# according to the same configuration file as the nagios plugin.
+
+import argparse
+import json
+import sys
+
+from zaphod.common import config
+from zaphod.common import logger
+from zaphod.common import pcap_reader
+from zaphod.common import protocol_errors
+from zaphod.common import result_batcher
+from zaphod.protocols import arp_monitor
+from zaphod.protocols import DHCP
+from zaphod.protocols import dhcp_monitor
+
+LOG = logger.get_logger(__name__)
+
+options = argparse.ArgumentParser(description='Validate captured traffic')
+options.add_argument('captures', nargs='+',
+                     help='pcap or pcapng capture files')
+options.add_argument('-f', '--file', type=str, default='/etc/zaphod.conf',
+                     help='Configuration file location '
+                          '(default: /etc/zaphod.conf)')
+options.add_argument('-s', '--stats', action='store_true',
+                     help='Print the replay statistics as JSON')
+options.add_argument('-j', '--json', action='store_true',
+                     help='Print the errors as JSON lines')
+options.add_argument('-v', '--verbose', action='count', default=0,
+                     help='Print verbose output')
+
+
+def _set_log_level(verbose):
+    if verbose > 1:
+        logger.set_log_level(logger.DEBUG)
+    elif verbose > 0:
+        logger.set_log_level(logger.INFO)
+    else:
+        logger.set_log_level(logger.ERROR)
+
+
+def _print_errors(errors):
+    for error in errors:
+        print(f'{error}')
+
+
+def _print_json_errors(errors):
+    sys.stdout.write(protocol_errors.to_json_lines(errors))
+
+
+def replay_capture(path, zaphod_config, json_lines=False):
+    """Replay a capture through passive handlers, printing their errors
+
+    Returns the ReplayStats, or None if the capture could not be read.
+    """
+    reader = pcap_reader.PcapReader(path)
+    if not reader.is_ready:
+        return None
+    dhcp_config = zaphod_config.get_dhcp_config()
+    arp_config = zaphod_config.get_arp_config()
+    handlers = [
+        DHCP.DHCPProto(reader, True,
+                       dhcp_config['servers'],
+                       dhcp_config['dhcp_ranges'],
+                       dhcp_config['gateways'],
+                       dhcp_config['dns_servers']),
+        dhcp_monitor.DHCPMonitor(reader, dhcp_config['servers'],
+                                 dhcp_config['dhcp_ranges']),
+        # Sees all the ARP traffic, not only the replies to the local host
+        arp_monitor.ARPMonitor(reader, arp_config['resolvers']),
+    ]
+    # Replays find errors as fast as the frames are read
+    batcher = result_batcher.ResultBatcher()
+    batcher.register_callback(_print_json_errors if json_lines
+                              else _print_errors)
+    for handler in handlers:
+        handler.register_callback(batcher)
+    try:
+        return reader.replay()
+    finally:
+        for handler in handlers:
+            handler.close()
+        reader.close()
+        batcher.close()
+
+
+def main():
+    args = options.parse_args()
+    _set_log_level(args.verbose)
+    try:
+        zaphod_config = config.Config(args.file)
+    except IOError:
+        LOG.error('Config file does not exist or not accessible')
+        return 3
+    status = 0
+    for path in args.captures:
+        stats = replay_capture(path, zaphod_config, args.json)
+        if stats is None:
+            status = 2
+            continue
+        if args.stats:
+            print(json.dumps(dict(stats.to_dict(), capture=path)))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
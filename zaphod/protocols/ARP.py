@@ -13,15 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
 import socket
+import struct
+import threading
 
 import netaddr
-from ryu.lib.packet import ethernet, arp
-from ryu.lib.packet import packet as ryu_packet
+from ryu.lib.packet import arp
 from ryu.ofproto import ether
 
+from zaphod.common import address_set
+from zaphod.common import packet_filter
+from zaphod.common import packet_template
 from zaphod.common import protocol_errors
-from zaphod.common import socket_utils
+from zaphod.common import rate_limiter
 from zaphod.protocols import base_handler
 
 from zaphod.common import logger
@@ -30,8 +35,76 @@ LOG = logger.get_logger(__name__)
 ETH_P_ALL = 0x0003
 MAC_BROADCAST = "ff:ff:ff:ff:ff:ff"
 
+ARP_MATCH = packet_filter.Match(ethertype=ether.ETH_TYPE_ARP)
 
-class ARPProto(base_handler.ProtocolHandler):
+# Ethernet header followed by an ARP request for IPv4 over ethernet
+_arp_request = struct.Struct('!6s6sHHHBBH6s4s6s4s')
+_ARP_TARGET_IP_OFFSET = _arp_request.size - 4
+_ipv4_address = struct.Struct('!I')
+
+DEFAULT_SWEEP_RATE = 1000
+DEFAULT_SWEEP_REPLY_TIMEOUT = 2
+
+
+class ArpSweepTable(object):
+    """The results of an ARP sweep over a set of networks
+
+    Both the IP and the MAC addresses are kept as integers, so the table
+    stays compact even for sweeps over whole /16 networks.
+    """
+    def __init__(self, networks):
+        ranges = []
+        for network in networks:
+            network = netaddr.IPNetwork(network)
+            first, last = network.first, network.last
+            if network.prefixlen < 31:
+                # Skip the network and broadcast addresses
+                first, last = first + 1, last - 1
+            if first <= last:
+                ranges.append((first, last))
+        self._ranges = []
+        for first, last in sorted(ranges):
+            if self._ranges and first <= self._ranges[-1][1] + 1:
+                prev_first, prev_last = self._ranges[-1]
+                self._ranges[-1] = (prev_first, max(prev_last, last))
+            else:
+                self._ranges.append((first, last))
+        self._range_starts = [first for first, _last in self._ranges]
+        self.target_count = sum(last - first + 1
+                                for first, last in self._ranges)
+        self.replies = {}
+        self.conflicts = {}
+        self.completed = threading.Event()
+        if not self.target_count:
+            self.completed.set()
+
+    def targets(self):
+        for first, last in self._ranges:
+            for ip in range(first, last + 1):
+                yield ip
+
+    def is_target(self, ip):
+        index = bisect.bisect_right(self._range_starts, ip) - 1
+        return index >= 0 and ip <= self._ranges[index][1]
+
+    def record_reply(self, ip, mac):
+        if not self.is_target(ip):
+            return
+        known_mac = self.replies.get(ip)
+        if known_mac is None:
+            self.replies[ip] = mac
+            if len(self.replies) == self.target_count:
+                self.completed.set()
+        elif known_mac != mac:
+            self.conflicts.setdefault(ip, set()).add(mac)
+
+    def unanswered(self):
+        for ip in self.targets():
+            if ip not in self.replies:
+                yield ip
+
+
+class ARPProto(base_handler.ActiveProtocolHandler):
     def __init__(self,
                  packet_reader,
                  passive_mode=False,
@@ -42,43 +115,77 @@ class ARPProto(base_handler.ProtocolHandler):
                                     for addr, mac in known_addresses.items()}
         else:
             self.known_addresses = {}
-        self._register_handler(arp.arp, self._handle_arp_packet)
+        self._template = None
+        # Probes and sweeps may create packets from different threads
+        self._template_lock = threading.Lock()
+        self._sweep_table = None
+        self._register_handler(arp.arp, self._handle_arp_packet, ARP_MATCH)
 
     @staticmethod
     def get_protocol_name():
         return 'ARP'
 
+    @staticmethod
+    def _build_template(iface_mac, iface_ip):
+        mac = packet_template.mac_to_bytes(iface_mac)
+        data = _arp_request.pack(
+            packet_template.mac_to_bytes(MAC_BROADCAST), mac,
+            ether.ETH_TYPE_ARP,
+            arp.ARP_HW_TYPE_ETHERNET, ether.ETH_TYPE_IP, 6, 4,
+            arp.ARP_REQUEST,
+            mac, packet_template.ip_to_bytes(iface_ip),
+            b'\0' * 6, b'\0' * 4)
+        data = data.ljust(packet_template.ETH_MIN_FRAME_LEN, b'\0')
+        return packet_template.PacketTemplate(data, (iface_mac, iface_ip))
+
+    def _get_template(self):
+        template_key = (self._iface_mac, self._iface_ip)
+        if not self._template or self._template.key != template_key:
+            self._template = self._build_template(*template_key)
+        return self._template
+
     def create_packet(self, ip_address):
-        iface_ip = socket_utils.get_iface_ip_address(self._iface_name)
-        protocols = [
-            ethernet.ethernet(
-                    ethertype=ether.ETH_TYPE_ARP,
-                    dst='FF:FF:FF:FF:FF:FF',
-                    src=self._iface_mac),
-            arp.arp_ip(arp.ARP_REQUEST,
-                       self._iface_mac,
-                       iface_ip,
-                       '00:00:00:00:00:00',
-                       '%s' % (ip_address,))
-        ]
-
-        arp_pkt = ryu_packet.Packet(protocols=protocols)
-        arp_pkt.serialize()
-        return arp_pkt.data
+        target_ip = netaddr.IPAddress(ip_address)
+        with self._template_lock:
+            template = self._get_template()
+            template.patch(_ARP_TARGET_IP_OFFSET, target_ip.packed)
+            data = template.to_bytes()
+        self._track_request(int(target_ip))
+        return data
 
-    def bind_socket(self):
-        sock = socket_utils.create_socket('Socket', self._iface_name)
-        if not sock:
-            return None
+    def get_request_key(self, packet):
+        return _ipv4_address.unpack_from(packet, _ARP_TARGET_IP_OFFSET)[0]
+
+    def sweep(self, networks,
+              rate=DEFAULT_SWEEP_RATE,
+              reply_timeout=DEFAULT_SWEEP_REPLY_TIMEOUT):
+        """Send ARP requests to every host in the given networks
+
+        The requests are sent at up to rate packets per second. Returns an
+        ArpSweepTable once all the hosts replied, or reply_timeout seconds
+        after the last request was sent.
+        """
+        table = ArpSweepTable(networks)
+        with self._template_lock:
+            # A copy, patched without the lock for the whole sweep
+            shared_template = self._get_template()
+            template = packet_template.PacketTemplate(
+                shared_template.to_bytes(), shared_template.key)
+        bucket = rate_limiter.TokenBucket(rate)
+        self._sweep_table = table
         try:
-            sock.setsockopt(socket.SOL_SOCKET,
-                            socket.SO_BROADCAST, 1)
-            sock.bind((self._iface_name, socket.SOCK_RAW))
-        except socket.error as msg:
-            LOG.error('Socket binding failed')
-            LOG.exception(msg)
-            return None
-        return sock
+            for target_ip in table.targets():
+                bucket.consume()
+                template.patch(_ARP_TARGET_IP_OFFSET,
+                               _ipv4_address.pack(target_ip))
+                self.send_packet(template.to_bytes())
+            table.completed.wait(reply_timeout)
+        finally:
+            self._sweep_table = None
+        return table
+
+    def bind_socket(self):
+        return self._transport.create_sender('Socket', socket.SOCK_RAW)
 
     def _check_mac_match(self, answer_ip, answer_mac):
         known_mac = self.known_addresses.get(answer_ip)
@@ -99,6 +206,11 @@ class ARPProto(base_handler.ProtocolHandler):
         arp_errors = []
         arp_packet = packet.get_protocol(arp.arp)
         if arp_packet.opcode == arp.ARP_REPLY:
+            sweep_table = self._sweep_table
+            if sweep_table:
+                sweep_table.record_reply(
+                    address_set.ip_to_int(arp_packet.src_ip),
+                    address_set.mac_to_int(arp_packet.src_mac))
             answer_ip = netaddr.IPAddress(arp_packet.src_ip)
             answer_mac = arp_packet.src_mac.lower()
             if arp_packet.dst_mac.lower() == MAC_BROADCAST:
@@ -108,9 +220,20 @@ class ARPProto(base_handler.ProtocolHandler):
                 arp_errors.append(
                     protocol_errors.InvalidARP(self.__class__,
                                                answer_ip, answer_mac))
+            self._emit_results(arp_errors, int(answer_ip))
+            self._complete_request(int(answer_ip))
         else:
             LOG.debug('ARP opcode type %d not handled', arp_packet.opcode)
-        self._emit_results(arp_errors)
+            self._emit_results(arp_errors)
+
+    def export_learned_state(self):
+        return {'known_addresses': {str(addr): mac for addr, mac
+                                    in self.known_addresses.items()}}
+
+    def import_learned_state(self, state):
+        for addr, mac in state.get('known_addresses', {}).items():
+            self.known_addresses.setdefault(netaddr.IPAddress(addr),
+                                            mac.lower())
 
     def close_resource(self):
         self._unregister_handler(arp.arp, self._handle_arp_packet)
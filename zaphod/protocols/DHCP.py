@@ -16,30 +16,52 @@
 import random
 import socket
 import struct
+import threading
 
-import netaddr
-from ryu.lib.packet import dhcp
-from ryu.lib.packet import ethernet
-from ryu.lib.packet import ipv4
-from ryu.lib.packet import packet as ryu_packet
-from ryu.lib.packet import udp
-from ryu.ofproto import ether
-
-from zaphod.common import socket_utils
+from zaphod.common import address_set
+from zaphod.common import packet_filter
+from zaphod.common import packet_reader
+from zaphod.common import packet_template
 from zaphod.common import protocol_errors
 from zaphod.protocols import base_handler
+from zaphod.protocols import dhcp_packet
 from zaphod.common import logger
 LOG = logger.get_logger(__name__)
 
 DHCP_SERVER_PORT = 67
 DHCP_CLIENT_PORT = 68
 
-DHCP_TIME_SERVER_OPT = 4
-DHCP_MTU_OPT = 26
-DHCP_STATIC_ROUTE_OPT = 33
+DHCP_MATCH = packet_filter.Match(ethertype=packet_filter.ETH_TYPE_IP,
+                                 ip_proto=socket.IPPROTO_UDP,
+                                 ports=(DHCP_SERVER_PORT, DHCP_CLIENT_PORT))
+
+MAC_BROADCAST = 'ff:ff:ff:ff:ff:ff'
+IP_BROADCAST = '255.255.255.255'
+IP_ANY = '0.0.0.0'
+IPTOS_LOWDELAY = 0x10
+# The seconds to wait for the offers of other servers after the first one
+OFFER_GRACE = 0.5
+# In passive mode, the offers to other clients are checked as well
+PASSIVE_PKT_TYPES = packet_reader.PKT_TYPES_ALL
+
+_DHCP_XID_OFFSET = packet_template.UDP_PAYLOAD_OFFSET + 4
+
+
+_ipv4_address = struct.Struct('!I')
+_static_route = struct.Struct('!II')
+_mtu = struct.Struct('!H')
+
 
+def _whole(value, item_size):
+    # Ignore a trailing partial item in a malformed option
+    return value[:len(value) - len(value) % item_size]
 
-class DHCPProto(base_handler.ProtocolHandler):
+
+def bind_client_socket(transport):
+    return transport.create_sender('Socket', DHCP_CLIENT_PORT)
+
+
+class DHCPProto(base_handler.ActiveProtocolHandler):
 
     def __init__(self,
                  packet_reader,
@@ -51,154 +73,137 @@ class DHCPProto(base_handler.ProtocolHandler):
         super(DHCPProto, self).__init__(packet_reader, passive_mode)
         self._rand = random.Random()
         self._rand.seed()
-        self._xid = 0
         self.address = None
-        self.allowed_servers = [item.lower() for item in allowed_servers]
-        self.allowed_dhcp_ranges = [netaddr.IPNetwork(net)
-                                    for net in allowed_dhcp_ranges]
-        self.allowed_gateways = [netaddr.IPAddress(addr)
-                                 for addr in allowed_gateways]
-        self.allowed_dns_servers = [netaddr.IPAddress(addr)
-                                    for addr in allowed_dns_servers]
+        # The allow-lists are kept as integers, so checking an offer does
+        # not build any address objects
+        self.allowed_servers = address_set.AddressSet(
+            allowed_servers, address_set.mac_to_int, address_set.int_to_mac)
+        self.allowed_dhcp_ranges = address_set.NetworkTable(
+            allowed_dhcp_ranges)
+        self.allowed_gateways = address_set.AddressSet(allowed_gateways)
+        self.allowed_dns_servers = address_set.AddressSet(
+            allowed_dns_servers)
         self.client_name = b'dhcp-tester'
-        self._register_handler(dhcp.dhcp, self._handle_dhcp_packet)
+        self._template = None
+        # Probes may create packets from different threads
+        self._template_lock = threading.Lock()
+        self._option_handlers = {
+            dhcp_packet.DHCP_SERVER_IDENTIFIER_OPT:
+                self._handle_server_identifier_opt,
+            dhcp_packet.DHCP_GATEWAY_ADDR_OPT:
+                self._handle_gateway_address_opt,
+            dhcp_packet.DHCP_DNS_SERVER_ADDR_OPT:
+                self._handle_dns_servers_opt,
+            dhcp_packet.DHCP_SUBNET_MASK_OPT: self._handle_subnet_mask_opt,
+            dhcp_packet.DHCP_MTU_OPT: self._handle_mtu_opt,
+            dhcp_packet.DHCP_STATIC_ROUTE_OPT: self._handle_static_route_opt,
+        }
+        self._option_tags = frozenset(self._option_handlers)
+        self._register_handler(self.get_protocol_name(),
+                               self._handle_dhcp_packet, DHCP_MATCH, raw=True,
+                               pkt_types=(PASSIVE_PKT_TYPES if passive_mode
+                                          else None))
 
     @staticmethod
     def get_protocol_name():
         return 'DHCP'
 
-    def create_packet(self):
+    @staticmethod
+    def _build_template(iface_mac, client_name):
         packed_params = struct.pack('!BBBBBB',
-                                    dhcp.DHCP_SUBNET_MASK_OPT,
-                                    DHCP_MTU_OPT,
-                                    dhcp.DHCP_GATEWAY_ADDR_OPT,
-                                    dhcp.DHCP_DNS_SERVER_ADDR_OPT,
-                                    DHCP_TIME_SERVER_OPT,
-                                    DHCP_STATIC_ROUTE_OPT)
+                                    dhcp_packet.DHCP_SUBNET_MASK_OPT,
+                                    dhcp_packet.DHCP_MTU_OPT,
+                                    dhcp_packet.DHCP_GATEWAY_ADDR_OPT,
+                                    dhcp_packet.DHCP_DNS_SERVER_ADDR_OPT,
+                                    dhcp_packet.DHCP_TIME_SERVER_OPT,
+                                    dhcp_packet.DHCP_STATIC_ROUTE_OPT)
         option_list = [
-            dhcp.option(dhcp.DHCP_MESSAGE_TYPE_OPT,
-                        struct.pack('!B', dhcp.DHCP_DISCOVER)),
-            dhcp.option(dhcp.DHCP_HOST_NAME_OPT, self.client_name),
-            dhcp.option(dhcp.DHCP_PARAMETER_REQUEST_LIST_OPT, packed_params),
-        ]
-        options = dhcp.options(option_list=option_list)
-        self._xid = self._rand.randint(0, 0xffffffff)
-        protocols = [
-            ethernet.ethernet(
-                    ethertype=ether.ETH_TYPE_IP,
-                    dst='FF:FF:FF:FF:FF:FF',
-                    src=self._iface_mac),
-            ipv4.ipv4(
-                dst='255.255.255.255',
-                src='0.0.0.0',
-                tos=0x10,  # IPTOS_LOWDELAY
-                ttl=16,
-                proto=socket.IPPROTO_UDP),
-            udp.udp(
-                src_port=DHCP_CLIENT_PORT,
-                dst_port=DHCP_SERVER_PORT),
-            dhcp.dhcp(
-                op=dhcp.DHCP_BOOT_REQUEST,
-                htype=1,
-                hlen=6,
-                hops=0,
-                xid=self._xid,
-                secs=0,
-                ciaddr='0.0.0.0',
-                yiaddr='0.0.0.0',
-                chaddr=self._iface_mac,
-                options=options)
+            (dhcp_packet.DHCP_MESSAGE_TYPE_OPT,
+             struct.pack('!B', dhcp_packet.DHCP_DISCOVER)),
+            (dhcp_packet.DHCP_HOST_NAME_OPT, client_name),
+            (dhcp_packet.DHCP_PARAMETER_REQUEST_LIST_OPT, packed_params),
         ]
+        message = dhcp_packet.build_message(
+            dhcp_packet.DHCP_BOOT_REQUEST,
+            0,  # The xid is patched for every packet
+            packet_template.mac_to_bytes(iface_mac), option_list)
+        data = packet_template.build_udp_frame(
+            MAC_BROADCAST, iface_mac, IP_BROADCAST, IP_ANY,
+            DHCP_SERVER_PORT, DHCP_CLIENT_PORT, message,
+            tos=IPTOS_LOWDELAY, ttl=16)
+        return packet_template.PacketTemplate(data, (iface_mac, client_name))
+
+    def _get_template(self):
+        template_key = (self._iface_mac, self.client_name)
+        if not self._template or self._template.key != template_key:
+            self._template = self._build_template(*template_key)
+        return self._template
 
-        dhcp_pkt = ryu_packet.Packet(protocols=protocols)
-        dhcp_pkt.serialize()
-        return dhcp_pkt.data
+    def create_packet(self):
+        xid = self._rand.randint(0, 0xffffffff)
+        with self._template_lock:
+            template = self._get_template()
+            template.patch_checksummed(
+                _DHCP_XID_OFFSET, struct.pack('!I', xid),
+                packet_template.UDP_CHECKSUM_OFFSET, zero_is_none=True)
+            data = template.to_bytes()
+        self._track_request(xid)
+        return data
+
+    def get_request_key(self, packet):
+        return struct.unpack_from('!I', packet, _DHCP_XID_OFFSET)[0]
 
     def bind_socket(self):
-        sock = socket_utils.create_socket('Socket', self._iface_name)
-        if not sock:
-            return None
-        try:
-            sock.setsockopt(socket.SOL_SOCKET,
-                            socket.SO_BROADCAST, 1)
-            sock.bind((self._iface_name, DHCP_CLIENT_PORT))
-        except socket.error as msg:
-            LOG.error('Socket binding failed')
-            LOG.exception(msg)
-            return None
-        return sock
-
-    @staticmethod
-    def _get_dhcp_message_type_opt(dhcp_packet):
-        for opt in dhcp_packet.options.option_list:
-            if opt.tag == dhcp.DHCP_MESSAGE_TYPE_OPT:
-                return ord(opt.value)
+        return bind_client_socket(self._transport)
 
     def _handle_server_identifier_opt(self, value, dhcp_errors):
-        val1, = struct.unpack('!I', bytes(value))
-        address = netaddr.IPAddress(val1, 4)
-        LOG.debug('Server identifier: %s', address)
+        address, = _ipv4_address.unpack_from(value)
+        LOG.debug('Server identifier: %s', address_set.int_to_ip(address))
         # TODO: Check if this IP is allowed
 
     def _handle_gateway_address_opt(self, value, dhcp_errors):
-        val1, = struct.unpack('!I', bytes(value))
-        address = netaddr.IPAddress(val1, 4)
-        LOG.debug('Gateway address: %s', address)
+        address, = _ipv4_address.unpack_from(value)
+        LOG.debug('Gateway address: %s', address_set.int_to_ip(address))
         if not self._check_allowed_gateway(address):
-            dhcp_errors.append(
-                protocol_errors.InvalidGatewayIPAddress(self.__class__,
-                                                        address))
+            dhcp_errors.append(protocol_errors.InvalidGatewayIPAddress(
+                self.__class__, address_set.int_to_ip(address)))
 
     def _handle_dns_servers_opt(self, value, dhcp_errors):
-        val_bytes = bytes(value)
-        data_len = len(val_bytes)
-        for start in range(0, data_len, 4):
-            val1, = struct.unpack('!I', bytes(value)[start:start + 4])
-            address = netaddr.IPAddress(val1, 4)
-            LOG.debug('DNS Server: %s', address)
+        for address, in _ipv4_address.iter_unpack(_whole(value, 4)):
+            LOG.debug('DNS Server: %s', address_set.int_to_ip(address))
             if not self._check_allowed_dns(address):
-                dhcp_errors.append(
-                    protocol_errors.InvalidDnsServer(self.__class__, address))
+                dhcp_errors.append(protocol_errors.InvalidDnsServer(
+                    self.__class__, address_set.int_to_ip(address)))
 
     def _handle_subnet_mask_opt(self, value, dhcp_errors):
-        val1, = struct.unpack('!I', bytes(value))
-        mask = netaddr.IPAddress(val1, 4)
-        LOG.debug('Subnet mask: %s', mask)
-        if not self._check_subnet_mask(mask):
-            cidr = netaddr.IPNetwork('%s/%s' % (self.address, mask,)).cidr
+        mask, = _ipv4_address.unpack_from(value)
+        LOG.debug('Subnet mask: %s', address_set.int_to_ip(mask))
+        network = address_set.mask_range(self.address, mask)
+        if not self._check_subnet_mask(network):
             dhcp_errors.append(protocol_errors.InvalidNetwork(
-                self.__class__, cidr))
+                self.__class__, address_set.range_to_cidr(*network)))
 
     def _handle_mtu_opt(self, value, dhcp_errors):
-        mtu, = struct.unpack('!H', value)
+        mtu, = _mtu.unpack_from(value)
         LOG.debug('MTU: %d', mtu)
         # TODO(snapiri) Check MTU
 
     def _handle_static_route_opt(self, value, dhcp_errors):
-        val_bytes = bytes(value)
-        data_len = len(val_bytes)
-        for start in range(0, data_len, 8):
-            val1, val2 = struct.unpack('!II', bytes(value)[start:start + 8])
-            dest = netaddr.IPAddress(val1, 4)
-            gateway = netaddr.IPAddress(val2, 4)
-            LOG.debug('Static route: %s through %s', dest, gateway, )
+        for dest, gateway in _static_route.iter_unpack(_whole(value, 8)):
+            dest = address_set.int_to_ip(dest)
+            LOG.debug('Static route: %s through %s', dest,
+                      address_set.int_to_ip(gateway))
             if not self._check_allowed_gateway(gateway):
                 dhcp_errors.append(protocol_errors.InvalidRoute(
-                    self.__class__, dest, gateway))
+                    self.__class__, dest, address_set.int_to_ip(gateway)))
 
     def _handle_dhcp_opt(self, tag, value, dhcp_errors):
-        handlers = {
-            dhcp.DHCP_SERVER_IDENTIFIER_OPT:
-                self._handle_server_identifier_opt,
-            dhcp.DHCP_GATEWAY_ADDR_OPT: self._handle_gateway_address_opt,
-            dhcp.DHCP_DNS_SERVER_ADDR_OPT: self._handle_dns_servers_opt,
-            dhcp.DHCP_SUBNET_MASK_OPT: self._handle_subnet_mask_opt,
-            DHCP_MTU_OPT: self._handle_mtu_opt,
-            DHCP_STATIC_ROUTE_OPT: self._handle_static_route_opt,
-        }
-        handler = handlers.get(tag)
+        handler = self._option_handlers.get(tag)
         if handler:
-            handler(value, dhcp_errors)
+            try:
+                handler(value, dhcp_errors)
+            except struct.error:
+                LOG.debug('Malformed DHCP option %s - ignoring', tag)
         else:
             LOG.debug('Not handler for DHCP option %s', tag)
 
@@ -206,26 +211,22 @@ class DHCPProto(base_handler.ProtocolHandler):
         if item in item_list:
             return True
         if self.learn:
-            LOG.debug('Learned %s: %s', item_type, item)
-            item_list.append(item)
+            LOG.debug('Learned %s: %s', item_type, item_list.to_string(item))
+            item_list.add(item)
             return True
         if not item_list:
             return True
         return False
 
     def _check_allowed_server_mac(self, server_mac):
-        return self._check_item_in_list('server MAC',
-                                        server_mac.lower(),
+        return self._check_item_in_list('server MAC', server_mac,
                                         self.allowed_servers)
 
     def _check_allowed_address(self, addr):
         if not self.allowed_dhcp_ranges and not self.learn:
             return True
-        for allowed_range in self.allowed_dhcp_ranges:
-            if addr in allowed_range:
-                return True
         # Learning is in the netmask...
-        return False
+        return self.allowed_dhcp_ranges.contains_address(addr)
 
     def _check_allowed_gateway(self, addr):
         return self._check_item_in_list('gateway', addr,
@@ -235,45 +236,68 @@ class DHCPProto(base_handler.ProtocolHandler):
         return self._check_item_in_list('DNS', addr,
                                         self.allowed_dns_servers)
 
-    def _check_subnet_mask(self, mask):
-        net = netaddr.IPNetwork('%s/%s' % (self.address, mask,))
-        return self._check_item_in_list('Network', net,
+    def _check_subnet_mask(self, network):
+        return self._check_item_in_list('Network', network,
                                         self.allowed_dhcp_ranges)
 
-    def _handle_dhcp_packet(self, packet):
+    def _handle_dhcp_packet(self, data):
+        message = dhcp_packet.parse(data, self._option_tags)
+        if message is None:
+            return
         dhcp_errors = []
-        ethernet_packet = packet.get_protocol(ethernet.ethernet)
-        dhcp_packet = packet.get_protocol(dhcp.dhcp)
 
-        LOG.debug('xid: %d', dhcp_packet.xid)
+        LOG.debug('xid: %d', message.xid)
 
-        # Verify xid only on active mode
-        if not self._passive_mode and dhcp_packet.xid != self._xid:
-            LOG.debug('Invalid xid (Got %d, expecting %d) - ignoring',
-                      dhcp_packet.xid, self._xid)
+        # Verify xid only on active mode, where many requests may be tracked
+        if not self._passive_mode and not self._is_request_tracked(
+                message.xid):
+            LOG.debug('Invalid xid (Got %d, not a tracked request) - '
+                      'ignoring', message.xid)
             return
 
-        dhcp_message_type = self._get_dhcp_message_type_opt(dhcp_packet)
-        if dhcp_message_type == dhcp.DHCP_OFFER:
-            source_mac = ethernet_packet.src
-            dest_mac = ethernet_packet.dst
+        if message.message_type == dhcp_packet.DHCP_OFFER:
+            source_mac = dhcp_packet.format_mac(message.src_mac)
+            dest_mac = dhcp_packet.format_mac(message.dst_mac)
             LOG.debug('Source MAC is: %s', source_mac)
             LOG.debug('Dest MAC is: %s', dest_mac)
-            if not self._check_allowed_server_mac(source_mac):
+            server_mac = int.from_bytes(message.src_mac, 'big')
+            if not self._check_allowed_server_mac(server_mac):
                 dhcp_errors.append(protocol_errors.InvalidServerMAC(
                     self.__class__, source_mac))
 
-            self.address = netaddr.IPAddress(dhcp_packet.yiaddr)
-            LOG.debug('Got IP address %s', self.address)
+            self.address = message.yiaddr
+            LOG.debug('Got IP address %s', address_set.int_to_ip(self.address))
             if not self._check_allowed_address(self.address):
                 if not self.learn:
                     dhcp_errors.append(protocol_errors.InvalidIPAddress(
-                        self.__class__, self.address))
-            for opt in dhcp_packet.options.option_list:
-                self._handle_dhcp_opt(opt.tag, opt.value, dhcp_errors)
+                        self.__class__, address_set.int_to_ip(self.address)))
+            for tag, value in message.options.items():
+                self._handle_dhcp_opt(tag, value, dhcp_errors)
+            self._emit_results(dhcp_errors, message.xid)
+            self._complete_request(message.xid)
         else:
-            LOG.debug('DHCP message type %d not handled', dhcp_message_type)
-        self._emit_results(dhcp_errors)
+            LOG.debug('DHCP message type %s not handled',
+                      message.message_type)
+            self._emit_results(dhcp_errors)
+
+    def export_learned_state(self):
+        return {
+            'servers': self.allowed_servers.to_strings(),
+            'dhcp_ranges': self.allowed_dhcp_ranges.to_strings(),
+            'gateways': self.allowed_gateways.to_strings(),
+            'dns_servers': self.allowed_dns_servers.to_strings(),
+        }
+
+    def import_learned_state(self, state):
+        for mac in state.get('servers', ()):
+            self.allowed_servers.add(mac)
+        for net in state.get('dhcp_ranges', ()):
+            self.allowed_dhcp_ranges.add(net)
+        for addr in state.get('gateways', ()):
+            self.allowed_gateways.add(addr)
+        for addr in state.get('dns_servers', ()):
+            self.allowed_dns_servers.add(addr)
 
     def close_resource(self):
-        self._unregister_handler(dhcp.dhcp, self._handle_dhcp_packet)
+        self._unregister_handler(self.get_protocol_name(),
+                                 self._handle_dhcp_packet)
@@ -0,0 +1,245 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import operator
+import struct
+import threading
+import time
+
+from zaphod.common import address_set
+from zaphod.common import packet_filter
+from zaphod.common import packet_reader
+from zaphod.common import protocol_errors
+from zaphod.protocols import base_handler
+from zaphod.protocols import ARP
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+DEFAULT_MAX_BINDINGS = 262144
+# Hosts that were not heard from for this long are forgotten
+DEFAULT_BINDING_TIMEOUT = 4 * 3600
+# A MAC that flips back within this many seconds means both are in use
+DEFAULT_CONFLICT_WINDOW = 60
+DEFAULT_GRATUITOUS_LIMIT = 20
+DEFAULT_GRATUITOUS_PERIOD = 10.0
+
+ARP_HW_TYPE_ETHERNET = 1
+
+# Requests are broadcast, and replies to other hosts are only seen in
+# promiscuous mode
+MONITORED_PKT_TYPES = packet_reader.PKT_TYPES_ALL
+
+# ARP for IPv4 over ethernet, with the MACs as bytes and the IPs as ints
+_arp_ipv4 = struct.Struct('!HHBBH6sI6sI')
+_ARP_IPV4_ETHERNET = (ARP_HW_TYPE_ETHERNET, packet_filter.ETH_TYPE_IP, 6, 4)
+
+
+class ArpBinding(object):
+    """The MAC an IPv4 address was last seen with
+
+    The addresses and MACs are integers, so a table of these stays small
+    enough to hold every host of a large L2 domain.
+    """
+    __slots__ = ('mac', 'first_seen', 'last_seen', 'flips', 'prev_mac',
+                 'flipped_at')
+
+    def __init__(self, mac, now):
+        self.mac = mac
+        self.first_seen = now
+        self.last_seen = now
+        self.flips = 0
+        self.prev_mac = None
+        self.flipped_at = None
+
+    def to_dict(self, ip):
+        return {
+            'ip': address_set.int_to_ip(ip),
+            'mac': address_set.int_to_mac(self.mac),
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'flips': self.flips,
+        }
+
+
+class _GratuitousPeriod(object):
+    __slots__ = ('start', 'count')
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 1
+
+
+_binding_last_seen = operator.attrgetter('last_seen')
+_period_start = operator.attrgetter('start')
+
+
+class ARPMonitor(base_handler.ProtocolHandler):
+    """Passively watch all the ARP traffic for spoofing
+
+    Every request, reply and gratuitous ARP binds its sender IP to its
+    sender MAC, in a table of up to max_bindings addresses, where the
+    bindings idle for binding_timeout seconds are dropped, least recently
+    seen first. The monitor reports:
+     * MAC flips - an address moving to another MAC
+     * IP conflicts - an address flipping back to its previous MAC within
+       conflict_window seconds, so both MACs are claiming it
+     * gratuitous ARP floods - a MAC sending more than gratuitous_limit
+       gratuitous ARPs in gratuitous_period seconds
+     * bindings that do not match known_addresses (or the ones learned, in
+       learn mode), as InvalidARP
+    """
+    def __init__(self,
+                 packet_reader,
+                 known_addresses=None,
+                 max_bindings=DEFAULT_MAX_BINDINGS,
+                 binding_timeout=DEFAULT_BINDING_TIMEOUT,
+                 conflict_window=DEFAULT_CONFLICT_WINDOW,
+                 gratuitous_limit=DEFAULT_GRATUITOUS_LIMIT,
+                 gratuitous_period=DEFAULT_GRATUITOUS_PERIOD,
+                 promiscuous=False):
+        super(ARPMonitor, self).__init__(packet_reader, True)
+        self.known_addresses = {}
+        self.import_learned_state({'known_addresses': known_addresses or {}})
+        self.max_bindings = max_bindings
+        self.binding_timeout = binding_timeout
+        self.conflict_window = conflict_window
+        self.gratuitous_limit = gratuitous_limit
+        self.gratuitous_period = gratuitous_period
+        self._bindings = collections.OrderedDict()
+        # MACs to their current gratuitous ARP period
+        self._gratuitous = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._promiscuous = (promiscuous and packet_reader.is_ready and
+                             packet_reader.set_promiscuous(True))
+        self._register_handler(self.get_protocol_name(),
+                               self._handle_arp_packet, ARP.ARP_MATCH,
+                               raw=True, pkt_types=MONITORED_PKT_TYPES)
+
+    @staticmethod
+    def get_protocol_name():
+        return 'ARPMonitor'
+
+    @property
+    def is_ready(self):
+        return self._packet_reader.is_ready
+
+    def get_bindings(self):
+        """A snapshot of the binding table, least recently seen first"""
+        with self._lock:
+            return [binding.to_dict(ip)
+                    for ip, binding in self._bindings.items()]
+
+    def _evict(self, table, idle_since, get_last_seen):
+        # The least recently updated entries are first
+        while table:
+            key, entry = next(iter(table.items()))
+            if (len(table) <= self.max_bindings and
+                    get_last_seen(entry) > idle_since):
+                break
+            del table[key]
+
+    def _check_known(self, ip, mac, errors):
+        known_mac = self.known_addresses.get(ip)
+        if known_mac is None:
+            if self.learn:
+                LOG.debug('Learned MAC %s for IP %s',
+                          address_set.int_to_mac(mac),
+                          address_set.int_to_ip(ip))
+                self.known_addresses[ip] = mac
+        elif known_mac != mac:
+            errors.append(protocol_errors.InvalidARP(
+                self.__class__, address_set.int_to_mac(mac),
+                address_set.int_to_ip(ip)))
+
+    def _update_binding(self, ip, mac, now, errors):
+        binding = self._bindings.get(ip)
+        if binding is None:
+            self._bindings[ip] = ArpBinding(mac, now)
+            self._check_known(ip, mac, errors)
+            self._evict(self._bindings, now - self.binding_timeout,
+                        _binding_last_seen)
+            return
+        self._bindings.move_to_end(ip)
+        binding.last_seen = now
+        if binding.mac == mac:
+            return
+        if (binding.prev_mac == mac and
+                now - binding.flipped_at < self.conflict_window):
+            error_class = protocol_errors.IPConflict
+        else:
+            error_class = protocol_errors.MACFlip
+        errors.append(error_class(self.__class__,
+                                  address_set.int_to_mac(mac),
+                                  address_set.int_to_ip(ip),
+                                  address_set.int_to_mac(binding.mac)))
+        binding.prev_mac = binding.mac
+        binding.mac = mac
+        binding.flipped_at = now
+        binding.flips += 1
+        self._check_known(ip, mac, errors)
+
+    def _count_gratuitous(self, mac, now, errors):
+        period = self._gratuitous.get(mac)
+        if period is None or now - period.start >= self.gratuitous_period:
+            self._gratuitous[mac] = _GratuitousPeriod(now)
+            self._gratuitous.move_to_end(mac)
+            self._evict(self._gratuitous, now - self.gratuitous_period,
+                        _period_start)
+            return
+        period.count += 1
+        # Reported once per period
+        if period.count == self.gratuitous_limit + 1:
+            errors.append(protocol_errors.GratuitousARPFlood(
+                self.__class__, address_set.int_to_mac(mac), period.count,
+                now - period.start))
+
+    def _handle_arp_packet(self, data):
+        _ethertype, offset = packet_filter.get_network_header(data)
+        if len(data) < offset + _arp_ipv4.size:
+            return
+        (hw_type, proto_type, hw_len, proto_len, _opcode, sender_mac,
+         sender_ip, _target_mac, target_ip) = _arp_ipv4.unpack_from(
+             data, offset)
+        if (hw_type, proto_type, hw_len, proto_len) != _ARP_IPV4_ETHERNET:
+            return
+        if not sender_ip:
+            # Address probes (RFC 5227) do not bind anything
+            return
+        mac = int.from_bytes(sender_mac, 'big')
+        now = time.time()
+        errors = []
+        with self._lock:
+            if sender_ip == target_ip:
+                self._count_gratuitous(mac, now, errors)
+            self._update_binding(sender_ip, mac, now, errors)
+        if errors:
+            self._emit_results(errors)
+
+    def export_learned_state(self):
+        return {'known_addresses': {
+            address_set.int_to_ip(ip): address_set.int_to_mac(mac)
+            for ip, mac in self.known_addresses.items()}}
+
+    def import_learned_state(self, state):
+        for ip, mac in state.get('known_addresses', {}).items():
+            self.known_addresses.setdefault(address_set.ip_to_int(ip),
+                                            address_set.mac_to_int(mac))
+
+    def close_resource(self):
+        self._unregister_handler(self.get_protocol_name(),
+                                 self._handle_arp_packet)
+        if self._promiscuous:
+            self._packet_reader.set_promiscuous(False)
@@ -0,0 +1,137 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import socket
+
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+
+class AsyncProtocolHandler(object):
+    """Exposes a protocol handler to asyncio code
+
+    The results emitted by the handler are delivered to the awaiting
+    coroutines instead of to global callbacks. The handler may be fed by
+    either an AsyncPacketReader on the same loop, or a threaded
+    PacketReader. Unless given, the loop is the one running when the
+    handler is first used.
+    """
+    def __init__(self, handler, loop=None):
+        self._handler = handler
+        self._loop = loop
+        self._queues = []
+        # Request keys to the queues of the probes waiting for their replies
+        self._probes = collections.defaultdict(list)
+        if handler.socket is not None:
+            # Passive handlers have no socket, and only emit results
+            self._handler.set_timeout(0)
+        self._handler.register_callback(self._on_results)
+        self._handler.register_request_callback(self._on_request_results)
+
+    @property
+    def handler(self):
+        return self._handler
+
+    def create_packet(self, *args, **kwargs):
+        return self._handler.create_packet(*args, **kwargs)
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return self._loop
+
+    def _dispatch_results(self, errors):
+        for queue in self._queues:
+            queue.put_nowait(errors)
+
+    def _dispatch_request_results(self, request_key, errors):
+        for queue in self._probes.get(request_key, ()):
+            queue.put_nowait(errors)
+
+    def _on_results(self, errors):
+        # Called by the packet reader, which may be running in another thread
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._dispatch_results, errors)
+
+    def _on_request_results(self, request_key, errors):
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._dispatch_request_results,
+                                      request_key, errors)
+
+    async def send_packet(self, packet_to_send):
+        sock = self._handler.socket
+        if not isinstance(sock, socket.socket):
+            # Senders of non raw transports do not block
+            self._handler.send_packet(packet_to_send)
+            return
+        await self._get_loop().sock_sendall(sock, packet_to_send)
+
+    async def results(self):
+        """Iterate over the results emitted by the handler"""
+        self._get_loop()
+        queue = asyncio.Queue()
+        self._queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._queues.remove(queue)
+
+    async def probe(self, packet_to_send, replies=1, timeout=None):
+        """Send a packet and wait for the handler to process its replies
+
+        The replies are matched to the packet by the key the handler tracks
+        its request by (see get_request_key), so many probes may run at the
+        same time. Returns as soon as the expected number of replies were
+        processed, or when the timeout expires, with the list of results
+        emitted for each of the replies.
+        """
+        request_key = self._handler.get_request_key(packet_to_send)
+        if request_key is None:
+            raise ValueError('%s does not match replies to requests' % (
+                self._handler.get_protocol_name(),))
+        loop = self._get_loop()
+        queue = asyncio.Queue()
+        self._probes[request_key].append(queue)
+        results = []
+        try:
+            await self.send_packet(packet_to_send)
+            deadline = None if timeout is None else loop.time() + timeout
+            while len(results) < replies:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                try:
+                    results.append(
+                        await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            queues = self._probes[request_key]
+            queues.remove(queue)
+            if not queues:
+                del self._probes[request_key]
+        return results
+
+    def close(self):
+        self._handler.unregister_request_callback(self._on_request_results)
+        self._handler.unregister_callback(self._on_results)
+        self._handler.close()
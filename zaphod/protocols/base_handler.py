@@ -14,11 +14,36 @@
 # limitations under the License.
 
 import abc
+import threading
+import time
 
-from zaphod.common import socket_utils
 from zaphod.common import logger
 LOG = logger.get_logger(__name__)
 
+DEFAULT_REQUEST_TIMEOUT = 5
+
+REQUEST_PENDING = 'pending'
+REQUEST_REPLIED = 'replied'
+REQUEST_TIMED_OUT = 'timed out'
+
+
+class PendingRequest(object):
+    def __init__(self, key, timeout):
+        self.key = key
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout
+        self.replied_at = None
+        self.reason = REQUEST_PENDING
+
+    @property
+    def rtt(self):
+        if self.replied_at is None:
+            return None
+        return self.replied_at - self.sent_at
+
+    def __repr__(self):
+        return 'PendingRequest(%s: %s)' % (self.key, self.reason,)
+
 
 class ProtocolHandler(object):
     def __init__(self,
@@ -27,7 +52,20 @@ class ProtocolHandler(object):
         self._packet_reader = packet_reader
         self._passive_mode = passive_mode
         self._callbacks = []
-        self._socket = self.bind_socket()
+        self._request_callbacks = []
+        self._socket = None
+        if packet_reader.transport:
+            # Offline readers may not have a transport to send on
+            self._socket = self.bind_socket()
+        self._requests = {}
+        self._requests_cond = threading.Condition()
+        self._probe_rtt = packet_reader.registry.histogram(
+            'zaphod_probe_rtt_seconds', 'Round trip time of replied requests',
+            reader=packet_reader.name, protocol=self.get_protocol_name())
+        self._probe_timeouts = packet_reader.registry.counter(
+            'zaphod_probe_timeouts_total', 'Requests that were not replied',
+            reader=packet_reader.name, protocol=self.get_protocol_name())
+        self.request_timeout = DEFAULT_REQUEST_TIMEOUT
         self.learn = False
 
     @property
@@ -35,31 +73,50 @@ class ProtocolHandler(object):
         return (self._packet_reader.is_ready and self._socket and
                 self._iface_mac)
 
+    @property
+    def socket(self):
+        return self._socket
+
     @property
     def _iface_name(self):
         return self._packet_reader.iface_name
 
+    @property
+    def _transport(self):
+        return self._packet_reader.transport
+
     @property
     def _iface_mac(self):
-        return socket_utils.get_iface_hw_mac(self._iface_name)
+        return self._transport.get_iface_mac()
+
+    @property
+    def _iface_ip(self):
+        return self._transport.get_iface_ip_address()
 
     @staticmethod
     @abc.abstractmethod
     def get_protocol_name():
         pass
 
-    @abc.abstractmethod
-    def create_packet(self, *args, **kwargs):
-        pass
-
-    @abc.abstractmethod
     def bind_socket(self):
-        pass
+        # Passive handlers send nothing
+        return None
 
     @abc.abstractmethod
     def close_resource(self):
         pass
 
+    def export_learned_state(self):
+        """Return the state learned by the handler as plain data
+
+        The state is made of dicts, lists and strings only, so it can be
+        pickled or serialized, and merged with import_learned_state.
+        """
+        return {}
+
+    def import_learned_state(self, state):
+        pass
+
     def close(self):
         self.close_resource()
         if self._socket:
@@ -77,17 +134,131 @@ class ProtocolHandler(object):
     def unregister_callback(self, callback):
         self._callbacks.remove(callback)
 
-    def _register_handler(self, protocol, handler):
-        self._packet_reader.register_protocol_packet_handler(protocol, handler)
+    def register_request_callback(self, callback):
+        """Get the results of the replies to tracked requests
+
+        The callback is called with the key of the request and the results
+        of each reply to it, e.g. to match replies to their requests.
+        """
+        self._request_callbacks.append(callback)
+
+    def unregister_request_callback(self, callback):
+        self._request_callbacks.remove(callback)
+
+    def get_request_key(self, packet):
+        """The key a packet created by create_packet is tracked by"""
+        return None
+
+    def _register_handler(self, protocol, handler, match=None, raw=False,
+                          pkt_types=None):
+        self._packet_reader.register_protocol_packet_handler(protocol, handler,
+                                                             match, raw,
+                                                             pkt_types)
 
     def _unregister_handler(self, protocol, handler):
         self._packet_reader.unregister_protocol_packet_handler(protocol,
                                                                handler)
 
-    def _emit_results(self, errors):
+    def _track_request(self, key, timeout=None):
+        if timeout is None:
+            timeout = self.request_timeout
+        with self._requests_cond:
+            self._requests[key] = PendingRequest(key, timeout)
+
+    def _is_request_tracked(self, key):
+        with self._requests_cond:
+            return key in self._requests
+
+    def _complete_request(self, key):
+        with self._requests_cond:
+            request = self._requests.get(key)
+            if not request or request.reason != REQUEST_PENDING:
+                return False
+            request.replied_at = time.monotonic()
+            request.reason = REQUEST_REPLIED
+            self._probe_rtt.observe(request.rtt)
+            self._requests_cond.notify_all()
+        return True
+
+    def _expire_requests(self, now):
+        pending = []
+        for request in self._requests.values():
+            if request.reason != REQUEST_PENDING:
+                continue
+            if request.deadline <= now:
+                request.reason = REQUEST_TIMED_OUT
+                self._probe_timeouts.inc()
+            else:
+                pending.append(request)
+        return pending
+
+    def wait_for_completion(self, timeout=None, early_completion=True,
+                            grace=0):
+        """Wait until every tracked request was replied or timed out
+
+        Returns a dict of the tracked requests by their key, each with the
+        reason it was completed for, and stops tracking the completed ones.
+        If timeout is given, returns after at most timeout seconds, and the
+        requests that are still pending remain tracked. With grace, keeps
+        waiting up to grace seconds after each reply (but not beyond the
+        timeout of its request), so the other replies to the same request
+        (e.g. of a rogue server) are checked as well. Without
+        early_completion, waits until the timeout of every request even if
+        it was replied.
+        """
+        end_time = None if timeout is None else time.monotonic() + timeout
+        with self._requests_cond:
+            while True:
+                now = time.monotonic()
+                wait_until = [request.deadline for request in
+                              self._expire_requests(now)]
+                if not early_completion:
+                    wait_until = [request.deadline
+                                  for request in self._requests.values()
+                                  if request.deadline > now]
+                elif grace:
+                    wait_until.extend(
+                        min(request.replied_at + grace, request.deadline)
+                        for request in self._requests.values()
+                        if request.reason == REQUEST_REPLIED and
+                        request.replied_at + grace > now and
+                        request.deadline > now)
+                if not wait_until or (end_time is not None and
+                                      now >= end_time):
+                    break
+                wait_until = min(wait_until)
+                if end_time is not None:
+                    wait_until = min(wait_until, end_time)
+                self._requests_cond.wait(wait_until - now)
+            requests = self._requests
+            self._requests = {key: request for key, request in requests.items()
+                              if request.reason == REQUEST_PENDING}
+        return requests
+
+    def _emit_results(self, errors, request_key=None):
         for callback in self._callbacks:
             try:
                 callback(errors)
             except Exception as e:
                 LOG.error('Exception in callback')
                 LOG.exception(e)
+        if request_key is None:
+            return
+        for callback in self._request_callbacks:
+            try:
+                callback(request_key, errors)
+            except Exception as e:
+                LOG.error('Exception in request callback')
+                LOG.exception(e)
+
+
+class ActiveProtocolHandler(ProtocolHandler):
+    """A handler that sends packets, and checks the replies to them"""
+
+    @abc.abstractmethod
+    def create_packet(self, *args, **kwargs):
+        pass
+
+    @abc.abstractmethod
+    def bind_socket(self):
+        pass
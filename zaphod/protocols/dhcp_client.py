@@ -0,0 +1,368 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import random
+import struct
+import threading
+import time
+
+from zaphod.common import address_set
+from zaphod.common import packet_reader
+from zaphod.common import packet_template
+from zaphod.common import rate_limiter
+from zaphod.protocols import base_handler
+from zaphod.protocols import dhcp_packet
+from zaphod.protocols import DHCP
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+DEFAULT_RATE = 100
+DEFAULT_PHASE_TIMEOUT = 2
+DEFAULT_RETRIES = 2
+
+PHASE_DISCOVER = 'discover'
+PHASE_REQUEST = 'request'
+
+STATE_SELECTING = 'selecting'
+STATE_REQUESTING = 'requesting'
+STATE_BOUND = 'bound'
+STATE_RELEASED = 'released'
+STATE_NAKED = 'naked'
+STATE_TIMED_OUT = 'timed out'
+
+_DONE_STATES = frozenset((STATE_BOUND, STATE_RELEASED, STATE_NAKED,
+                          STATE_TIMED_OUT))
+
+_PARAMETER_REQUEST_LIST = struct.pack(
+    '!BBBB', dhcp_packet.DHCP_SUBNET_MASK_OPT,
+    dhcp_packet.DHCP_GATEWAY_ADDR_OPT, dhcp_packet.DHCP_DNS_SERVER_ADDR_OPT,
+    dhcp_packet.DHCP_IP_ADDR_LEASE_TIME_OPT)
+_OPTION_TAGS = frozenset((dhcp_packet.DHCP_SERVER_IDENTIFIER_OPT,
+                          dhcp_packet.DHCP_IP_ADDR_LEASE_TIME_OPT))
+# The clients ask for broadcast replies, as the replies to their own MACs
+# would only be seen in promiscuous mode
+_REPLY_PKT_TYPES = packet_reader.PKT_TYPES_ALL
+
+_ipv4_address = struct.Struct('!I')
+_message_type = struct.Struct('!B')
+
+
+def _random_mac(rand):
+    # A locally administered unicast address
+    return bytes(bytearray([0x02] + [rand.randint(0, 0xff)
+                                     for _index in range(5)]))
+
+
+class DhcpTransaction(object):
+    """The exchange of a single simulated client
+
+    The latencies are in seconds by phase, measured from the last time the
+    phase message was sent.
+    """
+    __slots__ = ('chaddr', 'xid', 'state', 'attempts', 'retries',
+                 'started_at', 'sent_at', 'deadline', 'latencies',
+                 'offered_ip', 'server_ip', 'server_mac', 'lease_time')
+
+    def __init__(self, chaddr, xid, now):
+        self.chaddr = chaddr
+        self.xid = xid
+        self.state = STATE_SELECTING
+        self.attempts = 0
+        self.retries = 0
+        self.started_at = now
+        self.sent_at = now
+        self.deadline = now
+        self.latencies = {}
+        self.offered_ip = None
+        self.server_ip = None
+        self.server_mac = None
+        self.lease_time = None
+
+    @property
+    def phase(self):
+        if self.state == STATE_SELECTING:
+            return PHASE_DISCOVER
+        return PHASE_REQUEST
+
+    @property
+    def is_done(self):
+        return self.state in _DONE_STATES
+
+    def __repr__(self):
+        return 'DhcpTransaction(%s %08x: %s)' % (
+            dhcp_packet.format_mac(self.chaddr), self.xid, self.state,)
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class DhcpLoadReport(object):
+    """The transactions of a single run, with their summary"""
+    def __init__(self, transactions, elapsed):
+        self.transactions = transactions
+        self.elapsed = elapsed
+
+    def summary(self):
+        states = {}
+        retries = 0
+        phase_latencies = {PHASE_DISCOVER: [], PHASE_REQUEST: []}
+        for transaction in self.transactions:
+            states[transaction.state] = states.get(transaction.state, 0) + 1
+            retries += transaction.retries
+            for phase, latency in transaction.latencies.items():
+                phase_latencies[phase].append(latency)
+        leases = states.get(STATE_BOUND, 0) + states.get(STATE_RELEASED, 0)
+        latencies = {}
+        for phase, values in phase_latencies.items():
+            if not values:
+                continue
+            values.sort()
+            latencies[phase] = {
+                'min': values[0],
+                'avg': sum(values) / len(values),
+                'p50': _percentile(values, 0.5),
+                'p95': _percentile(values, 0.95),
+                'max': values[-1],
+            }
+        return {
+            'clients': len(self.transactions),
+            'states': states,
+            'leases': leases,
+            'retries': retries,
+            'elapsed': self.elapsed,
+            'leases_per_minute': (leases * 60 / self.elapsed
+                                  if self.elapsed else 0.0),
+            'latencies': latencies,
+        }
+
+
+class DHCPClientSimulator(base_handler.ActiveProtocolHandler):
+    """Run complete DHCP exchanges for many simulated clients at once
+
+    Every client gets a random MAC address and xid, and goes through
+    DISCOVER, OFFER, REQUEST and ACK, and then optionally RELEASE. A phase
+    that is not answered within phase_timeout seconds is retried up to
+    retries times. The DISCOVERs of new clients are sent at up to rate per
+    second, while the REQUESTs are sent as soon as the offers arrive.
+    """
+    def __init__(self,
+                 packet_reader,
+                 phase_timeout=DEFAULT_PHASE_TIMEOUT,
+                 retries=DEFAULT_RETRIES):
+        super(DHCPClientSimulator, self).__init__(packet_reader, False)
+        self.phase_timeout = phase_timeout
+        self.retries = retries
+        self._rand = random.Random()
+        self._rand.seed()
+        self._transactions = {}
+        self._deadlines = []
+        self._pending = 0
+        self._release = True
+        self._cond = threading.Condition()
+        self._register_handler(self.get_protocol_name(),
+                               self._handle_dhcp_packet, DHCP.DHCP_MATCH,
+                               raw=True, pkt_types=_REPLY_PKT_TYPES)
+
+    @staticmethod
+    def get_protocol_name():
+        return 'DHCPClient'
+
+    def bind_socket(self):
+        return DHCP.bind_client_socket(self._transport)
+
+    def create_packet(self, transaction):
+        """Build the message of the current phase of the transaction"""
+        secs = min(0xffff, int(time.monotonic() - transaction.started_at))
+        if transaction.state == STATE_SELECTING:
+            option_list = [(dhcp_packet.DHCP_MESSAGE_TYPE_OPT,
+                            _message_type.pack(dhcp_packet.DHCP_DISCOVER))]
+        else:
+            option_list = [
+                (dhcp_packet.DHCP_MESSAGE_TYPE_OPT,
+                 _message_type.pack(dhcp_packet.DHCP_REQUEST)),
+                (dhcp_packet.DHCP_REQUESTED_IP_ADDR_OPT,
+                 _ipv4_address.pack(transaction.offered_ip)),
+                (dhcp_packet.DHCP_SERVER_IDENTIFIER_OPT,
+                 _ipv4_address.pack(transaction.server_ip)),
+            ]
+        option_list.append((dhcp_packet.DHCP_PARAMETER_REQUEST_LIST_OPT,
+                            _PARAMETER_REQUEST_LIST))
+        message = dhcp_packet.build_message(
+            dhcp_packet.DHCP_BOOT_REQUEST, transaction.xid,
+            transaction.chaddr, option_list,
+            flags=dhcp_packet.BOOTP_FLAG_BROADCAST, secs=secs)
+        return packet_template.build_udp_frame(
+            DHCP.MAC_BROADCAST, dhcp_packet.format_mac(transaction.chaddr),
+            DHCP.IP_BROADCAST, DHCP.IP_ANY,
+            DHCP.DHCP_SERVER_PORT, DHCP.DHCP_CLIENT_PORT, message,
+            tos=DHCP.IPTOS_LOWDELAY, ttl=16)
+
+    def _create_release(self, transaction):
+        option_list = [
+            (dhcp_packet.DHCP_MESSAGE_TYPE_OPT,
+             _message_type.pack(dhcp_packet.DHCP_RELEASE)),
+            (dhcp_packet.DHCP_SERVER_IDENTIFIER_OPT,
+             _ipv4_address.pack(transaction.server_ip)),
+        ]
+        message = dhcp_packet.build_message(
+            dhcp_packet.DHCP_BOOT_REQUEST, self._rand.randint(0, 0xffffffff),
+            transaction.chaddr, option_list, ciaddr=transaction.offered_ip)
+        return packet_template.build_udp_frame(
+            dhcp_packet.format_mac(transaction.server_mac),
+            dhcp_packet.format_mac(transaction.chaddr),
+            address_set.int_to_ip(transaction.server_ip),
+            address_set.int_to_ip(transaction.offered_ip),
+            DHCP.DHCP_SERVER_PORT, DHCP.DHCP_CLIENT_PORT, message)
+
+    def _send(self, packet):
+        try:
+            self.send_packet(packet)
+        except OSError as e:
+            LOG.error('Failed sending DHCP client message')
+            LOG.exception(e)
+
+    def _start_phase(self, transaction, now):
+        transaction.attempts += 1
+        transaction.sent_at = now
+        transaction.deadline = now + self.phase_timeout
+        heapq.heappush(self._deadlines,
+                       (transaction.deadline, transaction.xid))
+        return self.create_packet(transaction)
+
+    def _new_transaction(self, now):
+        xid = self._rand.randint(0, 0xffffffff)
+        while xid in self._transactions:
+            xid = self._rand.randint(0, 0xffffffff)
+        transaction = DhcpTransaction(_random_mac(self._rand), xid, now)
+        self._transactions[xid] = transaction
+        self._pending += 1
+        return self._start_phase(transaction, now)
+
+    def _finish(self, transaction, state):
+        transaction.state = state
+        self._pending -= 1
+        self._cond.notify_all()
+
+    def _expire_transactions(self, now):
+        packets = []
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, xid = heapq.heappop(deadlines)
+            transaction = self._transactions[xid]
+            # Deadlines of phases that were answered are left in the heap
+            if transaction.is_done or transaction.deadline != deadline:
+                continue
+            if transaction.attempts > self.retries:
+                LOG.debug('%s timed out in %s', transaction,
+                          transaction.phase)
+                self._finish(transaction, STATE_TIMED_OUT)
+                continue
+            transaction.retries += 1
+            packets.append(self._start_phase(transaction, now))
+        return packets
+
+    def run(self, clients, rate=DEFAULT_RATE, release=True):
+        """Run the exchanges of the given number of clients
+
+        Returns a DhcpLoadReport once every exchange completed or timed out.
+        """
+        bucket = rate_limiter.TokenBucket(rate)
+        started = time.monotonic()
+        with self._cond:
+            self._transactions = {}
+            self._deadlines = []
+            self._pending = 0
+            self._release = release
+        to_start = clients
+        while True:
+            now = time.monotonic()
+            with self._cond:
+                packets = self._expire_transactions(now)
+                while to_start and bucket.try_consume():
+                    packets.append(self._new_transaction(now))
+                    to_start -= 1
+                if not to_start and not self._pending:
+                    break
+                if not packets:
+                    wait_until = [deadline for deadline, _xid
+                                  in self._deadlines[:1]]
+                    if to_start:
+                        wait_until.append(now + 1 / bucket.rate)
+                    self._cond.wait(max(0, min(wait_until) - now))
+            for packet in packets:
+                self._send(packet)
+        with self._cond:
+            transactions = list(self._transactions.values())
+        return DhcpLoadReport(transactions, time.monotonic() - started)
+
+    def _handle_offer(self, transaction, message, now):
+        if transaction.state != STATE_SELECTING:
+            # Only the first offer is taken
+            return None
+        server_ip = message.options.get(
+            dhcp_packet.DHCP_SERVER_IDENTIFIER_OPT)
+        if server_ip is None or len(server_ip) != _ipv4_address.size:
+            LOG.debug('Offer for %s has no server identifier', transaction)
+            return None
+        transaction.server_ip, = _ipv4_address.unpack(server_ip)
+        transaction.server_mac = message.src_mac
+        transaction.offered_ip = message.yiaddr
+        transaction.latencies[PHASE_DISCOVER] = now - transaction.sent_at
+        transaction.state = STATE_REQUESTING
+        transaction.attempts = 0
+        return self._start_phase(transaction, now)
+
+    def _handle_ack(self, transaction, message, now):
+        if transaction.state != STATE_REQUESTING:
+            return None
+        transaction.latencies[PHASE_REQUEST] = now - transaction.sent_at
+        lease_time = message.options.get(
+            dhcp_packet.DHCP_IP_ADDR_LEASE_TIME_OPT)
+        if lease_time is not None and len(lease_time) == 4:
+            transaction.lease_time, = _ipv4_address.unpack(lease_time)
+        if not self._release:
+            self._finish(transaction, STATE_BOUND)
+            return None
+        # Nothing answers a release
+        self._finish(transaction, STATE_RELEASED)
+        return self._create_release(transaction)
+
+    def _handle_dhcp_packet(self, data):
+        message = dhcp_packet.parse(data, _OPTION_TAGS)
+        if message is None or message.op != dhcp_packet.DHCP_BOOT_REPLY:
+            return
+        now = time.monotonic()
+        packet = None
+        with self._cond:
+            transaction = self._transactions.get(message.xid)
+            if transaction is None or transaction.chaddr != message.chaddr:
+                return
+            if message.message_type == dhcp_packet.DHCP_OFFER:
+                packet = self._handle_offer(transaction, message, now)
+            elif message.message_type == dhcp_packet.DHCP_ACK:
+                packet = self._handle_ack(transaction, message, now)
+            elif (message.message_type == dhcp_packet.DHCP_NAK and
+                  transaction.state == STATE_REQUESTING):
+                transaction.latencies[PHASE_REQUEST] = \
+                    now - transaction.sent_at
+                self._finish(transaction, STATE_NAKED)
+        if packet:
+            self._send(packet)
+
+    def close_resource(self):
+        self._unregister_handler(self.get_protocol_name(),
+                                 self._handle_dhcp_packet)
@@ -0,0 +1,323 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import math
+import struct
+import threading
+import time
+import zlib
+
+from zaphod.common import address_set
+from zaphod.common import packet_reader
+from zaphod.common import protocol_errors
+from zaphod.protocols import base_handler
+from zaphod.protocols import dhcp_packet
+from zaphod.protocols import DHCP
+from zaphod.common import logger
+LOG = logger.get_logger(__name__)
+
+DEFAULT_MAX_SERVERS = 1024
+DEFAULT_IDLE_TIMEOUT = 3600
+# The time constant of the offer rate average, in seconds
+OFFER_RATE_PERIOD = 60.0
+
+EVENT_OFFER = 'offer'
+EVENT_ACK = 'ack'
+EVENT_NAK = 'nak'
+
+_EVENT_TYPES = {
+    dhcp_packet.DHCP_OFFER: EVENT_OFFER,
+    dhcp_packet.DHCP_ACK: EVENT_ACK,
+    dhcp_packet.DHCP_NAK: EVENT_NAK,
+}
+
+# The options that make up the configuration handed out by a server. Only
+# the options servers send whatever the client asked for (in its parameter
+# request list) are included, so clients asking for different options do
+# not change the fingerprint. The server identifier is checked on its own.
+FINGERPRINT_OPTIONS = (
+    dhcp_packet.DHCP_IP_ADDR_LEASE_TIME_OPT,
+    dhcp_packet.DHCP_SUBNET_MASK_OPT,
+    dhcp_packet.DHCP_GATEWAY_ADDR_OPT,
+)
+_OPTION_TAGS = frozenset(FINGERPRINT_OPTIONS +
+                         (dhcp_packet.DHCP_SERVER_IDENTIFIER_OPT,))
+
+# Offers to other clients are usually broadcast
+MONITORED_PKT_TYPES = packet_reader.PKT_TYPES_ALL
+
+_ipv4_address = struct.Struct('!I')
+_option_header = struct.Struct('!BB')
+
+
+class DhcpServerEntry(object):
+    """What the monitor knows about a single DHCP server
+
+    The MAC and addresses are integers, and the offered ranges are
+    (first, last) integer ranges. The fingerprints of the configuration
+    the server hands out are kept by fingerprint key.
+    """
+    __slots__ = ('mac', 'server_ip', 'fingerprints', 'offered_ranges',
+                 'first_seen', 'last_seen', 'offers', 'acks', 'naks',
+                 'offer_rate', 'offer_rate_at')
+
+    def __init__(self, mac, server_ip, now):
+        self.mac = mac
+        self.server_ip = server_ip
+        self.fingerprints = {}
+        self.offered_ranges = set()
+        self.first_seen = now
+        self.last_seen = now
+        self.offers = 0
+        self.acks = 0
+        self.naks = 0
+        # Offers per second, averaged over OFFER_RATE_PERIOD
+        self.offer_rate = 0.0
+        self.offer_rate_at = now
+
+    def update_offer_rate(self, now):
+        decay = math.exp(-(now - self.offer_rate_at) / OFFER_RATE_PERIOD)
+        self.offer_rate = self.offer_rate * decay + 1 / OFFER_RATE_PERIOD
+        self.offer_rate_at = now
+
+    def to_dict(self):
+        return {
+            'mac': address_set.int_to_mac(self.mac),
+            'server_ip': address_set.int_to_ip(self.server_ip),
+            'offered_ranges': [address_set.range_to_cidr(first, last)
+                               for first, last in sorted(self.offered_ranges)],
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'offers': self.offers,
+            'acks': self.acks,
+            'naks': self.naks,
+            'offer_rate': self.offer_rate,
+        }
+
+
+class DhcpEvent(object):
+    """An OFFER, ACK or NAK seen on the wire"""
+    __slots__ = ('event_type', 'timestamp', 'server_mac', 'server_ip',
+                 'client_mac', 'xid', 'yiaddr')
+
+    def __init__(self, event_type, timestamp, server_mac, server_ip,
+                 client_mac, xid, yiaddr):
+        self.event_type = event_type
+        self.timestamp = timestamp
+        self.server_mac = server_mac
+        self.server_ip = server_ip
+        self.client_mac = client_mac
+        self.xid = xid
+        self.yiaddr = yiaddr
+
+    def __repr__(self):
+        return 'DhcpEvent(%s from %s to %s: %s)' % (
+            self.event_type, address_set.int_to_mac(self.server_mac),
+            address_set.int_to_mac(self.client_mac),
+            address_set.int_to_ip(self.yiaddr),)
+
+
+def _fingerprint_key(message):
+    # Servers hand out a different configuration to every subnet (told by
+    # the relay agent the message went through), and the ACKs to INFORMs
+    # (with no address) carry no lease time
+    return message.giaddr, message.message_type, not message.yiaddr
+
+
+def _fingerprint(options):
+    fingerprint = 0
+    for tag in FINGERPRINT_OPTIONS:
+        value = options.get(tag)
+        if value is not None:
+            fingerprint = zlib.crc32(_option_header.pack(tag, len(value)),
+                                     fingerprint)
+            fingerprint = zlib.crc32(value, fingerprint)
+    return fingerprint
+
+
+class DHCPMonitor(base_handler.ProtocolHandler):
+    """Passively watch the DHCP servers answering on an interface
+
+    Every OFFER, ACK and NAK updates a table of the servers seen, and is
+    passed to the event callbacks. A server that is not in allowed_servers
+    is reported when it is first seen (or learned, in learn mode), and a
+    known server is reported when its server identifier or the
+    configuration it hands out changes. The table holds up to max_servers
+    entries, and entries idle for idle_timeout seconds are dropped, least
+    recently seen first.
+
+    Offers that are broadcast to other clients are always seen. The unicast
+    ones are only seen if promiscuous is set.
+    """
+    def __init__(self,
+                 packet_reader,
+                 allowed_servers=(),
+                 allowed_dhcp_ranges=(),
+                 max_servers=DEFAULT_MAX_SERVERS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 promiscuous=False):
+        super(DHCPMonitor, self).__init__(packet_reader, True)
+        self.allowed_servers = address_set.AddressSet(
+            allowed_servers, address_set.mac_to_int, address_set.int_to_mac)
+        self.allowed_dhcp_ranges = address_set.NetworkTable(
+            allowed_dhcp_ranges)
+        self.max_servers = max_servers
+        self.idle_timeout = idle_timeout
+        self._servers = collections.OrderedDict()
+        self._servers_lock = threading.Lock()
+        self._event_callbacks = []
+        self._promiscuous = (promiscuous and packet_reader.is_ready and
+                             packet_reader.set_promiscuous(True))
+        self._register_handler(self.get_protocol_name(),
+                               self._handle_dhcp_packet, DHCP.DHCP_MATCH,
+                               raw=True, pkt_types=MONITORED_PKT_TYPES)
+
+    @staticmethod
+    def get_protocol_name():
+        return 'DHCPMonitor'
+
+    @property
+    def is_ready(self):
+        return self._packet_reader.is_ready
+
+    def register_event_callback(self, callback):
+        self._event_callbacks.append(callback)
+
+    def unregister_event_callback(self, callback):
+        self._event_callbacks.remove(callback)
+
+    def get_servers(self):
+        """A snapshot of the server table, least recently seen first"""
+        with self._servers_lock:
+            return [entry.to_dict() for entry in self._servers.values()]
+
+    def _emit_event(self, event):
+        for callback in self._event_callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                LOG.error('Exception in event callback')
+                LOG.exception(e)
+
+    def _evict_servers(self, now):
+        servers = self._servers
+        idle_since = now - self.idle_timeout
+        while servers:
+            mac, entry = next(iter(servers.items()))
+            if (len(servers) <= self.max_servers and
+                    entry.last_seen > idle_since):
+                break
+            LOG.debug('Dropping DHCP server %s from the table',
+                      address_set.int_to_mac(mac))
+            del servers[mac]
+
+    def _check_fingerprint(self, entry, fingerprint_key, fingerprint,
+                           errors):
+        known_fingerprint = entry.fingerprints.get(fingerprint_key)
+        if known_fingerprint == fingerprint:
+            return
+        if known_fingerprint is not None:
+            errors.append(protocol_errors.ChangedServer(
+                self.__class__, address_set.int_to_mac(entry.mac),
+                'options'))
+        entry.fingerprints[fingerprint_key] = fingerprint
+
+    def _check_server(self, server_mac, server_ip, now, errors):
+        entry = self._servers.get(server_mac)
+        if entry is None:
+            entry = DhcpServerEntry(server_mac, server_ip, now)
+            self._servers[server_mac] = entry
+            if server_mac in self.allowed_servers:
+                pass
+            elif self.learn:
+                LOG.debug('Learned server MAC: %s',
+                          address_set.int_to_mac(server_mac))
+                self.allowed_servers.add(server_mac)
+            elif self.allowed_servers:
+                errors.append(protocol_errors.RogueServer(
+                    self.__class__, address_set.int_to_mac(server_mac),
+                    address_set.int_to_ip(server_ip)))
+            self._evict_servers(now)
+            return entry
+        self._servers.move_to_end(server_mac)
+        if entry.server_ip != server_ip:
+            errors.append(protocol_errors.ChangedServer(
+                self.__class__, address_set.int_to_mac(server_mac),
+                'server identifier'))
+            entry.server_ip = server_ip
+        return entry
+
+    def _record_offer(self, entry, message, now, errors):
+        mask = message.options.get(dhcp_packet.DHCP_SUBNET_MASK_OPT)
+        if mask is not None and len(mask) == _ipv4_address.size:
+            mask, = _ipv4_address.unpack(mask)
+            entry.offered_ranges.add(
+                address_set.mask_range(message.yiaddr, mask))
+        if (self.allowed_dhcp_ranges and
+                not self.allowed_dhcp_ranges.contains_address(
+                    message.yiaddr)):
+            errors.append(protocol_errors.InvalidIPAddress(
+                self.__class__, address_set.int_to_ip(message.yiaddr)))
+        entry.update_offer_rate(now)
+        entry.offers += 1
+
+    def _handle_dhcp_packet(self, data):
+        message = dhcp_packet.parse(data, _OPTION_TAGS)
+        if message is None or message.op != dhcp_packet.DHCP_BOOT_REPLY:
+            return
+        event_type = _EVENT_TYPES.get(message.message_type)
+        if event_type is None:
+            return
+        server_mac = int.from_bytes(message.src_mac, 'big')
+        server_ip = message.options.get(dhcp_packet.DHCP_SERVER_IDENTIFIER_OPT)
+        if server_ip is not None and len(server_ip) == _ipv4_address.size:
+            server_ip, = _ipv4_address.unpack(server_ip)
+        else:
+            server_ip = message.src_ip
+        now = time.time()
+        errors = []
+        with self._servers_lock:
+            entry = self._check_server(server_mac, server_ip, now, errors)
+            # NAKs carry no configuration, so they are not fingerprinted
+            if event_type != EVENT_NAK:
+                self._check_fingerprint(entry, _fingerprint_key(message),
+                                        _fingerprint(message.options),
+                                        errors)
+            if event_type == EVENT_OFFER:
+                self._record_offer(entry, message, now, errors)
+            elif event_type == EVENT_ACK:
+                entry.acks += 1
+            else:
+                entry.naks += 1
+            entry.last_seen = now
+        self._emit_event(DhcpEvent(event_type, now, server_mac, server_ip,
+                                   int.from_bytes(message.chaddr, 'big'),
+                                   message.xid, message.yiaddr))
+        if errors:
+            self._emit_results(errors)
+
+    def export_learned_state(self):
+        return {'servers': self.allowed_servers.to_strings()}
+
+    def import_learned_state(self, state):
+        for mac in state.get('servers', ()):
+            self.allowed_servers.add(mac)
+
+    def close_resource(self):
+        self._unregister_handler(self.get_protocol_name(),
+                                 self._handle_dhcp_packet)
+        if self._promiscuous:
+            self._packet_reader.set_promiscuous(False)
@@ -0,0 +1,178 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+from zaphod.common import packet_filter
+
+DHCP_BOOT_REQUEST = 1
+DHCP_BOOT_REPLY = 2
+
+DHCP_DISCOVER = 1
+DHCP_OFFER = 2
+DHCP_REQUEST = 3
+DHCP_DECLINE = 4
+DHCP_ACK = 5
+DHCP_NAK = 6
+DHCP_RELEASE = 7
+DHCP_INFORM = 8
+
+DHCP_PAD_OPT = 0
+DHCP_SUBNET_MASK_OPT = 1
+DHCP_GATEWAY_ADDR_OPT = 3
+DHCP_TIME_SERVER_OPT = 4
+DHCP_DNS_SERVER_ADDR_OPT = 6
+DHCP_HOST_NAME_OPT = 12
+DHCP_DOMAIN_NAME_OPT = 15
+DHCP_MTU_OPT = 26
+DHCP_STATIC_ROUTE_OPT = 33
+DHCP_REQUESTED_IP_ADDR_OPT = 50
+DHCP_IP_ADDR_LEASE_TIME_OPT = 51
+DHCP_MESSAGE_TYPE_OPT = 53
+DHCP_SERVER_IDENTIFIER_OPT = 54
+DHCP_PARAMETER_REQUEST_LIST_OPT = 55
+DHCP_END_OPT = 255
+
+DHCP_MAGIC_COOKIE = b'\x63\x82\x53\x63'
+
+BOOTP_HTYPE_ETHERNET = 1
+BOOTP_FLAG_BROADCAST = 0x8000
+
+# The fixed BOOTP header, up to and including the magic cookie
+_bootp_header = struct.Struct('!BBBBIHHIIII16s64s128s4s')
+# op, xid, ciaddr, yiaddr, siaddr, giaddr
+_bootp_fields = struct.Struct('!B3xI4xIIII')
+_UDP_HLEN = 8
+_udp_length = struct.Struct('!H')
+_ipv4_address = struct.Struct('!I')
+_option_header = struct.Struct('!BB')
+_END_OPTION = struct.pack('!B', DHCP_END_OPT)
+
+
+class DhcpMessage(object):
+    """The fields of a received DHCP message
+
+    The addresses are integers and the MACs are bytes. The option values
+    are views into the received frame, so they are only valid while the
+    frame is being handled.
+    """
+    __slots__ = ('src_mac', 'dst_mac', 'src_ip', 'dst_ip', 'op', 'xid',
+                 'ciaddr', 'yiaddr', 'siaddr', 'giaddr', 'chaddr',
+                 'message_type', 'options')
+
+    def __init__(self, src_mac, dst_mac, src_ip, dst_ip, op, xid, ciaddr,
+                 yiaddr, siaddr, giaddr, chaddr, message_type, options):
+        self.src_mac = src_mac
+        self.dst_mac = dst_mac
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.op = op
+        self.xid = xid
+        self.ciaddr = ciaddr
+        self.yiaddr = yiaddr
+        self.siaddr = siaddr
+        self.giaddr = giaddr
+        self.chaddr = chaddr
+        self.message_type = message_type
+        self.options = options
+
+
+def format_mac(mac):
+    return ':'.join('%02x' % (octet,) for octet in bytearray(mac))
+
+
+def build_options(option_list):
+    """Encode a list of (tag, value) options, ending with the end option"""
+    return b''.join(_option_header.pack(tag, len(value)) + value
+                    for tag, value in option_list) + _END_OPTION
+
+
+def build_message(op, xid, chaddr, option_list, flags=0, secs=0, ciaddr=0,
+                  yiaddr=0, siaddr=0, giaddr=0):
+    """Encode a DHCP message, from its BOOTP header to the end option
+
+    The addresses are integers, and chaddr is the client MAC as bytes.
+    """
+    return _bootp_header.pack(op, BOOTP_HTYPE_ETHERNET, len(chaddr), 0, xid,
+                              secs, flags, ciaddr, yiaddr, siaddr, giaddr,
+                              chaddr, b'', b'', DHCP_MAGIC_COOKIE) + \
+        build_options(option_list)
+
+
+def _parse_options(data, offset, end, option_tags):
+    options = {}
+    message_type = None
+    while offset < end:
+        tag = data[offset]
+        if tag == DHCP_END_OPT:
+            break
+        if tag == DHCP_PAD_OPT:
+            offset += 1
+            continue
+        if offset + 2 > end:
+            return None, None
+        length = data[offset + 1]
+        offset += 2
+        if offset + length > end:
+            return None, None
+        if tag == DHCP_MESSAGE_TYPE_OPT and length:
+            message_type = data[offset]
+        elif option_tags is None or tag in option_tags:
+            value = data[offset:offset + length]
+            if tag in options:
+                # Long options are split between multiple instances
+                value = bytes(options[tag]) + bytes(value)
+            options[tag] = value
+        offset += length
+    return message_type, options
+
+
+def parse(frame, option_tags=None):
+    """Decode a DHCP message from a raw ethernet frame
+
+    Only the options whose tags are in option_tags are kept (all of them if
+    option_tags is None), in a single pass over the option list. Returns a
+    DhcpMessage, or None if the frame is not a valid DHCP message.
+    """
+    data = memoryview(frame)
+    frame_key = packet_filter.classify(data)
+    if (not frame_key or frame_key[1] != packet_filter.IPPROTO_UDP or
+            frame_key[2] is None):
+        return None
+    _ethertype, ip_offset = packet_filter.get_network_header(data)
+    udp_offset = ip_offset + (data[ip_offset] & 0x0f) * 4
+    # classify only checked the ports are there
+    if len(data) < udp_offset + _UDP_HLEN:
+        return None
+    udp_len, = _udp_length.unpack_from(data, udp_offset + 4)
+    end = min(len(data), udp_offset + udp_len)
+    offset = udp_offset + _UDP_HLEN
+    options_offset = offset + _bootp_header.size
+    if options_offset > end:
+        return None
+    if data[options_offset - 4:options_offset] != DHCP_MAGIC_COOKIE:
+        return None
+    op, xid, ciaddr, yiaddr, siaddr, giaddr = \
+        _bootp_fields.unpack_from(data, offset)
+    message_type, options = _parse_options(data, options_offset, end,
+                                           option_tags)
+    if options is None:
+        return None
+    src_ip, = _ipv4_address.unpack_from(data, ip_offset + 12)
+    dst_ip, = _ipv4_address.unpack_from(data, ip_offset + 16)
+    return DhcpMessage(bytes(data[6:12]), bytes(data[0:6]), src_ip, dst_ip,
+                       op, xid, ciaddr, yiaddr, siaddr, giaddr,
+                       bytes(data[offset + 28:offset + 34]), message_type,
+                       options)
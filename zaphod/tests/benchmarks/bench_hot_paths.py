@@ -0,0 +1,303 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of the packet hot paths
+
+The benchmarks need no network access or privileges: the frames are
+built in memory, and the handlers are fed through an offline reader
+replaying a capture of the same frames, or through a reader on an
+in-memory transport. Run with:
+
+    python -m zaphod.tests.benchmarks.bench_hot_paths -o results.json
+
+The results are written as JSON, and every benchmark that is slower than
+its threshold (or than a baseline run, with --baseline) is reported as a
+regression, failing the run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+import timeit
+
+from zaphod.common import address_set
+from zaphod.common import logger
+from zaphod.common import packet_reader
+from zaphod.common import pcap_reader
+from zaphod.common import transport
+from zaphod.protocols import ARP
+from zaphod.protocols import DHCP
+from zaphod.protocols import dhcp_packet
+from zaphod.tests import frames as test_frames
+
+DEFAULT_THRESHOLDS = os.path.join(os.path.dirname(__file__),
+                                  'thresholds.json')
+DEFAULT_REPEAT = 5
+DEFAULT_MIN_TIME = 0.2
+DEFAULT_TOLERANCE = 0.25
+# Frames injected into the in-memory transport per operation
+TRANSPORT_BATCH = 64
+
+
+class HotPathBenchmarks(object):
+    """The benchmarks, each returning the time of a single operation"""
+
+    def __init__(self, workdir, repeat=DEFAULT_REPEAT,
+                 min_time=DEFAULT_MIN_TIME, capture_frames=3000):
+        self.repeat = repeat
+        self.min_time = min_time
+        self.dhcp_offer = test_frames.build_dhcp_offer()
+        self.arp_reply = test_frames.build_arp_reply()
+        self.other_frame = test_frames.build_other_frame()
+        self.capture_path = os.path.join(workdir, 'bench.pcap')
+        frames = (self.dhcp_offer, self.arp_reply, self.other_frame)
+        pcap_reader.write_pcap(self.capture_path,
+                               [frames[index % len(frames)]
+                                for index in range(capture_frames)])
+        # The handlers send to memory, so create_packet works offline
+        self.transport = self._create_transport()
+        self.reader = pcap_reader.PcapReader(self.capture_path,
+                                             transport=self.transport)
+        self.dhcp_proto, self.arp_proto = self._create_handlers(self.reader)
+        # Large enough allow-lists that lookups are not trivially cheap
+        self.network_table = address_set.NetworkTable(
+            '10.%d.%d.0/24' % (index // 256, index % 256)
+            for index in range(0, 4096, 2))
+        self.address_set = address_set.AddressSet(
+            '10.1.%d.%d' % (index // 256, index % 256)
+            for index in range(4096))
+
+    @staticmethod
+    def _create_transport():
+        return transport.MemoryTransport(iface_mac=test_frames.LOCAL_MAC,
+                                         iface_ip=test_frames.LOCAL_IP)
+
+    @staticmethod
+    def _create_handlers(reader):
+        dhcp_proto = DHCP.DHCPProto(
+            reader, True, allowed_servers=[test_frames.SERVER_MAC],
+            allowed_dhcp_ranges=['10.0.0.0/24'],
+            allowed_gateways=[test_frames.GATEWAY_IP],
+            allowed_dns_servers=[test_frames.DNS_IP])
+        arp_proto = ARP.ARPProto(
+            reader, True,
+            known_addresses={test_frames.SERVER_IP: test_frames.SERVER_MAC})
+        return dhcp_proto, arp_proto
+
+    def close(self):
+        self.dhcp_proto.close()
+        self.arp_proto.close()
+        self.reader.close()
+        self.transport.close()
+
+    def _time(self, func):
+        timer = timeit.Timer(func)
+        number, elapsed = timer.autorange()
+        while elapsed < self.min_time:
+            number *= 2
+            elapsed = timer.timeit(number)
+        best = min(timer.repeat(self.repeat, number)) / number
+        return best, number
+
+    def bench_dispatch_unmatched(self):
+        return self._time(lambda: self.reader._handle_packet_in(
+            self.other_frame, socket.PACKET_HOST))
+
+    def bench_dispatch_dhcp(self):
+        return self._time(lambda: self.reader._handle_packet_in(
+            self.dhcp_offer, socket.PACKET_HOST))
+
+    def bench_dispatch_arp(self):
+        return self._time(lambda: self.reader._handle_packet_in(
+            self.arp_reply, socket.PACKET_HOST))
+
+    def bench_dhcp_parse(self):
+        return self._time(lambda: dhcp_packet.parse(self.dhcp_offer))
+
+    def bench_dhcp_handler(self):
+        return self._time(
+            lambda: self.dhcp_proto._handle_dhcp_packet(self.dhcp_offer))
+
+    def bench_arp_handler(self):
+        packet = packet_reader._parse_packet(self.arp_reply)
+        return self._time(lambda: self.arp_proto._handle_arp_packet(packet))
+
+    def bench_dhcp_create_packet(self):
+        def create_packet():
+            self.dhcp_proto.create_packet()
+            # Do not let the tracked requests pile up
+            self.dhcp_proto._requests.clear()
+        return self._time(create_packet)
+
+    def bench_arp_create_packet(self):
+        return self._time(
+            lambda: self.arp_proto.create_packet(test_frames.SERVER_IP))
+
+    def bench_network_table_lookup(self):
+        addresses = [address_set.ip_to_int('10.%d.%d.1' % (index // 16, index))
+                     for index in range(256)]
+        table = self.network_table
+        return self._time(lambda: [table.contains_address(address)
+                                   for address in addresses])
+
+    def bench_address_set_lookup(self):
+        addresses = [address_set.ip_to_int('10.1.%d.1' % (index,))
+                     for index in range(256)]
+        addresses_set = self.address_set
+        return self._time(lambda: [address in addresses_set
+                                   for address in addresses])
+
+    def bench_pcap_replay(self):
+        # Timed per frame, so the result is in frames per second
+        elapsed = []
+        for _index in range(self.repeat):
+            start = time.perf_counter()
+            stats = self.reader.replay()
+            elapsed.append(time.perf_counter() - start)
+        return min(elapsed) / stats.frames, stats.frames
+
+    def bench_memory_transport(self):
+        # Inject a batch and drain it through a PacketReader, timed per
+        # frame, including the socket pair round trip
+        mem_transport = self._create_transport()
+        reader = packet_reader.PacketReader(transport=mem_transport,
+                                            read_timeout=0)
+        handlers = self._create_handlers(reader)
+        frames = [(self.dhcp_offer, self.arp_reply, self.other_frame)[
+            index % 3] for index in range(TRANSPORT_BATCH)]
+
+        def inject_and_read():
+            for frame in frames:
+                mem_transport.inject(frame)
+            for _frame in frames:
+                reader.read_pending()
+        try:
+            return self._time(inject_and_read)
+        finally:
+            for handler in handlers:
+                handler.close()
+            reader.close()
+            mem_transport.close()
+
+    # The lookup benchmarks check 256 addresses per operation
+    OPS_PER_CALL = {
+        'network_table_lookup': 256,
+        'address_set_lookup': 256,
+        'memory_transport': TRANSPORT_BATCH,
+    }
+
+    def run(self, names=None):
+        results = {}
+        for attr in sorted(dir(self)):
+            if not attr.startswith('bench_'):
+                continue
+            name = attr[len('bench_'):]
+            if names and name not in names:
+                continue
+            op_time, number = getattr(self, attr)()
+            op_time /= self.OPS_PER_CALL.get(name, 1)
+            results[name] = {
+                'ops_per_second': 1.0 / op_time,
+                'usec_per_op': op_time * 1e6,
+                'iterations': number,
+            }
+        return results
+
+
+def check_regressions(results, thresholds, baseline=None,
+                      tolerance=DEFAULT_TOLERANCE):
+    """Return the benchmarks that are slower than their thresholds
+
+    thresholds maps benchmark names to their minimal ops per second. If
+    baseline results are given, a benchmark is also a regression if it is
+    more than tolerance slower than in the baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        ops = result['ops_per_second']
+        minimum = thresholds.get(name)
+        if minimum is not None and ops < minimum:
+            regressions.append({'benchmark': name, 'ops_per_second': ops,
+                                'threshold': minimum})
+        if baseline and name in baseline:
+            minimum = baseline[name]['ops_per_second'] * (1 - tolerance)
+            if ops < minimum:
+                regressions.append({'benchmark': name, 'ops_per_second': ops,
+                                    'baseline': minimum})
+    return regressions
+
+
+def _load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the packet hot paths')
+    parser.add_argument('-o', '--output',
+                        help='File to write the JSON results to')
+    parser.add_argument('-t', '--thresholds', default=DEFAULT_THRESHOLDS,
+                        help='JSON file of minimal ops per second')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON results of a previous run to compare to')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed slowdown relative to the baseline')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Keep the debug logs, which are timed as well')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run (default: all)')
+    args = parser.parse_args(argv)
+    if not args.verbose:
+        logger.set_log_level(logger.WARN)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        benchmarks = HotPathBenchmarks(workdir, repeat=args.repeat)
+        try:
+            results = benchmarks.run(args.benchmarks)
+        finally:
+            benchmarks.close()
+
+    thresholds = _load_json(args.thresholds) if args.thresholds else {}
+    baseline = None
+    if args.baseline:
+        baseline = _load_json(args.baseline)['benchmarks']
+    regressions = check_regressions(results, thresholds, baseline,
+                                    args.tolerance)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'benchmarks': results,
+        'regressions': regressions,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    for name, result in sorted(results.items()):
+        print('%-24s %12.0f ops/s %10.2f usec' % (
+            name, result['ops_per_second'], result['usec_per_op'],))
+    for regression in regressions:
+        print('REGRESSION: %s' % (regression,))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from zaphod.common import address_set
+
+
+class TestConversions(unittest.TestCase):
+
+    def test_ip(self):
+        self.assertEqual(0x0a000001, address_set.ip_to_int('10.0.0.1'))
+        self.assertEqual(0x0a000001, address_set.ip_to_int(0x0a000001))
+        self.assertEqual('10.0.0.1', address_set.int_to_ip(0x0a000001))
+
+    def test_mac(self):
+        mac = '02:00:5e:10:00:ff'
+        self.assertEqual(0x02005e1000ff, address_set.mac_to_int(mac))
+        self.assertEqual(mac, address_set.int_to_mac(0x02005e1000ff))
+
+    def test_ranges(self):
+        first, last = address_set.network_range('10.0.1.0/24')
+        self.assertEqual((0x0a000100, 0x0a0001ff), (first, last))
+        self.assertEqual((first, last), address_set.network_range(
+            (first, last)))
+        self.assertEqual((first, last), address_set.mask_range(
+            0x0a000142, 0xffffff00))
+        self.assertEqual('10.0.1.0/24', address_set.range_to_cidr(first,
+                                                                  last))
+
+
+class TestAddressSet(unittest.TestCase):
+
+    def test_ips(self):
+        addresses = address_set.AddressSet(['10.0.0.2', '10.0.0.1'])
+        self.assertIn(0x0a000001, addresses)
+        self.assertNotIn(0x0a000003, addresses)
+        addresses.add('10.0.0.3')
+        self.assertIn(0x0a000003, addresses)
+        self.assertEqual(3, len(addresses))
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+                         addresses.to_strings())
+
+    def test_macs(self):
+        macs = address_set.AddressSet(['02:00:00:00:00:01'],
+                                      address_set.mac_to_int,
+                                      address_set.int_to_mac)
+        self.assertIn(2 << 40 | 1, macs)
+        self.assertEqual('02:00:00:00:00:01', macs.to_string(2 << 40 | 1))
+
+
+class TestNetworkTable(unittest.TestCase):
+
+    def test_contains_address(self):
+        table = address_set.NetworkTable(['10.0.0.0/24', '10.0.2.0/24'])
+        for address, expected in (('9.255.255.255', False),
+                                  ('10.0.0.0', True),
+                                  ('10.0.0.255', True),
+                                  ('10.0.1.0', False),
+                                  ('10.0.2.128', True),
+                                  ('10.0.3.0', False)):
+            self.assertEqual(expected, table.contains_address(
+                address_set.ip_to_int(address)), address)
+
+    def test_overlapping_networks(self):
+        table = address_set.NetworkTable(['10.0.0.0/16', '10.0.5.0/24'])
+        table.add('10.1.0.0/24')
+        self.assertTrue(table.contains_address(
+            address_set.ip_to_int('10.0.5.1')))
+        self.assertTrue(table.contains_address(
+            address_set.ip_to_int('10.1.0.1')))
+        self.assertFalse(table.contains_address(
+            address_set.ip_to_int('10.1.1.1')))
+        # The networks are kept as given, even when merged for lookups
+        self.assertIn('10.0.5.0/24', table)
+        self.assertEqual(['10.0.0.0/16', '10.0.5.0/24', '10.1.0.0/24'],
+                         table.to_strings())
+
+    def test_empty(self):
+        table = address_set.NetworkTable()
+        self.assertFalse(table)
+        self.assertFalse(table.contains_address(0))
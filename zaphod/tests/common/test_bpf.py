@@ -0,0 +1,115 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import unittest
+
+from zaphod.common import bpf
+from zaphod.common import packet_filter
+from zaphod.protocols import DHCP
+from zaphod.tests import frames
+
+_sock_filter = struct.Struct('HBBI')
+
+
+def run_filter(program, frame):
+    """Run a classic BPF program over a frame, returning its verdict
+
+    Only the instructions that compile_matches emits are supported. Loads
+    past the end of the frame drop it, as in the kernel.
+    """
+    insns = [insn for insn in _sock_filter.iter_unpack(program)]
+    acc = index = 0
+    pc = 0
+    while True:
+        code, jt, jf, k = insns[pc]
+        pc += 1
+        try:
+            if code == bpf.BPF_LD_H_ABS:
+                acc, = struct.unpack_from('!H', frame, k)
+            elif code == bpf.BPF_LD_B_ABS:
+                acc = frame[k]
+            elif code == bpf.BPF_LD_H_IND:
+                acc, = struct.unpack_from('!H', frame, index + k)
+            elif code == bpf.BPF_LDX_B_MSH:
+                index = (frame[k] & 0x0f) * 4
+            elif code == bpf.BPF_JEQ_K:
+                pc += jt if acc == k else jf
+            elif code == bpf.BPF_JSET_K:
+                pc += jt if acc & k else jf
+            elif code == bpf.BPF_RET_K:
+                return k
+            else:
+                raise AssertionError('Unexpected opcode %#x' % (code,))
+        except (IndexError, struct.error):
+            return bpf.BPF_DROP
+
+
+class TestCompileMatches(unittest.TestCase):
+
+    def setUp(self):
+        self.dhcp_offer = frames.build_dhcp_offer()
+        self.arp_reply = frames.build_arp_reply()
+        self.dns_query = frames.build_other_frame()
+
+    def _accepts(self, matches, frame):
+        return run_filter(bpf.compile_matches(matches),
+                          frame) == bpf.BPF_ACCEPT
+
+    def test_match_all_needs_no_filter(self):
+        self.assertIsNone(bpf.compile_matches([packet_filter.Match()]))
+
+    def test_no_matches_drops_everything(self):
+        self.assertFalse(self._accepts([], self.dhcp_offer))
+        self.assertFalse(self._accepts([], self.arp_reply))
+
+    def test_ports(self):
+        matches = [DHCP.DHCP_MATCH]
+        self.assertTrue(self._accepts(matches, self.dhcp_offer))
+        self.assertFalse(self._accepts(matches, self.dns_query))
+        self.assertFalse(self._accepts(matches, self.arp_reply))
+
+    def test_ethertype(self):
+        matches = [packet_filter.Match(
+            ethertype=frames.ETH_TYPE_ARP)]
+        self.assertTrue(self._accepts(matches, self.arp_reply))
+        self.assertFalse(self._accepts(matches, self.dhcp_offer))
+
+    def test_any_match_accepts(self):
+        matches = [DHCP.DHCP_MATCH, packet_filter.Match(
+            ethertype=frames.ETH_TYPE_ARP)]
+        self.assertTrue(self._accepts(matches, self.dhcp_offer))
+        self.assertTrue(self._accepts(matches, self.arp_reply))
+        self.assertFalse(self._accepts(matches, self.dns_query))
+
+    def test_ip_proto(self):
+        udp = [packet_filter.Match(ethertype=packet_filter.ETH_TYPE_IP,
+                                   ip_proto=packet_filter.IPPROTO_UDP)]
+        tcp = [packet_filter.Match(ethertype=packet_filter.ETH_TYPE_IP,
+                                   ip_proto=packet_filter.IPPROTO_TCP)]
+        self.assertTrue(self._accepts(udp, self.dns_query))
+        self.assertFalse(self._accepts(tcp, self.dns_query))
+
+    def test_fragments_are_dropped(self):
+        frame = bytearray(self.dhcp_offer)
+        # A non-first fragment has no UDP header to match on
+        struct.pack_into('!H', frame, packet_filter.ETH_HLEN + 6, 0x00b9)
+        self.assertFalse(self._accepts([DHCP.DHCP_MATCH], bytes(frame)))
+
+    def test_vlan_frames_are_left_to_the_classifier(self):
+        frame = (self.dns_query[:12] +
+                 struct.pack('!HH', packet_filter.ETH_TYPE_8021Q, 10) +
+                 self.dns_query[12:])
+        self.assertTrue(self._accepts([DHCP.DHCP_MATCH], frame))
@@ -0,0 +1,128 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_filter
+from zaphod.common import packet_reader
+from zaphod.common import packet_template
+from zaphod.protocols import DHCP
+from zaphod.tests import frames
+
+
+def build_udp_frame(dst_port):
+    return packet_template.build_udp_frame(
+        frames.LOCAL_MAC, frames.SERVER_MAC, frames.LOCAL_IP,
+        frames.SERVER_IP, dst_port, 40000, b'\0' * 32)
+
+
+class TestDispatchTable(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.dispatcher = packet_reader.PacketDispatcher(
+            'test', metrics.Registry())
+        self.calls = []
+
+    def _create_handler(self, name):
+        def handler(data):
+            self.calls.append(name)
+        handler.handler_name = name
+        return handler
+
+    def _register(self, handler, match=DHCP.DHCP_MATCH,
+                  pkt_types=packet_reader.PKT_TYPES_ALL):
+        self.dispatcher.register_protocol_packet_handler(
+            'udp', handler, match, raw=True, pkt_types=pkt_types)
+
+    def test_snapshot(self):
+        first = self._create_handler('first')
+        self._register(first)
+        table = self.dispatcher._dispatch
+        self._register(self._create_handler('second'))
+        # Registering replaces the table, and leaves the old one as it was
+        self.assertIsNot(table, self.dispatcher._dispatch)
+        self.assertEqual([first], [entry.handler for entry in table.entries])
+        self.assertEqual(2, len(self.dispatcher._dispatch.entries))
+
+    def test_registration_order(self):
+        for name in ('first', 'second', 'third'):
+            self._register(self._create_handler(name))
+        self.dispatcher._handle_packet_in(frames.build_dhcp_offer())
+        self.assertEqual(['first', 'second', 'third'], self.calls)
+
+    def test_lookup(self):
+        self._register(self._create_handler('dhcp'))
+        self._register(self._create_handler('host'),
+                       packet_filter.MATCH_ALL, packet_reader.PKT_TYPES_HOST)
+        table = self.dispatcher._dispatch
+
+        def lookup(pkt_type, frame):
+            return [entry.handler.handler_name for entry in table.lookup(
+                pkt_type, packet_filter.classify(frame))]
+
+        offer = frames.build_dhcp_offer()
+        self.assertEqual(['dhcp', 'host'], lookup(socket.PACKET_HOST, offer))
+        self.assertEqual(['dhcp'], lookup(socket.PACKET_BROADCAST, offer))
+        self.assertEqual(['host'], lookup(socket.PACKET_HOST,
+                                          build_udp_frame(53)))
+        self.assertEqual([], lookup(socket.PACKET_BROADCAST,
+                                    build_udp_frame(53)))
+
+    def test_cache_key(self):
+        self._register(self._create_handler('dhcp'))
+        table = self.dispatcher._dispatch
+        for dst_port in (53, 123, 5000):
+            table.lookup(socket.PACKET_HOST, packet_filter.classify(
+                build_udp_frame(dst_port)))
+        # Ports no handler matches on share the same cache entry
+        self.assertEqual(1, len(table._cache))
+        table.lookup(socket.PACKET_HOST, packet_filter.classify(
+            build_udp_frame(DHCP.DHCP_SERVER_PORT)))
+        self.assertEqual(2, len(table._cache))
+
+    def test_unregister(self):
+        first = self._create_handler('first')
+        second = self._create_handler('second')
+        self._register(first)
+        self._register(second)
+        self.dispatcher.unregister_protocol_packet_handler('udp', first)
+        self.dispatcher._handle_packet_in(frames.build_dhcp_offer())
+        self.assertEqual(['second'], self.calls)
+        self.assertRaises(ValueError,
+                          self.dispatcher.unregister_protocol_packet_handler,
+                          'udp', first)
+        self.assertRaises(ValueError,
+                          self.dispatcher.unregister_protocol_packet_handler,
+                          'arp', second)
+
+    def test_unregister_while_dispatching(self):
+        second = self._create_handler('second')
+
+        def first(data):
+            self.calls.append('first')
+            self.dispatcher.unregister_protocol_packet_handler('udp', second)
+
+        self._register(first)
+        self._register(second)
+        # The frame being dispatched still goes to the handlers that were
+        # registered when it arrived
+        self.dispatcher._handle_packet_in(frames.build_dhcp_offer())
+        self.assertEqual(['first', 'second'], self.calls)
+        self.dispatcher._handle_packet_in(frames.build_dhcp_offer())
+        self.assertEqual(['first', 'second', 'first'], self.calls)
@@ -0,0 +1,136 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from zaphod.common import error_aggregator
+from zaphod.common import protocol_errors
+
+
+class FakeProtocol(object):
+
+    @staticmethod
+    def get_protocol_name():
+        return 'Fake'
+
+
+def invalid_ip(index):
+    return protocol_errors.InvalidIPAddress(FakeProtocol,
+                                            '10.0.0.%d' % (index,))
+
+
+class TestErrorAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.notified = []
+
+    def _create(self, **kwargs):
+        aggregator = error_aggregator.ErrorAggregator(**kwargs)
+        aggregator.register_callback(self.notified.append)
+        self.addCleanup(aggregator.close)
+        return aggregator
+
+    def _notified_addresses(self):
+        return [entry.error.ip_address for batch in self.notified
+                for entry in batch]
+
+    def test_repeated_errors_are_merged(self):
+        aggregator = self._create(rate=None)
+        aggregator([invalid_ip(1), invalid_ip(1)])
+        aggregator([invalid_ip(1), invalid_ip(2)])
+        self.assertEqual(['10.0.0.1', '10.0.0.2'],
+                         self._notified_addresses())
+        # The second report was merged before the first was notified
+        self.assertEqual(1, aggregator.suppressed)
+        counts = {entry.error.ip_address: entry.count
+                  for entry in aggregator.get_errors()}
+        self.assertEqual({'10.0.0.1': 3, '10.0.0.2': 1}, counts)
+
+    def test_rate_limit(self):
+        # A rate slow enough that the bucket never refills during the test
+        aggregator = self._create(rate=0.001, burst=3)
+        aggregator([invalid_ip(index) for index in range(10)])
+        self.assertEqual(['10.0.0.0', '10.0.0.1', '10.0.0.2'],
+                         self._notified_addresses())
+        # The held errors stay held while the rate is exceeded
+        aggregator([invalid_ip(10)])
+        aggregator.flush()
+        self.assertEqual(3, len(self._notified_addresses()))
+        aggregator.flush(limited=False)
+        self.assertEqual(['10.0.0.%d' % (index,) for index in range(11)],
+                         self._notified_addresses())
+
+    def test_held_errors_are_flushed(self):
+        aggregator = self._create(rate=20, burst=1)
+        all_notified = threading.Event()
+
+        def wait_for_all(notifications):
+            if len(self._notified_addresses()) == 3:
+                all_notified.set()
+
+        aggregator.register_callback(wait_for_all)
+        aggregator([invalid_ip(index) for index in range(3)])
+        self.assertEqual(['10.0.0.0'], self._notified_addresses())
+        # The held errors are notified with no further reports
+        self.assertTrue(all_notified.wait(2))
+        self.assertEqual(['10.0.0.0', '10.0.0.1', '10.0.0.2'],
+                         self._notified_addresses())
+
+    def test_close(self):
+        aggregator = self._create(rate=0.001, burst=1)
+        aggregator([invalid_ip(index) for index in range(3)])
+        aggregator.close()
+        self.assertEqual(['10.0.0.0', '10.0.0.1', '10.0.0.2'],
+                         self._notified_addresses())
+
+    def test_renotify(self):
+        aggregator = self._create(rate=None, renotify_interval=0)
+        aggregator([invalid_ip(1)])
+        aggregator([invalid_ip(1)])
+        self.assertEqual(2, len(self.notified))
+        self.assertEqual(2, self.notified[-1][0].count)
+        self.assertEqual('Fake: Invalid IP Address: 10.0.0.1 '
+                         '(reported 2 times)', str(self.notified[-1][0]))
+
+    def test_max_entries(self):
+        aggregator = self._create(rate=None, max_entries=2)
+        aggregator([invalid_ip(1)])
+        aggregator([invalid_ip(2)])
+        aggregator([invalid_ip(1)])
+        aggregator([invalid_ip(3)])
+        # The least recently reported error is forgotten
+        self.assertEqual(['10.0.0.1', '10.0.0.3'],
+                         [entry.error.ip_address
+                          for entry in aggregator.get_errors()])
+
+    def test_callback_exceptions(self):
+        aggregator = self._create(rate=None)
+
+        def failing_callback(errors):
+            raise RuntimeError('Callback failed')
+
+        aggregator.unregister_callback(self.notified.append)
+        aggregator.register_callback(failing_callback)
+        aggregator.register_callback(self.notified.append)
+        aggregator([invalid_ip(1)])
+        self.assertEqual(['10.0.0.1'], self._notified_addresses())
+
+    def test_clear(self):
+        aggregator = self._create(rate=None)
+        aggregator([invalid_ip(1), invalid_ip(1)])
+        aggregator.clear()
+        self.assertEqual([], aggregator.get_errors())
+        self.assertEqual(0, aggregator.suppressed)
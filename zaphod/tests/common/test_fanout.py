@@ -0,0 +1,95 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from zaphod.common import fanout
+from zaphod.common import logger
+from zaphod.common import protocol_errors
+from zaphod.common import transport
+from zaphod.protocols import DHCP
+from zaphod.tests import frames
+
+ROGUE_MAC = '02:00:00:00:00:66'
+WORKERS = 2
+
+
+def _create_monitor(reader):
+    return [DHCP.DHCPProto(reader, True, [frames.SERVER_MAC])]
+
+
+def _create_learner(reader):
+    dhcp_proto = DHCP.DHCPProto(reader, True)
+    dhcp_proto.learn = True
+    return [dhcp_proto]
+
+
+class TestFanoutCapture(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+
+    def _start(self, handler_factory):
+        capture = fanout.FanoutCapture(
+            self.transport.iface_name, handler_factory, workers=WORKERS,
+            state_interval=0.1, transport=self.transport)
+        capture.start()
+        self.addCleanup(capture.stop)
+        return capture
+
+    def _inject_offers(self, server_mac, count):
+        for xid in range(count):
+            self.transport.inject(frames.build_dhcp_reply(
+                xid=xid, server_mac=server_mac))
+
+    def test_errors(self):
+        errors = []
+        found = threading.Event()
+
+        def collect(worker_errors):
+            errors.extend(worker_errors)
+            if len(errors) >= 10:
+                found.set()
+
+        capture = self._start(_create_monitor)
+        capture.register_callback(collect)
+        self._inject_offers(frames.SERVER_MAC, 10)
+        self._inject_offers(ROGUE_MAC, 10)
+        # Only the offers of the rogue server are reported, by any worker
+        self.assertTrue(found.wait(5))
+        capture.stop()
+        self.assertEqual(10, len(errors))
+        self.assertEqual({protocol_errors.InvalidServerMAC},
+                         {error.__class__ for error in errors})
+
+    def test_learned_state(self):
+        capture = self._start(_create_learner)
+        self._inject_offers(frames.SERVER_MAC, 10)
+        self._inject_offers(ROGUE_MAC, 10)
+        expected = sorted([frames.SERVER_MAC, ROGUE_MAC])
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            # The states the workers learned are merged
+            state = capture.get_learned_state('DHCP')
+            if sorted(state.get('servers', ())) == expected:
+                break
+            time.sleep(0.05)
+        self.assertEqual(expected, sorted(state['servers']))
+        self.assertEqual({}, capture.get_learned_state('ARP'))
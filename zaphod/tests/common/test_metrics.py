@@ -0,0 +1,159 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import urllib.request
+
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import transport
+from zaphod.protocols import ARP
+from zaphod.protocols import DHCP
+from zaphod.tests import frames
+
+READER_LABELS = (('reader', 'mem0'),)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_metrics_are_shared(self):
+        counter = self.registry.counter('frames_total', 'Frames', iface='a')
+        self.assertIs(counter, self.registry.counter('frames_total',
+                                                     'Frames', iface='a'))
+        self.assertIsNot(counter, self.registry.counter('frames_total',
+                                                        'Frames', iface='b'))
+        self.assertRaises(ValueError, self.registry.gauge, 'frames_total',
+                          'Frames')
+
+    def test_snapshot(self):
+        self.registry.counter('frames_total', 'Frames', iface='a').inc(3)
+        histogram = self.registry.histogram('rtt_seconds', 'RTT',
+                                            buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(2)
+        self.assertEqual({
+            'frames_total': {(('iface', 'a'),): 3},
+            'rtt_seconds': {(): {'buckets': {0.1: 1, 1.0: 0}, 'sum': 2.05,
+                                 'count': 2}},
+        }, self.registry.snapshot())
+
+    def test_collectors(self):
+        gauge = self.registry.gauge('queue_length', 'Queued frames')
+        self.registry.register_collector(lambda: gauge.set(7))
+        self.assertEqual({(): 7},
+                         self.registry.snapshot()['queue_length'])
+
+    def test_to_prometheus(self):
+        self.registry.counter('frames_total', 'Frames',
+                              iface='eth"0').inc(2)
+        histogram = self.registry.histogram('rtt_seconds', 'RTT',
+                                            buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(2)
+        self.assertEqual('\n'.join([
+            '# HELP frames_total Frames',
+            '# TYPE frames_total counter',
+            'frames_total{iface="eth\\"0"} 2',
+            '# HELP rtt_seconds RTT',
+            '# TYPE rtt_seconds histogram',
+            'rtt_seconds_bucket{le="0.1"} 1',
+            'rtt_seconds_bucket{le="1.0"} 2',
+            'rtt_seconds_bucket{le="+Inf"} 3',
+            'rtt_seconds_sum 2.55',
+            'rtt_seconds_count 3',
+        ]) + '\n', self.registry.to_prometheus())
+
+    def test_http_server(self):
+        self.registry.counter('frames_total', 'Frames').inc()
+        server = metrics.start_http_server(0, registry=self.registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d/metrics' % (server.server_address[1],)
+        with urllib.request.urlopen(url, timeout=5) as response:
+            self.assertEqual(metrics.PROMETHEUS_CONTENT_TYPE,
+                             response.headers['Content-Type'])
+            body = response.read().decode('utf-8')
+        self.assertEqual(self.registry.to_prometheus(), body)
+
+
+class TestReaderMetrics(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+        self.registry = metrics.Registry()
+        self.reader = packet_reader.PacketReader(
+            transport=self.transport, read_timeout=1,
+            registry=self.registry)
+        self.addCleanup(self.reader.close)
+
+    def _receive(self, *replies):
+        for frame in replies:
+            self.transport.inject(frame)
+            self.reader.read_pending()
+
+    def _get_value(self, name, labels=READER_LABELS):
+        return self.registry.snapshot()[name][labels]
+
+    def test_frame_counters(self):
+        arp_proto = ARP.ARPProto(self.reader)
+        self.addCleanup(arp_proto.close)
+        self._receive(frames.build_arp_reply(), frames.build_arp_reply(),
+                      frames.build_other_frame())
+        self.assertEqual(3, self._get_value('zaphod_frames_received_total'))
+        self.assertEqual(2,
+                         self._get_value('zaphod_frames_dispatched_total'))
+        self.assertEqual(1, self._get_value('zaphod_frames_filtered_total'))
+        self.assertEqual(2, self._get_value('zaphod_frames_parsed_total'))
+        self.assertEqual(0, self._get_value('zaphod_parse_errors_total'))
+
+    def test_handler_metrics(self):
+        def failing_handler(data):
+            raise ValueError('Bad frame')
+
+        self.reader.register_protocol_packet_handler(
+            'dhcp', failing_handler, DHCP.DHCP_MATCH, raw=True)
+        self._receive(frames.build_dhcp_offer(), frames.build_dhcp_offer())
+        labels = (('handler', failing_handler.__qualname__),) + \
+            READER_LABELS
+        self.assertEqual(2, self._get_value('zaphod_handler_errors_total',
+                                            labels))
+        self.assertEqual(2, self._get_value('zaphod_handler_seconds',
+                                            labels)['count'])
+        self.assertIn('zaphod_handler_errors_total{handler="%s",'
+                      'reader="mem0"} 2' % (failing_handler.__qualname__,),
+                      self.registry.to_prometheus())
+
+    def test_probe_metrics(self):
+        dhcp_proto = DHCP.DHCPProto(self.reader)
+        self.addCleanup(dhcp_proto.close)
+        dhcp_proto.send_packet(dhcp_proto.create_packet())
+        xid = dhcp_proto.get_request_key(self.transport.read_sent(1))
+        self._receive(frames.build_dhcp_offer(xid=xid))
+        dhcp_proto.request_timeout = 0
+        dhcp_proto.create_packet()
+        dhcp_proto.wait_for_completion(1)
+        labels = (('protocol', 'DHCP'),) + READER_LABELS
+        self.assertEqual(1, self._get_value('zaphod_probe_rtt_seconds',
+                                            labels)['count'])
+        self.assertEqual(1, self._get_value('zaphod_probe_timeouts_total',
+                                            labels))
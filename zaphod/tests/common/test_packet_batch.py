@@ -0,0 +1,97 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import socket
+import unittest
+
+from zaphod.common import packet_batch
+from zaphod.tests import frames
+
+
+class FakePacketSocket(object):
+    """Queued frames, received as from an AF_PACKET socket"""
+
+    def __init__(self, packets):
+        self.packets = collections.deque(packets)
+
+    def recvfrom_into(self, buf):
+        if not self.packets:
+            raise BlockingIOError()
+        frame, pkt_type = self.packets.popleft()
+        buf[:len(frame)] = frame
+        return len(frame), ('eth0', 3, pkt_type, 1, b'\0' * 6)
+
+    def close(self):
+        pass
+
+
+class TestBatchReceiver(unittest.TestCase):
+
+    def setUp(self):
+        # Datagram sockets keep the frame boundaries, as AF_PACKET does
+        self.wire, self.sock = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_DGRAM)
+        self.addCleanup(self.wire.close)
+        self.addCleanup(self.sock.close)
+        self.frames = [frames.build_dhcp_offer(), frames.build_arp_reply(),
+                       frames.build_other_frame()]
+        self.received = []
+
+    def _create(self, **kwargs):
+        receiver = packet_batch.BatchReceiver(self.sock, **kwargs)
+        self.addCleanup(receiver.close)
+        return receiver
+
+    def _handle_frame(self, frame, pkt_type):
+        self.received.append((bytes(frame), pkt_type))
+
+    @unittest.skipUnless(packet_batch._recvmmsg, 'recvmmsg is not available')
+    def test_recvmmsg_batches(self):
+        receiver = self._create(batch_size=2)
+        for frame in self.frames:
+            self.wire.send(frame)
+        self.assertEqual(2, receiver.read(self._handle_frame, 1))
+        self.assertEqual(1, receiver.read(self._handle_frame, 1))
+        self.assertEqual(self.frames,
+                         [frame for frame, _pkt_type in self.received])
+
+    def test_recvfrom_into_batches(self):
+        receiver = self._create(batch_size=2, use_recvmmsg=False)
+        receiver._nb_sock.close()
+        receiver._nb_sock = FakePacketSocket(
+            [(frame, socket.PACKET_BROADCAST) for frame in self.frames])
+        # The fake socket is not polled, so make the real one readable
+        self.wire.send(b'ready')
+        self.assertEqual(2, receiver.read(self._handle_frame, 1))
+        self.assertEqual(1, receiver.read(self._handle_frame, 1))
+        self.assertEqual(
+            [(frame, socket.PACKET_BROADCAST) for frame in self.frames],
+            self.received)
+
+    def test_timeout(self):
+        receiver = self._create()
+        self.assertEqual(0, receiver.read(self._handle_frame, 0.01))
+        self.assertEqual([], self.received)
+
+    def test_buffers_are_reused(self):
+        receiver = self._create(batch_size=1)
+        views = []
+        for frame in self.frames[:2]:
+            self.wire.send(frame)
+            receiver.read(lambda frame, pkt_type: views.append(frame), 1)
+        # The frames are only valid while they are being handled
+        with self.assertRaises(ValueError):
+            bytes(views[0])
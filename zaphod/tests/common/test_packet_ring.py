@@ -0,0 +1,139 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import select
+import socket
+import struct
+import unittest
+
+from zaphod.common import packet_ring
+from zaphod.tests import frames
+
+BLOCK_SIZE = 4096
+BLOCK_COUNT = 4
+# The offset of the first frame in a block, after the block descriptor
+FIRST_FRAME_OFFSET = 48
+# The offset of the frame data from its tpacket3_hdr
+MAC_OFFSET = 80
+
+_block_header = struct.Struct('III')
+_tpacket3_hdr = struct.Struct('IIIIIIH')
+
+
+class SyntheticRing(packet_ring.PacketRing):
+    """A ring in anonymous memory, filled by the test instead of the kernel"""
+
+    def __init__(self):
+        self._block_size = BLOCK_SIZE
+        self._block_count = BLOCK_COUNT
+        self._block_index = 0
+        self._map = mmap.mmap(-1, BLOCK_SIZE * BLOCK_COUNT)
+        self._view = memoryview(self._map)
+        # Nothing is registered, so polling only waits for the timeout
+        self._poll = select.poll()
+
+    def fill_block(self, index, packets):
+        """Hand a block of (frame, pkt type) to the user, as the kernel"""
+        block_offset = index * BLOCK_SIZE
+        _block_header.pack_into(self._map, block_offset + 8,
+                                packet_ring.TP_STATUS_USER, len(packets),
+                                FIRST_FRAME_OFFSET)
+        offset = block_offset + FIRST_FRAME_OFFSET
+        for frame, pkt_type in packets:
+            next_offset = MAC_OFFSET + len(frame)
+            next_offset += -next_offset % 16
+            _tpacket3_hdr.pack_into(self._map, offset, next_offset, 0, 0,
+                                    len(frame), len(frame),
+                                    packet_ring.TP_STATUS_USER, MAC_OFFSET)
+            self._map[offset + 58] = pkt_type
+            self._map[offset + MAC_OFFSET:
+                      offset + MAC_OFFSET + len(frame)] = frame
+            offset += next_offset
+
+    def block_status(self, index):
+        return struct.unpack_from('I', self._map, index * BLOCK_SIZE + 8)[0]
+
+
+class TestPacketRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = SyntheticRing()
+        self.addCleanup(self.ring.close)
+        self.received = []
+
+    def _handle_frame(self, frame, pkt_type):
+        self.received.append((bytes(frame), pkt_type))
+
+    def test_walk_blocks(self):
+        first = [(frames.build_dhcp_offer(), socket.PACKET_HOST),
+                 (frames.build_arp_reply(), socket.PACKET_HOST)]
+        second = [(frames.build_gratuitous_arp(frames.SERVER_MAC,
+                                               frames.SERVER_IP),
+                   socket.PACKET_BROADCAST)]
+        self.ring.fill_block(0, first)
+        self.ring.fill_block(1, second)
+        self.assertEqual(3, self.ring.read(self._handle_frame, 0))
+        self.assertEqual(first + second, self.received)
+        # The blocks are handed back to the kernel
+        self.assertEqual(packet_ring.TP_STATUS_KERNEL,
+                         self.ring.block_status(0))
+        self.assertEqual(packet_ring.TP_STATUS_KERNEL,
+                         self.ring.block_status(1))
+
+    def test_no_ready_block(self):
+        self.assertEqual(0, self.ring.read(self._handle_frame, 0))
+        self.assertEqual([], self.received)
+
+    def test_blocks_are_read_in_order(self):
+        frame = frames.build_arp_reply()
+        # A block ready out of order waits for the blocks before it
+        self.ring.fill_block(1, [(frame, socket.PACKET_HOST)])
+        self.assertEqual(0, self.ring.read(self._handle_frame, 0))
+        self.ring.fill_block(0, [(frame, socket.PACKET_OTHERHOST)])
+        self.assertEqual(2, self.ring.read(self._handle_frame, 0))
+        self.assertEqual([socket.PACKET_OTHERHOST, socket.PACKET_HOST],
+                         [pkt_type for _frame, pkt_type in self.received])
+
+    def test_wrap_around(self):
+        frame = frames.build_arp_reply()
+        for index in range(BLOCK_COUNT):
+            self.ring.fill_block(index, [(frame, socket.PACKET_HOST)])
+        self.assertEqual(BLOCK_COUNT,
+                         self.ring.read(self._handle_frame, 0))
+        self.ring.fill_block(0, [(frame, socket.PACKET_HOST)] * 2)
+        self.assertEqual(2, self.ring.read(self._handle_frame, 0))
+
+    def test_frames_are_released(self):
+        views = []
+        self.ring.fill_block(0, [(frames.build_arp_reply(),
+                                  socket.PACKET_HOST)])
+        self.ring.read(lambda frame, pkt_type: views.append(frame), 0)
+        # The frames are only valid while they are being handled
+        with self.assertRaises(ValueError):
+            bytes(views[0])
+
+    def test_handler_exceptions(self):
+        self.ring.fill_block(0, [(frames.build_arp_reply(),
+                                  socket.PACKET_HOST)])
+
+        def failing_handler(frame, pkt_type):
+            raise RuntimeError('Handler failed')
+
+        with self.assertRaises(RuntimeError):
+            self.ring.read(failing_handler, 0)
+        # The block is handed back even though handling it failed
+        self.assertEqual(packet_ring.TP_STATUS_KERNEL,
+                         self.ring.block_status(0))
@@ -0,0 +1,153 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import threading
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import packet_template
+from zaphod.common import transport
+from zaphod.protocols import DHCP
+from zaphod.tests import frames
+
+_IP_OFFSET = 14
+_IP_HLEN = 20
+
+
+def udp_checksum(frame):
+    """The UDP checksum of a frame, calculated over the whole datagram"""
+    ip_header = frame[_IP_OFFSET:_IP_OFFSET + _IP_HLEN]
+    udp = bytearray(frame[_IP_OFFSET + _IP_HLEN:])
+    udp_len, = struct.unpack_from('!H', udp, 4)
+    udp = udp[:udp_len]
+    udp[6:8] = b'\0\0'
+    pseudo_header = ip_header[12:20] + struct.pack(
+        '!BBH', 0, packet_template.IPPROTO_UDP, udp_len)
+    return packet_template.checksum(pseudo_header + udp) or 0xffff
+
+
+class TestChecksum(unittest.TestCase):
+
+    def test_rfc1071_example(self):
+        data = bytes(bytearray([0x00, 0x01, 0xf2, 0x03,
+                                0xf4, 0xf5, 0xf6, 0xf7]))
+        self.assertEqual(0x220d, packet_template.checksum(data))
+
+    def test_odd_length(self):
+        self.assertEqual(packet_template.checksum(b'\x12\x34\x56'),
+                         packet_template.checksum(b'\x12\x34\x56\x00'))
+
+    def test_update_checksum(self):
+        data = bytearray(range(32))
+        csum = packet_template.checksum(data)
+        old = bytes(data[8:14])
+        data[8:14] = b'\xff\xfe\x00\x01\x80\x7f'
+        self.assertEqual(packet_template.checksum(data),
+                         packet_template.update_checksum(csum, old,
+                                                         bytes(data[8:14])))
+
+
+class TestPacketTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = bytes(bytearray(range(64)))
+        self.frame = packet_template.build_udp_frame(
+            'ff:ff:ff:ff:ff:ff', '02:00:00:00:00:01', '255.255.255.255',
+            '0.0.0.0', 67, 68, self.payload)
+
+    def test_built_checksums(self):
+        ip_header = self.frame[_IP_OFFSET:_IP_OFFSET + _IP_HLEN]
+        self.assertEqual(0, packet_template.checksum(ip_header))
+        csum, = struct.unpack_from('!H', self.frame,
+                                   packet_template.UDP_CHECKSUM_OFFSET)
+        self.assertEqual(udp_checksum(self.frame), csum)
+
+    def test_patch_checksummed(self):
+        template = packet_template.PacketTemplate(self.frame)
+        offset = packet_template.UDP_PAYLOAD_OFFSET + 4
+        for value in (b'\x12\x34\x56\x78', b'\xff\xff\xff\xff',
+                      b'\x00\x00\x00\x00', b'\xde\xad\xbe\xef'):
+            template.patch_checksummed(offset, value,
+                                       packet_template.UDP_CHECKSUM_OFFSET,
+                                       zero_is_none=True)
+            frame = template.to_bytes()
+            self.assertEqual(value, frame[offset:offset + 4])
+            csum, = struct.unpack_from('!H', frame,
+                                       packet_template.UDP_CHECKSUM_OFFSET)
+            self.assertEqual(udp_checksum(frame), csum)
+
+    def test_zero_is_none(self):
+        # Patch a field so the checksum becomes zero, which UDP sends as
+        # all ones
+        template = packet_template.PacketTemplate(self.frame)
+        offset = packet_template.UDP_PAYLOAD_OFFSET
+        csum, = struct.unpack_from('!H', self.frame,
+                                   packet_template.UDP_CHECKSUM_OFFSET)
+        old, = struct.unpack_from('!H', self.frame, offset)
+        # Adding csum to the field sums the datagram to all ones
+        new = old + csum
+        new = (new & 0xffff) + (new >> 16)
+        template.patch_checksummed(offset, struct.pack('!H', new),
+                                   packet_template.UDP_CHECKSUM_OFFSET,
+                                   zero_is_none=True)
+        frame = template.to_bytes()
+        self.assertEqual(b'\xff\xff', frame[
+            packet_template.UDP_CHECKSUM_OFFSET:
+            packet_template.UDP_CHECKSUM_OFFSET + 2])
+        self.assertEqual(udp_checksum(frame), 0xffff)
+
+    def test_short_frames_are_padded(self):
+        frame = packet_template.build_ethernet_frame(
+            'ff:ff:ff:ff:ff:ff', '02:00:00:00:00:01', 0x0806, b'\x01')
+        self.assertEqual(packet_template.ETH_MIN_FRAME_LEN, len(frame))
+
+
+class TestDHCPTemplate(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+        self.reader = packet_reader.PacketReader(
+            transport=self.transport, read_timeout=0.1,
+            registry=metrics.Registry())
+        self.addCleanup(self.reader.close)
+        self.dhcp_proto = DHCP.DHCPProto(self.reader)
+        self.addCleanup(self.dhcp_proto.close)
+
+    def test_concurrent_packets(self):
+        packets = []
+
+        def create_packets():
+            for _ in range(200):
+                packets.append(self.dhcp_proto.create_packet())
+
+        threads = [threading.Thread(target=create_packets) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        requests = self.dhcp_proto.wait_for_completion(0)
+        self.assertEqual(800, len(packets))
+        for packet in packets:
+            # Every packet has the checksum of its own xid, and is tracked
+            csum, = struct.unpack_from(
+                '!H', packet, packet_template.UDP_CHECKSUM_OFFSET)
+            self.assertEqual(udp_checksum(packet), csum)
+            self.assertIn(self.dhcp_proto.get_request_key(packet), requests)
@@ -0,0 +1,166 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import pcap_reader
+from zaphod.protocols import DHCP
+from zaphod.tests import frames as test_frames
+
+LINKTYPE_RAW = 101
+
+
+def build_pcap(frames, byte_order='<', linktype=pcap_reader.LINKTYPE_ETHERNET):
+    capture = struct.pack(byte_order + 'IHHiIII', pcap_reader.PCAP_MAGIC_USEC,
+                          2, 4, 0, 0, 65535, linktype)
+    for frame in frames:
+        capture += struct.pack(byte_order + 'IIII', 0, 0, len(frame),
+                               len(frame)) + frame
+    return capture
+
+
+def _pcapng_block(block_type, body, byte_order='<'):
+    body += b'\0' * (-len(body) % 4)
+    block_len = len(body) + 12
+    return (struct.pack(byte_order + 'II', block_type, block_len) + body +
+            struct.pack(byte_order + 'I', block_len))
+
+
+def build_pcapng(frames, linktypes=(pcap_reader.LINKTYPE_ETHERNET,),
+                 byte_order='<'):
+    """A pcapng capture, of (interface id, frame) enhanced packets"""
+    capture = _pcapng_block(pcap_reader.PCAPNG_SHB_TYPE, struct.pack(
+        byte_order + 'IHHq', pcap_reader.PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1),
+        byte_order)
+    for linktype in linktypes:
+        capture += _pcapng_block(pcap_reader.PCAPNG_IDB_TYPE, struct.pack(
+            byte_order + 'HHI', linktype, 0, 0), byte_order)
+    for interface_id, frame in frames:
+        capture += _pcapng_block(pcap_reader.PCAPNG_EPB_TYPE, struct.pack(
+            byte_order + 'IIIII', interface_id, 0, 0, len(frame),
+            len(frame)) + frame, byte_order)
+    return capture
+
+
+def read_frames(capture):
+    return [capture[offset:offset + length]
+            for offset, length in pcap_reader.iter_frames(capture)]
+
+
+class TestIterFrames(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.frames = [test_frames.build_dhcp_offer(),
+                       test_frames.build_arp_reply()]
+
+    def test_pcap(self):
+        self.assertEqual(self.frames, read_frames(build_pcap(self.frames)))
+
+    def test_big_endian_pcap(self):
+        self.assertEqual(self.frames,
+                         read_frames(build_pcap(self.frames, '>')))
+
+    def test_pcapng(self):
+        capture = build_pcapng(enumerate(self.frames),
+                               (pcap_reader.LINKTYPE_ETHERNET,) * 2)
+        self.assertEqual(self.frames, read_frames(capture))
+
+    def test_big_endian_pcapng(self):
+        capture = build_pcapng([(0, frame) for frame in self.frames],
+                               byte_order='>')
+        self.assertEqual(self.frames, read_frames(capture))
+
+    def test_pcapng_skips_other_link_types(self):
+        capture = build_pcapng([(0, b'\x45' * 20), (1, self.frames[0])],
+                               (LINKTYPE_RAW, pcap_reader.LINKTYPE_ETHERNET))
+        self.assertEqual(self.frames[:1], read_frames(capture))
+
+    def test_pcapng_simple_packets(self):
+        capture = build_pcapng([]) + _pcapng_block(
+            pcap_reader.PCAPNG_SPB_TYPE,
+            struct.pack('<I', len(self.frames[1])) + self.frames[1])
+        self.assertEqual(self.frames[1:], read_frames(capture))
+
+    def test_truncated(self):
+        capture = build_pcap(self.frames)
+        self.assertEqual(self.frames[:1], read_frames(capture[:-1]))
+        capture = build_pcapng([(0, frame) for frame in self.frames])
+        self.assertEqual(self.frames[:1], read_frames(capture[:-1]))
+
+    def test_unsupported_captures(self):
+        with self.assertRaises(pcap_reader.PcapFormatError):
+            pcap_reader.iter_frames(b'\0' * 10)
+        with self.assertRaises(pcap_reader.PcapFormatError):
+            pcap_reader.iter_frames(b'\0' * 64)
+        with self.assertRaises(pcap_reader.PcapFormatError):
+            pcap_reader.iter_frames(build_pcap(self.frames,
+                                               linktype=LINKTYPE_RAW))
+
+
+class TestPcapReader(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'capture.pcap')
+
+    def _create_reader(self, frames):
+        pcap_reader.write_pcap(self.path, frames)
+        reader = pcap_reader.PcapReader(self.path,
+                                        registry=metrics.Registry())
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_replay(self):
+        frames = [test_frames.build_dhcp_offer(),
+                  test_frames.build_arp_reply(),
+                  test_frames.build_other_frame()] * 3
+        reader = self._create_reader(frames)
+        received = []
+        reader.register_protocol_packet_handler(
+            'dhcp', lambda data: received.append(bytes(data)),
+            DHCP.DHCP_MATCH, raw=True, pkt_types=packet_reader.PKT_TYPES_ALL)
+        stats = reader.replay()
+        self.assertEqual(len(frames), stats.frames)
+        self.assertEqual(sum(len(frame) for frame in frames),
+                         stats.total_bytes)
+        self.assertEqual(frames[::3], received)
+
+    def test_start_reader(self):
+        reader = self._create_reader([test_frames.build_dhcp_offer()])
+        received = []
+        reader.register_protocol_packet_handler(
+            'dhcp', lambda data: received.append(bytes(data)),
+            DHCP.DHCP_MATCH, raw=True)
+        reader.start_reader()
+        reader.wait(5)
+        reader.stop_reader()
+        self.assertEqual(1, len(received))
+
+    def test_not_a_capture(self):
+        with open(self.path, 'wb') as capture:
+            capture.write(b'\0' * 64)
+        reader = pcap_reader.PcapReader(self.path,
+                                        registry=metrics.Registry())
+        self.assertFalse(reader.is_ready)
@@ -0,0 +1,38 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+from zaphod.common import rate_limiter
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate_must_be_positive(self):
+        self.assertRaises(ValueError, rate_limiter.TokenBucket, 0)
+
+    def test_burst(self):
+        bucket = rate_limiter.TokenBucket(1, burst=3)
+        self.assertEqual([True, True, True, False],
+                         [bucket.try_consume() for _ in range(4)])
+
+    def test_consume_paces(self):
+        bucket = rate_limiter.TokenBucket(500, burst=1)
+        started = time.monotonic()
+        for _ in range(51):
+            bucket.consume()
+        # The first token is in the bucket, the other 50 take 0.1 seconds
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
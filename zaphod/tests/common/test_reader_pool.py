@@ -0,0 +1,119 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import reader_pool
+from zaphod.common import transport
+from zaphod.protocols import DHCP
+from zaphod.tests import frames
+
+IFACE_NAMES = ('mem0', 'mem1', 'mem2')
+
+
+class FrameCollector(object):
+
+    def __init__(self, expected):
+        self.frames = []
+        self._expected = expected
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+
+    def __call__(self, data):
+        with self._lock:
+            self.frames.append(bytes(data))
+            if len(self.frames) >= self._expected:
+                self.done.set()
+
+
+class TestReaderPool(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transports = {
+            iface_name: transport.MemoryTransport(
+                iface_name, iface_mac=frames.LOCAL_MAC,
+                iface_ip=frames.LOCAL_IP)
+            for iface_name in IFACE_NAMES}
+        for mem_transport in self.transports.values():
+            self.addCleanup(mem_transport.close)
+        self.pool = reader_pool.ReaderPool(
+            (), workers=2, read_timeout=0.1,
+            transports=self.transports.values())
+        self.addCleanup(self.pool.close)
+
+    def _register(self, collector, iface_names=None):
+        self.pool.register_protocol_packet_handler(
+            'DHCP', collector, DHCP.DHCP_MATCH, raw=True,
+            iface_names=iface_names)
+
+    def _inject_offers(self):
+        for xid, iface_name in enumerate(IFACE_NAMES):
+            self.transports[iface_name].inject(
+                frames.build_dhcp_offer(xid=xid))
+
+    def test_readers(self):
+        self.assertTrue(self.pool.is_ready)
+        self.assertEqual(sorted(IFACE_NAMES), sorted(self.pool.iface_names))
+        self.assertIs(self.transports['mem1'],
+                      self.pool.get_reader('mem1').transport)
+        self.assertIsNone(self.pool.get_reader('eth0'))
+
+    def test_all_interfaces(self):
+        collector = FrameCollector(len(IFACE_NAMES))
+        self._register(collector)
+        self.pool.start()
+        self._inject_offers()
+        self.assertTrue(collector.done.wait(2))
+        self.assertEqual(sorted(frames.build_dhcp_offer(xid=xid)
+                                for xid in range(len(IFACE_NAMES))),
+                         sorted(collector.frames))
+
+    def test_some_interfaces(self):
+        collector = FrameCollector(2)
+        self._register(collector, ('mem0', 'mem2'))
+        single = FrameCollector(1)
+        self._register(single, 'mem1')
+        self.pool.start()
+        self._inject_offers()
+        self.assertTrue(collector.done.wait(2))
+        self.assertTrue(single.done.wait(2))
+        self.pool.stop()
+        self.assertEqual(sorted([frames.build_dhcp_offer(xid=0),
+                                 frames.build_dhcp_offer(xid=2)]),
+                         sorted(collector.frames))
+        self.assertEqual([frames.build_dhcp_offer(xid=1)], single.frames)
+
+    def test_unregister(self):
+        collector = FrameCollector(1)
+        self._register(collector)
+        self.pool.unregister_protocol_packet_handler('DHCP', collector,
+                                                     ('mem0', 'mem1'))
+        self.pool.start()
+        self._inject_offers()
+        self.assertTrue(collector.done.wait(2))
+        self.pool.stop()
+        self.assertEqual([frames.build_dhcp_offer(xid=2)], collector.frames)
+
+    def test_create_handlers(self):
+        handlers = self.pool.create_handlers(DHCP.DHCPProto,
+                                             iface_names=['mem0', 'mem1'])
+        for handler in handlers.values():
+            self.addCleanup(handler.close)
+        self.assertEqual(['mem0', 'mem1'], sorted(handlers))
+        self.assertIs(self.pool.get_reader('mem0'),
+                      handlers['mem0']._packet_reader)
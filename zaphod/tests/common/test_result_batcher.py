@@ -0,0 +1,101 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from zaphod.common import result_batcher
+
+
+class TestResultBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def _create(self, **kwargs):
+        batcher = result_batcher.ResultBatcher(**kwargs)
+        batcher.register_callback(self.batches.append)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def test_max_size(self):
+        batcher = self._create(max_size=3, max_delay=60)
+        batcher([1, 2])
+        self.assertEqual([], self.batches)
+        batcher([3])
+        batcher([4])
+        self.assertEqual([[1, 2, 3]], self.batches)
+        batcher.flush()
+        self.assertEqual([[1, 2, 3], [4]], self.batches)
+
+    def test_max_delay(self):
+        emitted = threading.Event()
+        batcher = self._create(max_size=100, max_delay=0.05)
+        batcher.register_callback(lambda batch: emitted.set())
+        batcher([1])
+        self.assertTrue(emitted.wait(5))
+        self.assertEqual([[1]], self.batches)
+
+    def test_empty_results(self):
+        batcher = self._create(max_size=2, max_delay=60)
+        batcher([])
+        batcher.flush()
+        self.assertEqual([], self.batches)
+        batcher = self._create(max_size=2, max_delay=60, emit_empty=True)
+        batcher([])
+        batcher.flush()
+        self.assertEqual([[]], self.batches)
+
+    def test_close_flushes(self):
+        batcher = result_batcher.ResultBatcher(max_size=100, max_delay=60)
+        batcher.register_callback(self.batches.append)
+        batcher([1])
+        batcher.close()
+        self.assertEqual([[1]], self.batches)
+
+    def test_reentrant_callback(self):
+        batcher = self._create(max_size=1, max_delay=60)
+
+        def callback(batch):
+            if batch == [1]:
+                batcher([2])
+
+        batcher.register_callback(callback)
+        batcher([1])
+        self.assertEqual([[1], [2]], self.batches)
+
+    def test_concurrent_producers(self):
+        batcher = self._create(max_size=16, max_delay=0.01)
+        producers = 4
+        count = 2000
+
+        def produce(producer):
+            for index in range(count):
+                batcher([(producer, index)])
+
+        threads = [threading.Thread(target=produce, args=(producer,))
+                   for producer in range(producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batcher.flush()
+        results = [result for batch in self.batches for result in batch]
+        self.assertEqual(producers * count, len(results))
+        for producer in range(producers):
+            # The results of every producer are emitted in order
+            self.assertEqual(list(range(count)),
+                             [index for source, index in results
+                              if source == producer])
@@ -0,0 +1,88 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+
+from zaphod.common import results_server
+
+
+class TestResultsServer(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'run', 'zaphod.sock')
+        self.results = {'probes': {'DHCP': None}, 'runs': 0}
+
+    def _get_results(self):
+        self.results['runs'] += 1
+        return self.results
+
+    def _start(self):
+        server = results_server.start_results_server(self.path,
+                                                     self._get_results)
+        self.addCleanup(results_server.stop_results_server, server)
+        return server
+
+    def _send(self, command):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(self.path)
+            sock.sendall(command)
+            sock.shutdown(socket.SHUT_WR)
+            return json.loads(sock.makefile('rb').read())
+
+    def test_query_results(self):
+        self._start()
+        self.assertEqual({'probes': {'DHCP': None}, 'runs': 1},
+                         results_server.query_results(self.path, 5))
+        self.assertEqual(2, results_server.query_results(self.path,
+                                                         5)['runs'])
+
+    def test_default_command(self):
+        self._start()
+        self.assertEqual(1, self._send(b'\n')['runs'])
+
+    def test_unknown_command(self):
+        self._start()
+        self.assertEqual({'error': 'Unknown command: status'},
+                         self._send(b'status\n'))
+
+    def test_socket_mode(self):
+        self._start()
+        self.assertEqual(0o660, stat.S_IMODE(os.stat(self.path).st_mode))
+
+    def test_stale_socket(self):
+        os.makedirs(os.path.dirname(self.path))
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self._start()
+        self.assertEqual(1, results_server.query_results(self.path,
+                                                         5)['runs'])
+
+    def test_stop_removes_socket(self):
+        server = results_server.start_results_server(self.path,
+                                                     self._get_results)
+        results_server.stop_results_server(server)
+        self.assertFalse(os.path.exists(self.path))
+        with self.assertRaises(OSError):
+            results_server.query_results(self.path, 5)
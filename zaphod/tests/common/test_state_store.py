@@ -0,0 +1,119 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import state_store
+
+
+class FakeHandler(object):
+
+    def __init__(self, protocol_name, state):
+        self.protocol_name = protocol_name
+        self.state = state
+        self.imported = []
+
+    def get_protocol_name(self):
+        return self.protocol_name
+
+    def export_learned_state(self):
+        return self.state
+
+    def import_learned_state(self, state):
+        self.imported.append(state)
+
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'state')
+
+    def _save(self, *handlers, **kwargs):
+        store = state_store.StateStore(self.path, **kwargs)
+        try:
+            return store.save(handlers)
+        finally:
+            store.close()
+
+    def _load(self, protocol_name):
+        store = state_store.StateStore(self.path)
+        store.close()
+        return store.get_state(protocol_name)
+
+    def test_round_trip(self):
+        self._save(FakeHandler('ARP', {'known': {'10.0.0.1': 'a'}}),
+                   FakeHandler('DHCP', {'servers': ['a', 'b']}))
+        self.assertEqual({'known': {'10.0.0.1': 'a'}}, self._load('ARP'))
+        self.assertEqual({'servers': ['a', 'b']}, self._load('DHCP'))
+
+    def test_only_new_state_is_appended(self):
+        self.assertEqual(1, self._save(FakeHandler('DHCP',
+                                                   {'servers': ['a']})))
+        self.assertEqual(0, self._save(FakeHandler('DHCP',
+                                                   {'servers': ['a']})))
+        self.assertEqual(1, self._save(FakeHandler('DHCP',
+                                                   {'servers': ['a', 'b']})))
+        self.assertEqual({'servers': ['a', 'b']}, self._load('DHCP'))
+
+    def test_compact(self):
+        for index in range(5):
+            self._save(FakeHandler('DHCP', {'servers': [str(index)]}),
+                       compact_records=2)
+        self.assertEqual({'servers': ['0', '1', '2', '3', '4']},
+                         self._load('DHCP'))
+        records, _end = state_store.read_records(self.path + '.log')
+        self.assertLess(len(records), 2)
+
+    def test_torn_record(self):
+        self._save(FakeHandler('DHCP', {'servers': ['a']}))
+        with open(self.path + '.log', 'ab') as log:
+            log.write(b'\x00\x00\x01\x00torn')
+        self.assertEqual({'servers': ['a']}, self._load('DHCP'))
+        # Records appended after recovering are not lost behind the torn one
+        self._save(FakeHandler('DHCP', {'servers': ['a', 'b']}))
+        self.assertEqual({'servers': ['a', 'b']}, self._load('DHCP'))
+
+    def test_corrupted_record(self):
+        self._save(FakeHandler('DHCP', {'servers': ['a']}))
+        self._save(FakeHandler('DHCP', {'servers': ['a', 'b']}))
+        with open(self.path + '.log', 'r+b') as log:
+            log.seek(-2, os.SEEK_END)
+            log.write(b'xx')
+        self.assertEqual({'servers': ['a']}, self._load('DHCP'))
+        self._save(FakeHandler('DHCP', {'servers': ['a', 'c']}))
+        self.assertEqual({'servers': ['a', 'c']}, self._load('DHCP'))
+
+    def test_bad_log_header(self):
+        with open(self.path + '.log', 'wb') as log:
+            log.write(b'junk')
+        self._save(FakeHandler('DHCP', {'servers': ['a']}))
+        self.assertEqual({'servers': ['a']}, self._load('DHCP'))
+
+    def test_restore(self):
+        self._save(FakeHandler('DHCP', {'servers': ['a']}))
+        handler = FakeHandler('DHCP', {})
+        other = FakeHandler('ARP', {})
+        store = state_store.StateStore(self.path)
+        store.restore([handler, other])
+        store.close()
+        self.assertEqual([{'servers': ['a']}], handler.imported)
+        self.assertEqual([], other.imported)
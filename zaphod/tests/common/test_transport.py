@@ -0,0 +1,110 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import transport
+from zaphod.protocols import ARP
+from zaphod.tests import frames
+
+OTHER_MAC = '02:00:00:00:00:02'
+
+
+class TestMemoryTransport(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+        self.reader = packet_reader.PacketReader(
+            transport=self.transport, read_timeout=1,
+            registry=metrics.Registry())
+        self.addCleanup(self.reader.close)
+
+    def _register(self, pkt_types=None):
+        received = []
+        self.reader.register_protocol_packet_handler(
+            'arp', lambda data: received.append(bytes(data)), ARP.ARP_MATCH,
+            raw=True, pkt_types=pkt_types)
+        return received
+
+    def test_addresses(self):
+        self.assertEqual(frames.LOCAL_MAC, self.transport.get_iface_mac())
+        self.assertEqual(frames.LOCAL_IP,
+                         self.transport.get_iface_ip_address())
+        self.assertTrue(self.reader.is_ready)
+
+    def test_inject(self):
+        received = self._register()
+        reply = frames.build_arp_reply()
+        self.transport.inject(reply)
+        self.reader.read_pending()
+        self.assertEqual([reply], received)
+
+    def test_packet_types(self):
+        host = self._register()
+        everything = self._register(packet_reader.PKT_TYPES_ALL)
+        broadcast = frames.build_gratuitous_arp(frames.SERVER_MAC,
+                                                frames.SERVER_IP)
+        other_host = frames.build_arp(frames.SERVER_MAC, frames.SERVER_IP,
+                                      frames.LOCAL_IP, dst_mac=OTHER_MAC)
+        for frame in (broadcast, other_host):
+            self.transport.inject(frame)
+            self.reader.read_pending()
+        # Frames to other hosts are only passed to the handlers asking for
+        # them, as on a promiscuous link
+        self.assertEqual([], host)
+        self.assertEqual([broadcast, other_host], everything)
+
+    def test_listener(self):
+        listener = self.transport.create_listener(0)
+        self.transport.inject(frames.build_arp_reply())
+        data, address = listener.recvfrom(65536)
+        self.assertEqual(frames.build_arp_reply(), data)
+        self.assertEqual(socket.PACKET_HOST, address[2])
+        with self.assertRaises(socket.timeout):
+            listener.recvfrom(65536)
+
+    def test_read_sent(self):
+        sender = self.transport.create_sender('Socket', socket.SOCK_RAW)
+        sender.send(b'first')
+        sender.send(bytearray(b'second'))
+        self.assertEqual(b'first', self.transport.read_sent(1))
+        self.assertEqual(b'second', self.transport.read_sent(1))
+        self.assertIsNone(self.transport.read_sent(0.01))
+
+    def test_peer(self):
+        received = self._register()
+        reply = frames.build_arp_reply()
+
+        def peer(frame):
+            self.assertEqual(b'request', frame)
+            self.transport.inject(reply)
+
+        self.transport.peer = peer
+        sender = self.transport.create_sender('Socket', socket.SOCK_RAW)
+        sender.send(b'request')
+        self.reader.read_pending()
+        self.assertEqual([reply], received)
+        self.assertIsNone(self.transport.read_sent(0))
+
+    def test_transports_are_abstract(self):
+        with self.assertRaises(TypeError):
+            transport.Transport('eth0')
@@ -0,0 +1,120 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Frames for the tests and benchmarks, built in memory
+
+The frames are exchanged between the local host (LOCAL_MAC, LOCAL_IP) and
+a server on its link, which is its DHCP server and ARP resolver.
+"""
+
+import struct
+
+from zaphod.common import address_set
+from zaphod.common import packet_template
+from zaphod.protocols import DHCP
+from zaphod.protocols import dhcp_packet
+
+LOCAL_MAC = '02:00:00:00:00:01'
+LOCAL_IP = '10.0.0.2'
+SERVER_MAC = '02:00:00:00:00:fe'
+SERVER_IP = '10.0.0.1'
+GATEWAY_IP = '10.0.0.254'
+DNS_IP = '10.0.0.53'
+OFFERED_IP = '10.0.0.100'
+SUBNET_MASK = '255.255.255.0'
+MAC_BROADCAST = 'ff:ff:ff:ff:ff:ff'
+
+ETH_TYPE_ARP = 0x0806
+ARP_REQUEST = 1
+ARP_REPLY = 2
+# The offset of the target IP in an ARP frame
+ARP_TARGET_IP_OFFSET = 38
+
+_arp_payload = struct.Struct('!HHBBH6s4s6s4s')
+
+
+def build_dhcp_options(message_type, server_ip=SERVER_IP,
+                       subnet_mask=SUBNET_MASK, gateway_ip=GATEWAY_IP,
+                       dns_ip=DNS_IP, lease_time=3600, mtu=1500):
+    """The options of a DHCP reply, leaving out the ones given as None"""
+    option_list = [(dhcp_packet.DHCP_MESSAGE_TYPE_OPT,
+                    struct.pack('!B', message_type))]
+    for tag, value in (
+            (dhcp_packet.DHCP_SERVER_IDENTIFIER_OPT, server_ip),
+            (dhcp_packet.DHCP_IP_ADDR_LEASE_TIME_OPT, lease_time),
+            (dhcp_packet.DHCP_SUBNET_MASK_OPT, subnet_mask),
+            (dhcp_packet.DHCP_GATEWAY_ADDR_OPT, gateway_ip),
+            (dhcp_packet.DHCP_DNS_SERVER_ADDR_OPT, dns_ip),
+            (dhcp_packet.DHCP_MTU_OPT, mtu)):
+        if value is None:
+            continue
+        if tag == dhcp_packet.DHCP_IP_ADDR_LEASE_TIME_OPT:
+            value = struct.pack('!I', value)
+        elif tag == dhcp_packet.DHCP_MTU_OPT:
+            value = struct.pack('!H', value)
+        else:
+            value = packet_template.ip_to_bytes(value)
+        option_list.append((tag, value))
+    return option_list
+
+
+def build_dhcp_reply(message_type=dhcp_packet.DHCP_OFFER, xid=0x12345678,
+                     server_mac=SERVER_MAC, client_mac=LOCAL_MAC,
+                     dst_mac=None, offered_ip=OFFERED_IP,
+                     option_list=None, relay_ip=None):
+    """A DHCP reply of the server, sent to the client MAC by default"""
+    if option_list is None:
+        option_list = build_dhcp_options(message_type)
+    message = dhcp_packet.build_message(
+        dhcp_packet.DHCP_BOOT_REPLY, xid,
+        packet_template.mac_to_bytes(client_mac), option_list,
+        yiaddr=address_set.ip_to_int(offered_ip),
+        siaddr=address_set.ip_to_int(SERVER_IP),
+        giaddr=address_set.ip_to_int(relay_ip) if relay_ip else 0)
+    return packet_template.build_udp_frame(
+        dst_mac or client_mac, server_mac, offered_ip, SERVER_IP,
+        DHCP.DHCP_CLIENT_PORT, DHCP.DHCP_SERVER_PORT, message)
+
+
+def build_dhcp_offer(xid=0x12345678, dst_mac=LOCAL_MAC):
+    return build_dhcp_reply(xid=xid, dst_mac=dst_mac)
+
+
+def build_arp(sender_mac, sender_ip, target_ip, opcode=ARP_REQUEST,
+              target_mac='00:00:00:00:00:00', dst_mac=MAC_BROADCAST):
+    payload = _arp_payload.pack(
+        1, packet_template.ETH_TYPE_IP, 6, 4, opcode,
+        packet_template.mac_to_bytes(sender_mac),
+        packet_template.ip_to_bytes(sender_ip),
+        packet_template.mac_to_bytes(target_mac),
+        packet_template.ip_to_bytes(target_ip))
+    return packet_template.build_ethernet_frame(dst_mac, sender_mac,
+                                                ETH_TYPE_ARP, payload)
+
+
+def build_arp_reply(sender_mac=SERVER_MAC, sender_ip=SERVER_IP):
+    """A reply to an ARP request of the local host"""
+    return build_arp(sender_mac, sender_ip, LOCAL_IP, opcode=ARP_REPLY,
+                     target_mac=LOCAL_MAC, dst_mac=LOCAL_MAC)
+
+
+def build_gratuitous_arp(sender_mac, sender_ip):
+    return build_arp(sender_mac, sender_ip, sender_ip)
+
+
+def build_other_frame():
+    # A DNS query, which no handler is registered for
+    return packet_template.build_udp_frame(SERVER_MAC, LOCAL_MAC, DNS_IP,
+                                           LOCAL_IP, 53, 40000, b'\0' * 32)
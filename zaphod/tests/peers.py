@@ -0,0 +1,123 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Peers answering the frames the handlers send on a MemoryTransport
+
+A peer is set as the peer callback of the transport, and answers the
+frames sent by the handlers by injecting its replies, from the sending
+thread, or after a delay from a timer thread.
+"""
+
+import socket
+import threading
+
+from zaphod.common import address_set
+from zaphod.protocols import dhcp_packet
+from zaphod.tests import frames
+
+
+class Peer(object):
+
+    def __init__(self, mem_transport):
+        self.transport = mem_transport
+        self.received = []
+        self._timers = []
+        mem_transport.peer = self
+
+    def _inject(self, frame, delay=0):
+        if not delay:
+            self.transport.inject(frame)
+            return
+        timer = threading.Timer(delay, self.transport.inject, (frame,))
+        timer.daemon = True
+        self._timers.append(timer)
+        timer.start()
+
+    def __call__(self, frame):
+        self.received.append(frame)
+        self.answer(frame)
+
+    def answer(self, frame):
+        pass
+
+    def close(self):
+        for timer in self._timers:
+            timer.cancel()
+        self.transport.peer = None
+
+
+class ArpResponder(Peer):
+    """Answer the ARP requests for the addresses, an {ip: mac} dict"""
+
+    def __init__(self, mem_transport, addresses):
+        super(ArpResponder, self).__init__(mem_transport)
+        self.addresses = addresses
+
+    def answer(self, frame):
+        offset = frames.ARP_TARGET_IP_OFFSET
+        target_ip = socket.inet_ntoa(bytes(frame[offset:offset + 4]))
+        mac = self.addresses.get(target_ip)
+        if mac:
+            self._inject(frames.build_arp_reply(mac, target_ip))
+
+
+class DhcpServer(Peer):
+    """Answer DISCOVERs with OFFERs, and REQUESTs with ACKs (or NAKs)
+
+    Every server MAC in servers answers, after its delay in seconds. The
+    offered addresses are given out in order, starting at first_ip. The
+    first drop messages are not answered, e.g. to test retries.
+    """
+
+    def __init__(self, mem_transport, servers=((frames.SERVER_MAC, 0),),
+                 first_ip=frames.OFFERED_IP, nak=False, drop=0):
+        super(DhcpServer, self).__init__(mem_transport)
+        self.servers = servers
+        self.nak = nak
+        self.drop = drop
+        self._next_ip = address_set.ip_to_int(first_ip)
+        self._leases = {}
+        self.released = []
+
+    def _get_lease(self, chaddr):
+        lease = self._leases.get(chaddr)
+        if lease is None:
+            lease = self._leases[chaddr] = self._next_ip
+            self._next_ip += 1
+        return address_set.int_to_ip(lease)
+
+    def answer(self, frame):
+        message = dhcp_packet.parse(frame)
+        if message is None or message.op != dhcp_packet.DHCP_BOOT_REQUEST:
+            return
+        if message.message_type == dhcp_packet.DHCP_RELEASE:
+            self.released.append(message.chaddr)
+            return
+        if self.drop:
+            self.drop -= 1
+            return
+        if message.message_type == dhcp_packet.DHCP_DISCOVER:
+            message_type = dhcp_packet.DHCP_OFFER
+        elif message.message_type == dhcp_packet.DHCP_REQUEST:
+            message_type = (dhcp_packet.DHCP_NAK if self.nak
+                            else dhcp_packet.DHCP_ACK)
+        else:
+            return
+        client_mac = dhcp_packet.format_mac(message.chaddr)
+        offered_ip = self._get_lease(message.chaddr)
+        for server_mac, delay in self.servers:
+            self._inject(frames.build_dhcp_reply(
+                message_type, message.xid, server_mac, client_mac,
+                offered_ip=offered_ip), delay)
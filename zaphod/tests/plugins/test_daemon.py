@@ -0,0 +1,149 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from zaphod.common import address_set
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import transport
+from zaphod.plugins import daemon
+from zaphod.protocols import ARP
+from zaphod.protocols import DHCP
+from zaphod.tests import frames
+from zaphod.tests import peers
+
+REQUEST_TIMEOUT = 5
+ROGUE_MAC = '02:00:00:00:00:66'
+SILENT_IP = '10.0.0.3'
+
+
+def _create_reader(test):
+    mem = transport.MemoryTransport(iface_mac=frames.LOCAL_MAC,
+                                    iface_ip=frames.LOCAL_IP)
+    test.addCleanup(mem.close)
+    reader = packet_reader.PacketReader(transport=mem, read_timeout=0.1,
+                                        registry=metrics.Registry())
+    test.addCleanup(reader.close)
+    return mem, reader
+
+
+def _start_reader(test, reader):
+    reader.start_reader()
+    test.addCleanup(reader.stop_reader)
+
+
+class TestScheduledProbe(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport, self.reader = _create_reader(self)
+        self.dhcp_proto = DHCP.DHCPProto(self.reader, False,
+                                         [frames.SERVER_MAC])
+        self.dhcp_proto.request_timeout = REQUEST_TIMEOUT
+        self.addCleanup(self.dhcp_proto.close)
+        _start_reader(self, self.reader)
+
+    def _start_server(self, servers=((frames.SERVER_MAC, 0),)):
+        server = peers.DhcpServer(self.transport, servers=servers)
+        self.addCleanup(server.close)
+        return server
+
+    def _create_probe(self, send_probes=daemon._send_dhcp_probes,
+                      interval=60):
+        return daemon.ScheduledProbe('DHCP', self.dhcp_proto, send_probes,
+                                     interval, grace=DHCP.OFFER_GRACE)
+
+    def test_run_ends_after_grace(self):
+        self._start_server()
+        probe = daemon.ScheduledProbe('DHCP', self.dhcp_proto,
+                                      daemon._send_dhcp_probes, 60,
+                                      grace=DHCP.OFFER_GRACE)
+        probe.run_once()
+        self.assertTrue(probe.result['ok'])
+        self.assertEqual([], probe.result['timed_out'])
+        # The run does not wait for the timeout of the replied request
+        self.assertLess(probe.result['duration'], REQUEST_TIMEOUT / 2)
+
+    def test_errors(self):
+        self._start_server(((frames.SERVER_MAC, 0), (ROGUE_MAC, 0)))
+        probe = self._create_probe()
+        probe.run_once()
+        self.assertFalse(probe.result['ok'])
+        self.assertEqual(1, len(probe.result['errors']))
+        self.assertIn(ROGUE_MAC, probe.result['errors'][0]['message'])
+        # The errors of the previous run are not reported again
+        self.transport.peer = None
+        self.dhcp_proto.request_timeout = 0.2
+        probe.run_once()
+        self.assertEqual([], probe.result['errors'])
+        self.assertEqual(1, len(probe.result['timed_out']))
+        self.assertEqual(2, probe.result['runs'])
+
+    def test_failure(self):
+        def send_probes(handler):
+            raise IOError('link down')
+
+        probe = self._create_probe(send_probes)
+        probe.run_once()
+        self.assertFalse(probe.result['ok'])
+        self.assertEqual([{'message': 'DHCP probe failed: link down'}],
+                         probe.result['errors'])
+
+    def test_start_stop(self):
+        self._start_server()
+        runs = threading.Semaphore(0)
+
+        def send_probes(handler):
+            daemon._send_dhcp_probes(handler)
+            runs.release()
+
+        probe = self._create_probe(send_probes, interval=0.01)
+        probe.start()
+        self.addCleanup(probe.stop)
+        for _ in range(3):
+            self.assertTrue(runs.acquire(timeout=REQUEST_TIMEOUT))
+        probe.stop()
+        stopped_runs = probe.runs
+        time.sleep(0.1)
+        self.assertEqual(stopped_runs, probe.runs)
+        self.assertGreaterEqual(stopped_runs, 3)
+        self.assertTrue(probe.result['ok'])
+
+
+class TestScheduledArpProbe(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport, self.reader = _create_reader(self)
+        responder = peers.ArpResponder(self.transport,
+                                       {frames.SERVER_IP: frames.SERVER_MAC})
+        self.addCleanup(responder.close)
+        self.arp_proto = ARP.ARPProto(
+            self.reader, known_addresses={frames.SERVER_IP: frames.SERVER_MAC})
+        self.arp_proto.request_timeout = 0.2
+        self.addCleanup(self.arp_proto.close)
+        _start_reader(self, self.reader)
+
+    def test_timed_out(self):
+        send_probes = daemon._create_arp_sender([frames.SERVER_IP, SILENT_IP])
+        probe = daemon.ScheduledProbe('ARP', self.arp_proto, send_probes, 60)
+        probe.run_once()
+        self.assertTrue(probe.result['ok'])
+        self.assertEqual([str(address_set.ip_to_int(SILENT_IP))],
+                         probe.result['timed_out'])
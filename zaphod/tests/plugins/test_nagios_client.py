@@ -0,0 +1,69 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import io
+import unittest
+
+from zaphod.plugins import nagios_client
+
+NOW = 1000.0
+
+
+def _result(errors=(), started=NOW):
+    return {'started': started, 'duration': 0.1, 'ok': not errors,
+            'errors': [{'message': message} for message in errors],
+            'timed_out': [], 'runs': 1}
+
+
+class TestCheckResults(unittest.TestCase):
+
+    def _check(self, probes, max_age=300):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = nagios_client.check_results({'probes': probes}, max_age,
+                                                 now=NOW)
+        return status, output.getvalue().splitlines()
+
+    def test_ok(self):
+        status, lines = self._check({'ARP': _result(), 'DHCP': _result()})
+        self.assertEqual(nagios_client.STATUS_OK, status)
+        self.assertEqual([], lines)
+
+    def test_errors(self):
+        status, lines = self._check({'ARP': _result(),
+                                     'DHCP': _result(['rogue server'])})
+        self.assertEqual(nagios_client.STATUS_FAILED, status)
+        self.assertEqual(['rogue server'], lines)
+
+    def test_stale_results(self):
+        status, lines = self._check({'DHCP': _result(started=NOW - 400)})
+        self.assertEqual(nagios_client.STATUS_UNKNOWN, status)
+        self.assertEqual(['DHCP: Results are 400 seconds old'], lines)
+
+    def test_errors_outrank_unknown(self):
+        status, _ = self._check({'ARP': None,
+                                 'DHCP': _result(['rogue server'])})
+        self.assertEqual(nagios_client.STATUS_FAILED, status)
+
+    def test_no_results_yet(self):
+        status, lines = self._check({'DHCP': None})
+        self.assertEqual(nagios_client.STATUS_UNKNOWN, status)
+        self.assertEqual(['DHCP: No results yet'], lines)
+
+    def test_no_probes(self):
+        status, lines = self._check({})
+        self.assertEqual(nagios_client.STATUS_UNKNOWN, status)
+        self.assertEqual(['The daemon runs no probes'], lines)
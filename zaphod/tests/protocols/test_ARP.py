@@ -13,8 +13,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
-
 from zaphod.common import packet_reader
 from zaphod.protocols import ARP
 from zaphod.tests import cli_parser
@@ -29,7 +27,7 @@ class TestARP(object):
         for item in self.config['resolvers'].keys():
             packet = self.arp_proto.create_packet(ip_address=item)
             self.arp_proto.send_packet(packet)
-        time.sleep(5)
+        self.arp_proto.wait_for_completion(5)
 
     def test_learn(self):
         print("---- Learning Usecase ----")
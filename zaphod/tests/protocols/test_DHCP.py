@@ -13,8 +13,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
-
 from zaphod.common import packet_reader
 from zaphod.protocols import DHCP
 from zaphod.tests import cli_parser
@@ -28,7 +26,7 @@ class TestDHCP:
     def _single_run(self):
         packet = self.dhcp_proto.create_packet()
         self.dhcp_proto.send_packet(packet)
-        time.sleep(5)
+        self.dhcp_proto.wait_for_completion(5)
 
     def test_learn(self):
         print("---- Learning Usecase ----")
@@ -0,0 +1,130 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import pcap_reader
+from zaphod.common import protocol_errors
+from zaphod.protocols import arp_monitor
+from zaphod.tests import frames
+
+HOST_IP = '10.0.0.10'
+HOST_MAC = '02:00:00:00:00:10'
+SPOOFER_MAC = '02:00:00:00:00:66'
+
+
+class TestARPMonitor(unittest.TestCase):
+    """The monitor, fed by captures replayed through a PcapReader"""
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.errors = []
+
+    def _replay(self, captured, **kwargs):
+        path = os.path.join(self.workdir, 'arp.pcap')
+        pcap_reader.write_pcap(path, captured)
+        reader = pcap_reader.PcapReader(path, registry=metrics.Registry())
+        self.addCleanup(reader.close)
+        monitor = arp_monitor.ARPMonitor(reader, **kwargs)
+        monitor.register_callback(self.errors.extend)
+        self.addCleanup(monitor.close)
+        reader.replay()
+        return monitor
+
+    def _error_classes(self):
+        return [error.__class__ for error in self.errors]
+
+    def test_bindings(self):
+        monitor = self._replay([
+            frames.build_arp(HOST_MAC, HOST_IP, frames.SERVER_IP),
+            frames.build_arp(frames.SERVER_MAC, frames.SERVER_IP, HOST_IP,
+                             opcode=frames.ARP_REPLY, target_mac=HOST_MAC,
+                             dst_mac=HOST_MAC),
+        ])
+        self.assertEqual([], self.errors)
+        self.assertEqual(
+            [(HOST_IP, HOST_MAC), (frames.SERVER_IP, frames.SERVER_MAC)],
+            [(binding['ip'], binding['mac'])
+             for binding in monitor.get_bindings()])
+
+    def test_mac_flip(self):
+        monitor = self._replay([
+            frames.build_gratuitous_arp(HOST_MAC, HOST_IP),
+            frames.build_arp(SPOOFER_MAC, HOST_IP, frames.SERVER_IP),
+        ], conflict_window=0)
+        self.assertEqual([protocol_errors.MACFlip], self._error_classes())
+        binding, = monitor.get_bindings()
+        self.assertEqual((SPOOFER_MAC, 1), (binding['mac'],
+                                            binding['flips']))
+
+    def test_ip_conflict(self):
+        self._replay([
+            frames.build_arp(HOST_MAC, HOST_IP, frames.SERVER_IP),
+            frames.build_arp(SPOOFER_MAC, HOST_IP, frames.SERVER_IP),
+            frames.build_arp(HOST_MAC, HOST_IP, frames.SERVER_IP),
+        ])
+        self.assertEqual([protocol_errors.MACFlip,
+                          protocol_errors.IPConflict],
+                         self._error_classes())
+
+    def test_known_addresses(self):
+        self._replay([
+            frames.build_arp(HOST_MAC, HOST_IP, frames.SERVER_IP),
+            frames.build_arp(SPOOFER_MAC, frames.SERVER_IP, HOST_IP),
+        ], known_addresses={HOST_IP: HOST_MAC,
+                            frames.SERVER_IP: frames.SERVER_MAC})
+        self.assertEqual([protocol_errors.InvalidARP],
+                         self._error_classes())
+
+    def test_learn(self):
+        path = os.path.join(self.workdir, 'arp.pcap')
+        pcap_reader.write_pcap(path, [
+            frames.build_arp(HOST_MAC, HOST_IP, frames.SERVER_IP)])
+        reader = pcap_reader.PcapReader(path, registry=metrics.Registry())
+        self.addCleanup(reader.close)
+        monitor = arp_monitor.ARPMonitor(reader)
+        self.addCleanup(monitor.close)
+        monitor.learn = True
+        reader.replay()
+        self.assertEqual({'known_addresses': {HOST_IP: HOST_MAC}},
+                         monitor.export_learned_state())
+
+    def test_gratuitous_flood(self):
+        self._replay([frames.build_gratuitous_arp(HOST_MAC, HOST_IP)] * 10,
+                     gratuitous_limit=3)
+        # Reported once per period
+        self.assertEqual([protocol_errors.GratuitousARPFlood],
+                         self._error_classes())
+
+    def test_address_probes_are_ignored(self):
+        monitor = self._replay([
+            frames.build_arp(HOST_MAC, '0.0.0.0', HOST_IP)])
+        self.assertEqual([], monitor.get_bindings())
+
+    def test_max_bindings(self):
+        monitor = self._replay([
+            frames.build_arp(HOST_MAC, '10.0.0.%d' % (index,),
+                             frames.SERVER_IP)
+            for index in range(1, 6)], max_bindings=2)
+        self.assertEqual(['10.0.0.4', '10.0.0.5'],
+                         [binding['ip']
+                          for binding in monitor.get_bindings()])
@@ -0,0 +1,117 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+from zaphod.common import address_set
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import transport
+from zaphod.protocols import ARP
+from zaphod.tests import frames
+from zaphod.tests import peers
+
+OTHER_IP = '10.0.0.3'
+OTHER_MAC = '02:00:00:00:00:fd'
+SPOOFER_MAC = '02:00:00:00:00:66'
+
+
+class TestArpSweepTable(unittest.TestCase):
+
+    def test_targets(self):
+        table = ARP.ArpSweepTable(['10.0.0.0/30', '10.0.0.2/31',
+                                   '10.0.1.1/32'])
+        # The network and broadcast addresses of the /30 are skipped, and
+        # the overlapping networks are merged
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.1.1'],
+                         [address_set.int_to_ip(ip)
+                          for ip in table.targets()])
+        self.assertEqual(4, table.target_count)
+
+    def test_replies(self):
+        table = ARP.ArpSweepTable(['10.0.0.1/32', '10.0.0.2/32'])
+        first = address_set.ip_to_int('10.0.0.1')
+        table.record_reply(address_set.ip_to_int('10.0.0.9'), 1)
+        table.record_reply(first, 1)
+        table.record_reply(first, 2)
+        self.assertEqual({first: 1}, table.replies)
+        self.assertEqual({first: {2}}, table.conflicts)
+        self.assertFalse(table.completed.is_set())
+        table.record_reply(address_set.ip_to_int('10.0.0.2'), 1)
+        self.assertTrue(table.completed.is_set())
+        self.assertEqual([], list(table.unanswered()))
+
+
+class TestArpSweep(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+        self.responder = peers.ArpResponder(self.transport, {
+            frames.SERVER_IP: frames.SERVER_MAC,
+            OTHER_IP: OTHER_MAC,
+        })
+        self.addCleanup(self.responder.close)
+        self.reader = packet_reader.PacketReader(
+            transport=self.transport, read_timeout=0.1,
+            registry=metrics.Registry())
+        self.addCleanup(self.reader.close)
+        self.arp_proto = ARP.ARPProto(self.reader)
+        self.addCleanup(self.arp_proto.close)
+        self.reader.start_reader()
+        self.addCleanup(self.reader.stop_reader)
+
+    def test_rate(self):
+        started = time.monotonic()
+        self.arp_proto.sweep(['10.0.0.0/26'], rate=200, reply_timeout=0)
+        # 62 requests, at up to 200 per second
+        self.assertGreaterEqual(time.monotonic() - started, 0.25)
+        self.assertEqual(62, len(self.responder.received))
+
+    def test_sweep(self):
+        table = self.arp_proto.sweep(['10.0.0.0/29'], reply_timeout=0.2)
+        self.assertEqual({address_set.ip_to_int(frames.SERVER_IP):
+                          address_set.mac_to_int(frames.SERVER_MAC),
+                          address_set.ip_to_int(OTHER_IP):
+                          address_set.mac_to_int(OTHER_MAC)},
+                         table.replies)
+        self.assertEqual(['10.0.0.2', '10.0.0.4', '10.0.0.5', '10.0.0.6'],
+                         [address_set.int_to_ip(ip)
+                          for ip in table.unanswered()])
+
+    def test_completes_when_all_replied(self):
+        started = time.monotonic()
+        table = self.arp_proto.sweep([frames.SERVER_IP, OTHER_IP],
+                                     reply_timeout=5)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertTrue(table.completed.is_set())
+
+    def test_conflicts(self):
+        def answer_twice(frame):
+            self.responder(frame)
+            self.transport.inject(
+                frames.build_arp_reply(SPOOFER_MAC, OTHER_IP))
+
+        self.transport.peer = answer_twice
+        # An unanswered target, so the sweep waits for the other reply
+        table = self.arp_proto.sweep([OTHER_IP, '10.0.0.4'],
+                                     reply_timeout=0.2)
+        self.assertEqual({address_set.ip_to_int(OTHER_IP):
+                          {address_set.mac_to_int(SPOOFER_MAC)}},
+                         table.conflicts)
@@ -0,0 +1,157 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import protocol_errors
+from zaphod.common import transport
+from zaphod.protocols import ARP
+from zaphod.protocols import DHCP
+from zaphod.protocols import async_handler
+from zaphod.protocols import base_handler
+from zaphod.protocols import dhcp_monitor
+from zaphod.tests import frames
+from zaphod.tests import peers
+
+OTHER_SERVER_IP = '10.0.0.3'
+SPOOFER_MAC = '02:00:00:00:00:66'
+
+
+class _ProbeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+        self.reader = packet_reader.PacketReader(
+            transport=self.transport, read_timeout=0.1,
+            registry=metrics.Registry())
+        self.addCleanup(self.reader.close)
+
+    def _start_reader(self):
+        self.reader.start_reader()
+        self.addCleanup(self.reader.stop_reader)
+
+
+class TestDHCPRequests(_ProbeTestCase):
+
+    def setUp(self):
+        super(TestDHCPRequests, self).setUp()
+        self.server = peers.DhcpServer(self.transport)
+        self.addCleanup(self.server.close)
+        self.dhcp_proto = DHCP.DHCPProto(self.reader)
+        self.addCleanup(self.dhcp_proto.close)
+
+    def test_overlapping_requests(self):
+        packets = [self.dhcp_proto.create_packet() for _ in range(3)]
+        xids = [self.dhcp_proto.get_request_key(packet)
+                for packet in packets]
+        self.assertEqual(3, len(set(xids)))
+        # The offers are only read after all the requests were sent
+        for packet in packets:
+            self.dhcp_proto.send_packet(packet)
+        for _ in packets:
+            self.reader.read_pending()
+        requests = self.dhcp_proto.wait_for_completion(1)
+        self.assertEqual(set(xids), set(requests))
+        self.assertEqual({base_handler.REQUEST_REPLIED},
+                         {request.reason for request in requests.values()})
+        self.assertEqual({}, self.dhcp_proto.wait_for_completion(0))
+
+    def test_untracked_xid_ignored(self):
+        results = []
+        self.dhcp_proto.register_callback(results.append)
+        self.dhcp_proto.send_packet(self.dhcp_proto.create_packet())
+        self.transport.inject(frames.build_dhcp_offer(xid=1))
+        self.reader.read_pending()
+        self.reader.read_pending()
+        self.assertEqual([[]], results)
+
+    def test_async_probes(self):
+        async_dhcp = async_handler.AsyncProtocolHandler(self.dhcp_proto)
+
+        async def probe_all():
+            return await asyncio.gather(*(
+                async_dhcp.probe(async_dhcp.create_packet(), timeout=1)
+                for _ in range(3)))
+
+        self._start_reader()
+        # Every probe gets the results of the offer to its own request
+        self.assertEqual([[[]]] * 3, asyncio.run(probe_all()))
+
+
+class TestPassiveHandler(_ProbeTestCase):
+
+    def test_results(self):
+        monitor = dhcp_monitor.DHCPMonitor(self.reader, [frames.SERVER_MAC])
+        self.addCleanup(monitor.close)
+        # A passive handler has no socket to set the timeout of
+        async_monitor = async_handler.AsyncProtocolHandler(monitor)
+
+        async def first_result():
+            results = async_monitor.results()
+            receiving = asyncio.ensure_future(results.__anext__())
+            await asyncio.sleep(0)
+            self.transport.inject(frames.build_dhcp_reply(
+                server_mac=SPOOFER_MAC, dst_mac=frames.MAC_BROADCAST))
+            try:
+                return await asyncio.wait_for(receiving, 1)
+            finally:
+                await results.aclose()
+
+        self._start_reader()
+        errors = asyncio.run(first_result())
+        self.assertEqual([protocol_errors.RogueServer],
+                         [error.__class__ for error in errors])
+
+
+class TestARPProbes(_ProbeTestCase):
+
+    def setUp(self):
+        super(TestARPProbes, self).setUp()
+        self.responder = peers.ArpResponder(self.transport, {
+            frames.SERVER_IP: frames.SERVER_MAC,
+            OTHER_SERVER_IP: SPOOFER_MAC,
+        })
+        self.addCleanup(self.responder.close)
+
+    def test_async_probes(self):
+        arp_proto = ARP.ARPProto(self.reader, False, {
+            frames.SERVER_IP: frames.SERVER_MAC,
+            OTHER_SERVER_IP: frames.SERVER_MAC})
+        self.addCleanup(arp_proto.close)
+        async_arp = async_handler.AsyncProtocolHandler(arp_proto)
+
+        async def probe_all():
+            return await asyncio.gather(*(
+                async_arp.probe(async_arp.create_packet(ip_address),
+                                timeout=0.5)
+                for ip_address in (frames.SERVER_IP, OTHER_SERVER_IP,
+                                   '10.0.0.4')))
+
+        self._start_reader()
+        (server_results, other_results,
+         missing_results) = asyncio.run(probe_all())
+        # Every probe gets the results of the reply to its own request
+        self.assertEqual([[]], server_results)
+        self.assertEqual([[protocol_errors.InvalidARP]],
+                         [[error.__class__ for error in errors]
+                          for errors in other_results])
+        self.assertEqual([], missing_results)
@@ -0,0 +1,109 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from zaphod.common import address_set
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import transport
+from zaphod.protocols import dhcp_client
+from zaphod.tests import frames
+from zaphod.tests import peers
+
+CLIENTS = 5
+
+
+class TestDHCPClientSimulator(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+        self.reader = packet_reader.PacketReader(
+            transport=self.transport, read_timeout=0.1,
+            registry=metrics.Registry())
+        self.addCleanup(self.reader.close)
+        self.simulator = dhcp_client.DHCPClientSimulator(
+            self.reader, phase_timeout=0.2, retries=1)
+        self.addCleanup(self.simulator.close)
+        self.reader.start_reader()
+        self.addCleanup(self.reader.stop_reader)
+
+    def _start_server(self, **kwargs):
+        server = peers.DhcpServer(self.transport, **kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def _states(self, report):
+        return [transaction.state for transaction in report.transactions]
+
+    def test_bound(self):
+        self._start_server()
+        report = self.simulator.run(CLIENTS, rate=1000, release=False)
+        self.assertEqual([dhcp_client.STATE_BOUND] * CLIENTS,
+                         self._states(report))
+        offered = sorted(transaction.offered_ip
+                         for transaction in report.transactions)
+        first_ip = address_set.ip_to_int(frames.OFFERED_IP)
+        self.assertEqual(list(range(first_ip, first_ip + CLIENTS)), offered)
+        for transaction in report.transactions:
+            self.assertEqual(address_set.ip_to_int(frames.SERVER_IP),
+                             transaction.server_ip)
+            self.assertEqual(3600, transaction.lease_time)
+            self.assertEqual({dhcp_client.PHASE_DISCOVER,
+                              dhcp_client.PHASE_REQUEST},
+                             set(transaction.latencies))
+        summary = report.summary()
+        self.assertEqual(CLIENTS, summary['leases'])
+        self.assertEqual(0, summary['retries'])
+
+    def test_released(self):
+        server = self._start_server()
+        report = self.simulator.run(CLIENTS, rate=1000)
+        self.assertEqual([dhcp_client.STATE_RELEASED] * CLIENTS,
+                         self._states(report))
+        # Every client released its lease
+        self.assertEqual(sorted(transaction.chaddr
+                                for transaction in report.transactions),
+                         sorted(server.released))
+
+    def test_nak(self):
+        self._start_server(nak=True)
+        report = self.simulator.run(CLIENTS, rate=1000)
+        self.assertEqual([dhcp_client.STATE_NAKED] * CLIENTS,
+                         self._states(report))
+        self.assertEqual(0, report.summary()['leases'])
+
+    def test_retry(self):
+        # The first DISCOVER is not answered
+        self._start_server(drop=1)
+        report = self.simulator.run(1, release=False)
+        transaction, = report.transactions
+        self.assertEqual(dhcp_client.STATE_BOUND, transaction.state)
+        self.assertEqual(1, transaction.retries)
+
+    def test_timeout(self):
+        server = self._start_server(drop=CLIENTS * 2)
+        report = self.simulator.run(CLIENTS, rate=1000)
+        self.assertEqual([dhcp_client.STATE_TIMED_OUT] * CLIENTS,
+                         self._states(report))
+        # Every DISCOVER was sent once, and retried once
+        self.assertEqual(CLIENTS * 2, len(server.received))
+        summary = report.summary()
+        self.assertEqual(CLIENTS, summary['retries'])
+        self.assertEqual({}, summary['latencies'])
@@ -0,0 +1,173 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from zaphod.common import address_set
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import packet_template
+from zaphod.common import protocol_errors
+from zaphod.common import transport
+from zaphod.protocols import dhcp_monitor
+from zaphod.protocols import dhcp_packet
+from zaphod.tests import frames
+
+OTHER_SERVER_MAC = '02:00:00:00:00:fd'
+OTHER_CLIENT_MAC = '02:00:00:00:00:02'
+
+
+def build_reply(message_type=dhcp_packet.DHCP_OFFER, server_mac=None,
+                client_mac=frames.LOCAL_MAC, dst_mac=None,
+                offered_ip=frames.OFFERED_IP, relay_ip=None, xid=1,
+                **options):
+    return frames.build_dhcp_reply(
+        message_type, xid, server_mac or frames.SERVER_MAC, client_mac,
+        dst_mac, offered_ip,
+        frames.build_dhcp_options(message_type, **options), relay_ip)
+
+
+class TestDHCPMonitor(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+        self.reader = packet_reader.PacketReader(
+            transport=self.transport, read_timeout=1,
+            registry=metrics.Registry())
+        self.addCleanup(self.reader.close)
+        self.errors = []
+        self.events = []
+
+    def _create_monitor(self, **kwargs):
+        monitor = dhcp_monitor.DHCPMonitor(self.reader, **kwargs)
+        monitor.register_callback(self.errors.extend)
+        monitor.register_event_callback(self.events.append)
+        self.addCleanup(monitor.close)
+        return monitor
+
+    def _receive(self, *replies):
+        for frame in replies:
+            self.transport.inject(frame)
+            self.reader.read_pending()
+
+    def _error_classes(self):
+        return [error.__class__ for error in self.errors]
+
+    def test_allowed_server(self):
+        monitor = self._create_monitor(
+            allowed_servers=[frames.SERVER_MAC],
+            allowed_dhcp_ranges=['10.0.0.0/24'])
+        self._receive(build_reply(xid=7),
+                      build_reply(dhcp_packet.DHCP_ACK, xid=7))
+        self.assertEqual([], self.errors)
+        self.assertEqual([dhcp_monitor.EVENT_OFFER, dhcp_monitor.EVENT_ACK],
+                         [event.event_type for event in self.events])
+        self.assertEqual(7, self.events[0].xid)
+        server, = monitor.get_servers()
+        self.assertEqual(frames.SERVER_MAC, server['mac'])
+        self.assertEqual(frames.SERVER_IP, server['server_ip'])
+        self.assertEqual(['10.0.0.0/24'], server['offered_ranges'])
+        self.assertEqual((1, 1, 0), (server['offers'], server['acks'],
+                                     server['naks']))
+
+    def test_rogue_server(self):
+        self._create_monitor(allowed_servers=[frames.SERVER_MAC])
+        self._receive(build_reply(server_mac=OTHER_SERVER_MAC),
+                      build_reply(server_mac=OTHER_SERVER_MAC))
+        # Reported once, when the server is first seen
+        self.assertEqual([protocol_errors.RogueServer],
+                         self._error_classes())
+        self.assertEqual(OTHER_SERVER_MAC, self.errors[0].mac)
+
+    def test_learn(self):
+        monitor = self._create_monitor(allowed_servers=[frames.SERVER_MAC])
+        monitor.learn = True
+        self._receive(build_reply(server_mac=OTHER_SERVER_MAC))
+        self.assertEqual([], self.errors)
+        self.assertEqual({'servers': [OTHER_SERVER_MAC, frames.SERVER_MAC]},
+                         monitor.export_learned_state())
+
+    def test_changed_options(self):
+        self._create_monitor(allowed_servers=[frames.SERVER_MAC])
+        self._receive(build_reply(), build_reply(),
+                      build_reply(gateway_ip='10.0.0.253'))
+        self.assertEqual([protocol_errors.ChangedServer],
+                         self._error_classes())
+
+    def test_requested_options(self):
+        self._create_monitor(allowed_servers=[frames.SERVER_MAC])
+        # The clients asked for different options, and got only them
+        self._receive(
+            build_reply(client_mac=OTHER_CLIENT_MAC,
+                        dst_mac=frames.MAC_BROADCAST),
+            build_reply(dns_ip=None, mtu=None),
+            build_reply(dhcp_packet.DHCP_ACK, dns_ip=None))
+        self.assertEqual([], self.errors)
+
+    def test_fingerprint_by_subnet_and_type(self):
+        self._create_monitor(allowed_servers=[frames.SERVER_MAC])
+        self._receive(
+            build_reply(),
+            # A relayed subnet, with its own mask and gateway
+            build_reply(offered_ip='10.1.0.100', relay_ip='10.1.0.1',
+                        gateway_ip='10.1.0.1', subnet_mask='255.255.0.0'),
+            # An ACK to an INFORM carries no address and no lease time
+            build_reply(dhcp_packet.DHCP_ACK, offered_ip='0.0.0.0',
+                        lease_time=None),
+            build_reply(dhcp_packet.DHCP_ACK))
+        self.assertEqual([], self.errors)
+        self._receive(build_reply(offered_ip='10.1.0.101',
+                                  relay_ip='10.1.0.1', gateway_ip='10.1.0.2',
+                                  subnet_mask='255.255.0.0'))
+        self.assertEqual([protocol_errors.ChangedServer],
+                         self._error_classes())
+
+    def test_offered_range(self):
+        self._create_monitor(allowed_servers=[frames.SERVER_MAC],
+                             allowed_dhcp_ranges=['10.0.0.0/25'])
+        self._receive(build_reply(offered_ip='10.0.0.100'),
+                      build_reply(offered_ip='10.0.0.200'))
+        self.assertEqual([protocol_errors.InvalidIPAddress],
+                         self._error_classes())
+        self.assertEqual('10.0.0.200', self.errors[0].ip_address)
+
+    def test_offers_to_other_clients(self):
+        self._create_monitor()
+        self._receive(build_reply(client_mac=OTHER_CLIENT_MAC,
+                                  dst_mac='ff:ff:ff:ff:ff:ff'))
+        event, = self.events
+        self.assertEqual(OTHER_CLIENT_MAC,
+                         address_set.int_to_mac(event.client_mac))
+
+    def test_max_servers(self):
+        monitor = self._create_monitor(max_servers=1)
+        self._receive(build_reply(),
+                      build_reply(server_mac=OTHER_SERVER_MAC))
+        self.assertEqual([OTHER_SERVER_MAC],
+                         [server['mac'] for server in monitor.get_servers()])
+
+    def test_requests_are_ignored(self):
+        monitor = self._create_monitor()
+        request = bytearray(build_reply())
+        # Turn the reply into a request, keeping the checksums out of it
+        request[packet_template.UDP_PAYLOAD_OFFSET] = \
+            dhcp_packet.DHCP_BOOT_REQUEST
+        self._receive(bytes(request))
+        self.assertEqual([], self.events)
+        self.assertEqual([], monitor.get_servers())
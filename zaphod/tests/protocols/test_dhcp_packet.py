@@ -0,0 +1,114 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import unittest
+
+from zaphod.common import address_set
+from zaphod.common import packet_template
+from zaphod.protocols import DHCP
+from zaphod.protocols import dhcp_packet
+from zaphod.tests import frames
+
+
+def build_frame(message):
+    return packet_template.build_udp_frame(
+        frames.LOCAL_MAC, frames.SERVER_MAC,
+        frames.OFFERED_IP, frames.SERVER_IP,
+        DHCP.DHCP_CLIENT_PORT, DHCP.DHCP_SERVER_PORT, message)
+
+
+def build_offer(option_list):
+    return build_frame(dhcp_packet.build_message(
+        dhcp_packet.DHCP_BOOT_REPLY, 0x1234,
+        packet_template.mac_to_bytes(frames.LOCAL_MAC),
+        option_list))
+
+
+class TestParse(unittest.TestCase):
+
+    def test_offer(self):
+        message = dhcp_packet.parse(frames.build_dhcp_offer(xid=0xdeadbeef))
+        self.assertEqual(dhcp_packet.DHCP_BOOT_REPLY, message.op)
+        self.assertEqual(dhcp_packet.DHCP_OFFER, message.message_type)
+        self.assertEqual(0xdeadbeef, message.xid)
+        self.assertEqual(frames.OFFERED_IP,
+                         address_set.int_to_ip(message.yiaddr))
+        self.assertEqual(frames.SERVER_IP,
+                         address_set.int_to_ip(message.siaddr))
+        self.assertEqual(frames.SERVER_IP,
+                         address_set.int_to_ip(message.src_ip))
+        self.assertEqual(frames.SERVER_MAC,
+                         dhcp_packet.format_mac(message.src_mac))
+        self.assertEqual(frames.LOCAL_MAC,
+                         dhcp_packet.format_mac(message.chaddr))
+        self.assertEqual(
+            packet_template.ip_to_bytes(frames.GATEWAY_IP),
+            bytes(message.options[dhcp_packet.DHCP_GATEWAY_ADDR_OPT]))
+        self.assertEqual(struct.pack('!H', 1500),
+                         bytes(message.options[dhcp_packet.DHCP_MTU_OPT]))
+        # The message type is a field, not an option
+        self.assertNotIn(dhcp_packet.DHCP_MESSAGE_TYPE_OPT, message.options)
+
+    def test_option_tags(self):
+        message = dhcp_packet.parse(frames.build_dhcp_offer(),
+                                    {dhcp_packet.DHCP_MTU_OPT})
+        self.assertEqual([dhcp_packet.DHCP_MTU_OPT],
+                         list(message.options))
+        self.assertEqual(dhcp_packet.DHCP_OFFER, message.message_type)
+
+    def test_split_options_are_joined(self):
+        routes = dhcp_packet.DHCP_STATIC_ROUTE_OPT
+        message = dhcp_packet.parse(build_offer([
+            (routes, b'\x0a\x00\x00\x00'), (routes, b'\x0a\x00\x00\x01')]))
+        self.assertEqual(b'\x0a\x00\x00\x00\x0a\x00\x00\x01',
+                         bytes(message.options[routes]))
+
+    def test_pad_options(self):
+        message = dhcp_packet.build_message(
+            dhcp_packet.DHCP_BOOT_REPLY, 1, b'\x02' * 6,
+            [(dhcp_packet.DHCP_MTU_OPT, b'\x05\xdc')])
+        # Insert pad options before the first option
+        options_offset = len(message) - 5
+        message = (message[:options_offset] + b'\0\0' +
+                   message[options_offset:])
+        parsed = dhcp_packet.parse(build_frame(message))
+        self.assertEqual(b'\x05\xdc',
+                         bytes(parsed.options[dhcp_packet.DHCP_MTU_OPT]))
+
+    def test_truncated_option(self):
+        message = dhcp_packet.build_message(
+            dhcp_packet.DHCP_BOOT_REPLY, 1, b'\x02' * 6,
+            [(dhcp_packet.DHCP_MTU_OPT, b'\x05\xdc')])
+        # The option claims more data than the datagram has
+        message = message[:-4] + b'\x10\x05\xdc'
+        self.assertIsNone(dhcp_packet.parse(build_frame(message)))
+
+    def test_bad_magic_cookie(self):
+        frame = bytearray(frames.build_dhcp_offer())
+        cookie_offset = frame.find(dhcp_packet.DHCP_MAGIC_COOKIE)
+        frame[cookie_offset] ^= 0xff
+        self.assertIsNone(dhcp_packet.parse(bytes(frame)))
+
+    def test_short_datagram(self):
+        self.assertIsNone(dhcp_packet.parse(build_frame(b'\x02' * 100)))
+
+    def test_truncated_udp_header(self):
+        # Only the ports of the UDP header are in the frame
+        frame = build_frame(b'')[:packet_template.UDP_PAYLOAD_OFFSET - 4]
+        self.assertIsNone(dhcp_packet.parse(frame))
+
+    def test_not_udp(self):
+        self.assertIsNone(dhcp_packet.parse(frames.build_arp_reply()))
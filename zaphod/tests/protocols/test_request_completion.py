@@ -0,0 +1,129 @@
+# Copyright (C) 2020 Shachar Snapiri
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+from zaphod.common import logger
+from zaphod.common import metrics
+from zaphod.common import packet_reader
+from zaphod.common import protocol_errors
+from zaphod.common import transport
+from zaphod.protocols import ARP
+from zaphod.protocols import DHCP
+from zaphod.protocols import base_handler
+from zaphod.tests import frames
+from zaphod.tests import peers
+
+SPOOFER_MAC = '02:00:00:00:00:66'
+REQUEST_TIMEOUT = 5
+
+
+class _CompletionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logger.set_log_level(logger.CRITICAL)
+        self.transport = transport.MemoryTransport(
+            iface_mac=frames.LOCAL_MAC, iface_ip=frames.LOCAL_IP)
+        self.addCleanup(self.transport.close)
+        self.reader = packet_reader.PacketReader(
+            transport=self.transport, read_timeout=0.1,
+            registry=metrics.Registry())
+        self.addCleanup(self.reader.close)
+        self.errors = []
+
+    def _add_handler(self, handler):
+        handler.register_callback(self.errors.extend)
+        handler.request_timeout = REQUEST_TIMEOUT
+        self.addCleanup(handler.close)
+        return handler
+
+    def _start_reader(self):
+        self.reader.start_reader()
+        self.addCleanup(self.reader.stop_reader)
+
+
+class TestARPCompletion(_CompletionTestCase):
+
+    def setUp(self):
+        super(TestARPCompletion, self).setUp()
+        self.responder = peers.ArpResponder(self.transport, {
+            frames.SERVER_IP: frames.SERVER_MAC})
+        self.addCleanup(self.responder.close)
+
+    def _create_handler(self, known_addresses=None):
+        return self._add_handler(
+            ARP.ARPProto(self.reader, False, known_addresses))
+
+    def test_reply(self):
+        arp_proto = self._create_handler({frames.SERVER_IP: frames.SERVER_MAC})
+        arp_proto.send_packet(arp_proto.create_packet(frames.SERVER_IP))
+        self.reader.read_pending()
+        request, = arp_proto.wait_for_completion(1).values()
+        self.assertEqual(base_handler.REQUEST_REPLIED, request.reason)
+        self.assertEqual([], self.errors)
+
+    def test_wrong_mac(self):
+        arp_proto = self._create_handler({frames.SERVER_IP: SPOOFER_MAC})
+        arp_proto.send_packet(arp_proto.create_packet(frames.SERVER_IP))
+        self.reader.read_pending()
+        self.assertEqual([protocol_errors.InvalidARP],
+                         [error.__class__ for error in self.errors])
+
+    def test_timeout(self):
+        arp_proto = self._create_handler()
+        arp_proto.request_timeout = 0.05
+        arp_proto.send_packet(arp_proto.create_packet('10.0.0.4'))
+        request, = arp_proto.wait_for_completion(1).values()
+        self.assertEqual(base_handler.REQUEST_TIMED_OUT, request.reason)
+
+    def test_early_completion(self):
+        arp_proto = self._create_handler({frames.SERVER_IP: frames.SERVER_MAC})
+        self._start_reader()
+        started = time.monotonic()
+        arp_proto.send_packet(arp_proto.create_packet(frames.SERVER_IP))
+        request, = arp_proto.wait_for_completion().values()
+        # Returns once the reply was handled, not at the request timeout
+        self.assertLess(time.monotonic() - started, REQUEST_TIMEOUT / 2)
+        self.assertEqual(base_handler.REQUEST_REPLIED, request.reason)
+
+
+class TestDHCPCompletion(_CompletionTestCase):
+
+    def _run_check(self, servers, grace):
+        server = peers.DhcpServer(self.transport, servers)
+        self.addCleanup(server.close)
+        dhcp_proto = self._add_handler(
+            DHCP.DHCPProto(self.reader, False, [frames.SERVER_MAC]))
+        self._start_reader()
+        started = time.monotonic()
+        dhcp_proto.send_packet(dhcp_proto.create_packet())
+        request, = dhcp_proto.wait_for_completion(grace=grace).values()
+        self.assertEqual(base_handler.REQUEST_REPLIED, request.reason)
+        return time.monotonic() - started
+
+    def test_grace_after_offer(self):
+        duration = self._run_check(((frames.SERVER_MAC, 0),), 0.2)
+        self.assertGreaterEqual(duration, 0.2)
+        self.assertLess(duration, REQUEST_TIMEOUT / 2)
+        self.assertEqual([], self.errors)
+
+    def test_rogue_offer_in_grace(self):
+        duration = self._run_check(
+            ((frames.SERVER_MAC, 0), (SPOOFER_MAC, 0.1)), DHCP.OFFER_GRACE)
+        # The offer of the rogue server, after the first one, is checked
+        self.assertLess(duration, REQUEST_TIMEOUT / 2)
+        self.assertEqual([protocol_errors.InvalidServerMAC],
+                         [error.__class__ for error in self.errors])